@@ -0,0 +1,356 @@
+import asyncio
+import mmap
+import os
+import time
+
+from parsers import parse_commands
+from rdb import RDB_HEADER, load_rdb, iter_rdb_chunks
+from commands import COMMANDS
+from keyspace import copy_keyspace
+from globals import db, rdb_state, aof_state
+from config import server_config
+
+APPENDFSYNC_POLICIES = ("always", "everysec", "no")
+
+# How often the everysec policy syncs the log, and how often a running
+# rewrite is checked for completion, in seconds.
+AOF_FSYNC_INTERVAL = 1
+AOF_REWRITE_POLL_INTERVAL = 0.05
+
+# The log is replayed this many bytes at a time.
+AOF_LOAD_CHUNK = 4 * 1024 * 1024
+
+
+def aof_path():
+    """
+    Return the configured append-only file path.
+    """
+    return os.path.join(server_config["dir"] or ".", server_config["appendfilename"])
+
+
+def start_aof():
+    """
+    Open the append-only file for appending and start logging writes.
+    Without a log yet, the current dataset (e.g. loaded from the RDB file)
+    is written as its base first, so nothing is lost on the next start.
+    """
+    path = aof_path()
+    if not os.path.exists(path):
+        write_aof_base(path, db["dict"], db["expires"])
+    aof_state["fd"] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    aof_state["size"] = os.fstat(aof_state["fd"]).st_size
+
+
+def feed_aof(data):
+    """
+    Queue an encoded write command for the log.
+    The queue is written out once the current event loop turn is over, so
+    the commands of many clients go to the file with one write.
+    """
+    if aof_state["fd"] is None:
+        return
+    aof_state["buffer"].append(data)
+    aof_state["fed"] += len(data)
+    if aof_state["rewrite_buffer"] is not None:
+        aof_state["rewrite_buffer"].append(data)
+    if not aof_state["write_scheduled"]:
+        aof_state["write_scheduled"] = True
+        asyncio.get_running_loop().call_soon(write_aof_buffer)
+
+
+def write_all(fd, data):
+    """
+    Write all of 'data' to 'fd', however many calls it takes.
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def write_aof_buffer():
+    """
+    Write the queued commands to the log. This only copies them to the OS;
+    when they reach the disk depends on the appendfsync policy.
+    """
+    aof_state["write_scheduled"] = False
+    if not aof_state["buffer"] or aof_state["fd"] is None:
+        return
+    data = b"".join(aof_state["buffer"])
+    aof_state["buffer"].clear()
+    try:
+        write_all(aof_state["fd"], data)
+    except OSError as e:
+        # Keep the data queued and try again with the next write
+        aof_state["buffer"].append(data)
+        aof_state["last_write_status"] = "err"
+        print(f"Error writing the AOF: {e}")
+        return
+    aof_state["last_write_status"] = "ok"
+    aof_state["written"] += len(data)
+    aof_state["size"] += len(data)
+
+
+async def fsync_aof(offset=None):
+    """
+    Wait until the log is on disk up to 'offset' bytes fed (by default all
+    of it). The fsync runs in a worker thread, so the event loop never waits
+    for the disk, and only one runs at a time: clients waiting together are
+    covered by the same fsync (group commit).
+    """
+    if offset is None:
+        offset = aof_state["fed"]
+    while aof_state["synced"] < offset and aof_state["fd"] is not None:
+        task = aof_state["fsync_task"]
+        if task is None:
+            task = aof_state["fsync_task"] = asyncio.ensure_future(fsync_round())
+        synced = aof_state["synced"]
+        # A round that started before our data was written is followed by another
+        await asyncio.shield(task)
+        if aof_state["synced"] == synced and aof_state["last_write_status"] == "err":
+            return
+
+
+async def fsync_round():
+    """
+    Write out the queue and run one fsync covering everything written.
+    """
+    try:
+        write_aof_buffer()
+        upto = aof_state["written"]
+        if upto > aof_state["synced"]:
+            await asyncio.to_thread(os.fsync, aof_state["fd"])
+            # A rewrite finishing meanwhile may have synced more already
+            aof_state["synced"] = max(aof_state["synced"], upto)
+    except OSError as e:
+        aof_state["last_write_status"] = "err"
+        print(f"Error syncing the AOF: {e}")
+    finally:
+        aof_state["fsync_task"] = None
+
+
+async def aof_fsync_loop():
+    """
+    Background task syncing the log once per second for the everysec policy.
+    """
+    while True:
+        await asyncio.sleep(AOF_FSYNC_INTERVAL)
+        if aof_state["fd"] is not None and aof_state["fed"] > aof_state["synced"]:
+            await fsync_aof()
+
+
+def load_aof(file_path):
+    """
+    Replay the append-only file at 'file_path' into the dataset.
+    A rewritten log starts with an RDB snapshot, loaded with the RDB loader;
+    the commands after it are parsed a large chunk at a time and applied
+    through the command handlers. A command cut short at the end of the
+    file (e.g. by a crash) is dropped from it.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
+
+    started = time.perf_counter()
+    applied = truncated = 0
+    discarded = []
+    with open(file_path, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        offset = load_rdb(data) if data[:5] == RDB_HEADER[:5] else 0
+
+        chunk_size = AOF_LOAD_CHUNK
+        while offset < size:
+            commands, consumed = parse_commands(data[offset:offset + chunk_size])
+            if not consumed:
+                if offset + chunk_size >= size:
+                    truncated = size - offset
+                    break
+                # A single command larger than the chunk
+                chunk_size *= 2
+                continue
+            offset += consumed
+            for result in commands:
+                entry = COMMANDS.get(result[0].upper())
+                if entry is None or "write" not in entry["flags"]:
+                    raise ValueError(f"Unexpected command in AOF: {result[0]!r}")
+                entry["handler"](None, result, discarded)
+                discarded.clear()
+            applied += len(commands)
+
+    if truncated:
+        # Cut the partial command off, or new writes would be appended to it
+        print(f"Warning: truncating {truncated} bytes of incomplete command at the end of the AOF")
+        os.truncate(file_path, size - truncated)
+
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"AOF loaded: {applied} commands replayed in {elapsed:.3f} seconds")
+
+
+def write_aof_base(file_path, keyspace, expiries):
+    """
+    Write a compacted log holding only an RDB snapshot of 'keyspace' to
+    'file_path' (not renamed into place; the caller appends and renames).
+    """
+    with open(file_path, "wb") as file:
+        for chunk in iter_rdb_chunks(keyspace, expiries):
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def fsync_dir(path):
+    """
+    Sync the directory holding 'path', so a file renamed into it survives
+    a crash.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def rewrite_temp_path(pid):
+    """
+    Return the temporary file a rewrite by process 'pid' writes to.
+    """
+    return os.path.join(server_config["dir"] or ".", f"temp-rewriteaof-{pid}.aof")
+
+
+async def bgrewriteaof():
+    """
+    Compact the log in the background.
+    A forked child writes the current dataset as an RDB snapshot to a
+    temporary file, while the parent keeps logging to the old file and also
+    collects the writes made meanwhile. Once the child is done, those writes
+    are appended to the new file, which then replaces the old one.
+    Where fork() is not available, a shallow copy is written from a thread.
+    Returns False if a rewrite is already running.
+    """
+    if aof_state["rewrite_buffer"] is not None:
+        return False
+
+    aof_state["rewrite_buffer"] = []
+    if hasattr(os, "fork"):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                write_aof_base(rewrite_temp_path(os.getpid()), db["dict"], db["expires"])
+            except BaseException as e:
+                print(f"Error in AOF rewrite: {e}")
+                status = 1
+            os._exit(status)
+        aof_state["rewrite_task"] = asyncio.create_task(wait_for_rewrite(pid))
+    else:
+        aof_state["rewrite_task"] = asyncio.create_task(rewrite_in_thread(copy_keyspace(), db["expires"].copy()))
+    return True
+
+
+async def rewrite_new_dataset():
+    """
+    Start the log over after the whole dataset was replaced without being
+    logged (a full resync from a master). A rewrite already running writes
+    the old dataset, so it is left to finish first.
+    """
+    while not await bgrewriteaof():
+        await asyncio.shield(aof_state["rewrite_task"])
+
+
+async def wait_for_rewrite(pid):
+    """
+    Reap the rewrite child and install its file once it exits.
+    """
+    while True:
+        done_pid, status = os.waitpid(pid, os.WNOHANG)
+        if done_pid:
+            break
+        await asyncio.sleep(AOF_REWRITE_POLL_INTERVAL)
+    ok = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    await finish_rewrite(rewrite_temp_path(pid), ok)
+
+
+async def rewrite_in_thread(keyspace, expiries):
+    """
+    Write a copied dataset as the new log base from a worker thread.
+    """
+    temp_path = rewrite_temp_path(os.getpid())
+    try:
+        await asyncio.to_thread(write_aof_base, temp_path, keyspace, expiries)
+    except Exception as e:
+        print(f"Error in AOF rewrite: {e}")
+        await finish_rewrite(temp_path, False)
+    else:
+        await finish_rewrite(temp_path, True)
+
+
+async def finish_rewrite(temp_path, ok):
+    """
+    Append the writes made during the rewrite to the new file and switch the
+    log over to it. Most of them are appended and synced from a thread;
+    only the last few, arriving meanwhile, are written and synced from the
+    event loop just before the switch, so no write is lost or logged twice
+    and everything logged so far is on disk in the new file once it
+    replaces the old one.
+    """
+    try:
+        if not ok:
+            raise OSError("child process failed")
+        fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            pending = aof_state["rewrite_buffer"]
+            aof_state["rewrite_buffer"] = []
+            await asyncio.to_thread(write_all, fd, b"".join(pending))
+            await asyncio.to_thread(os.fsync, fd)
+
+            # No await from here on: the switch happens between two writes
+            write_all(fd, b"".join(aof_state["rewrite_buffer"]))
+            write_aof_buffer()
+            os.fsync(fd)
+            os.replace(temp_path, aof_path())
+        except BaseException:
+            os.close(fd)
+            raise
+    except OSError as e:
+        print(f"Background AOF rewrite failed: {e}")
+        aof_state["rewrite_buffer"] = None
+        aof_state["last_rewrite_status"] = "err"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+
+    old_fd = aof_state["fd"]
+    aof_state["fd"] = fd
+    aof_state["size"] = os.fstat(fd).st_size
+    aof_state["synced"] = aof_state["written"]
+    aof_state["rewrite_buffer"] = None
+    aof_state["last_rewrite_status"] = "ok"
+    print("Background AOF rewrite finished successfully")
+    try:
+        fsync_dir(aof_path())
+    except OSError as e:
+        print(f"Error syncing the AOF directory: {e}")
+
+    # An fsync started before the switch may still be using the old file
+    while aof_state["fsync_task"] is not None:
+        await asyncio.shield(aof_state["fsync_task"])
+    if old_fd is not None:
+        os.close(old_fd)
+
+
+def persistence_info():
+    """
+    Build the text of INFO persistence.
+    """
+    lines = [
+        "# Persistence",
+        f"rdb_changes_since_last_save:{rdb_state['changes']}",
+        f"rdb_bgsave_in_progress:{int(rdb_state['bgsave_pid'] is not None)}",
+        f"rdb_last_save_time:{int(rdb_state['last_save'])}",
+        f"rdb_last_bgsave_status:{rdb_state['last_bgsave_status']}",
+        f"aof_enabled:{int(aof_state['fd'] is not None)}",
+        f"aof_rewrite_in_progress:{int(aof_state['rewrite_buffer'] is not None)}",
+        f"aof_last_bgrewrite_status:{aof_state['last_rewrite_status']}",
+        f"aof_last_write_status:{aof_state['last_write_status']}",
+        f"aof_current_size:{aof_state['size']}",
+    ]
+    return "\r\n".join(lines) + "\r\n"
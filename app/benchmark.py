@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+
+from parsers import split_replies, encode_command
+
+TESTS = ("PING", "SET", "GET", "MGET", "SETPX", "WAIT")
+
+# Percentiles of the latency reported for each run.
+LATENCY_PERCENTILES = (50, 99, 99.9)
+
+# With a key space, each client cycles through this many pipelines of random keys.
+PIPELINE_VARIANTS = 16
+
+
+def make_key(i, keyspace):
+    """
+    Return the key of the 'i'th command of a pipeline: key:<i>, or a random
+    key:<n> with n below 'keyspace' if one is set.
+    """
+    return f"key:{random.randrange(keyspace) if keyspace else i}"
+
+
+def build_request(test, i, value, args):
+    """
+    Build the commands of a single request of a benchmark test.
+    A WAIT request is a SET followed by the WAIT, so there is a write to wait for.
+    """
+    key = make_key(i, args.keyspace)
+    if test == "PING":
+        return [encode_command(["PING"])]
+    if test == "SET":
+        return [encode_command(["SET", key, value])]
+    if test == "GET":
+        return [encode_command(["GET", key])]
+    if test == "MGET":
+        keys = [make_key(n, args.keyspace) for n in range(args.mget_keys)]
+        return [encode_command(["MGET", *keys])]
+    if test == "SETPX":
+        return [encode_command(["SET", key, value, "PX", str(args.px)])]
+    if test == "WAIT":
+        return [encode_command(["SET", key, value]),
+                encode_command(["WAIT", str(args.wait_replicas), str(args.wait_timeout)])]
+    raise ValueError(f"unknown test: {test}")
+
+
+def build_pipelines(test, depth, value, args):
+    """
+    Build the raw bytes of pipelines of 'depth' requests for a benchmark
+    test, with the number of replies each one gets. Random keys need a few
+    different pipelines; fixed keys need only one.
+    """
+    pipelines = []
+    for _ in range(PIPELINE_VARIANTS if args.keyspace else 1):
+        commands = [command for i in range(depth) for command in build_request(test, i, value, args)]
+        pipelines.append(b"".join(commands))
+    replies = depth * (2 if test == "WAIT" else 1)
+    return pipelines, replies
+
+
+async def read_replies(reader, count, buffer):
+    """
+    Read until 'count' complete replies have arrived.
+    Returns the number of error replies among them.
+    """
+    errors = 0
+    while count:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        buffer += data
+        replies, consumed = split_replies(buffer)
+        del buffer[:consumed]
+        count -= len(replies)
+        errors += sum(reply.startswith(b"-") for reply in replies)
+    return errors
+
+
+async def run_client(host, port, pipelines, replies, rounds, latencies):
+    """
+    Send 'rounds' pipelines over one connection, recording the time each
+    one takes to be answered in 'latencies'.
+    Returns the number of error replies.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    buffer = bytearray()
+    errors = 0
+    try:
+        for payload in itertools.islice(itertools.cycle(pipelines), rounds):
+            start = time.perf_counter()
+            writer.write(payload)
+            errors += await read_replies(reader, replies, buffer)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return errors
+
+
+def percentile(sorted_values, pct):
+    """
+    Return the value below which 'pct' percent of 'sorted_values' fall.
+    """
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+async def run_test(host, port, test, clients, requests, depth, value_size, args):
+    """
+    Run a single test and return its result as a dict.
+    Latencies are those of whole pipelines: every request of a pipeline is
+    answered when the last reply arrives.
+    """
+    pipelines, replies = build_pipelines(test, depth, "x" * value_size, args)
+    rounds = max(1, requests // (clients * depth))
+    latencies = []
+    start = time.perf_counter()
+    errors = await asyncio.gather(*(run_client(host, port, pipelines, replies, rounds, latencies)
+                                    for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "test": test,
+        "clients": clients,
+        "pipeline": depth,
+        "value_size": value_size,
+        "keyspace": args.keyspace,
+        "requests": rounds * depth * clients,
+        "errors": sum(errors),
+        "seconds": round(elapsed, 6),
+        "ops_per_sec": round(rounds * depth * clients / elapsed, 1),
+        "latency_ms": {
+            **{f"p{pct:g}": round(percentile(latencies, pct) * 1000, 3) for pct in LATENCY_PERCENTILES},
+            "max": round(latencies[-1] * 1000, 3)
+        }
+    }
+
+
+def format_result(result):
+    """
+    Format a test result as one line of text.
+    """
+    latency = " ".join(f"{name}={ms:.3f}ms" for name, ms in result["latency_ms"].items())
+    errors = f"  errors={result['errors']}" if result["errors"] else ""
+    return (f"{result['test']:<6} clients={result['clients']:<4} pipeline={result['pipeline']:<4} "
+            f"size={result['value_size']:<6} {result['ops_per_sec']:>12.0f} ops/s  {latency}{errors}")
+
+
+def result_key(result):
+    """
+    Identify the settings of a test result, to match it with earlier runs.
+    """
+    return result["test"], result["clients"], result["pipeline"], result["value_size"], result["keyspace"]
+
+
+def load_baseline(file_path):
+    """
+    Load the results of an earlier run written with --json.
+    """
+    with open(file_path) as file:
+        return {result_key(result): result for result in json.load(file)["results"]}
+
+
+async def main(args):
+    baseline = load_baseline(args.compare) if args.compare else {}
+    results = []
+    for test in args.tests:
+        for clients, depth, value_size in itertools.product(args.clients, args.pipeline, args.value_size):
+            result = await run_test(args.host, args.port, test, clients, args.requests, depth, value_size, args)
+            results.append(result)
+            line = format_result(result)
+            before = baseline.get(result_key(result))
+            if before:
+                change = (result["ops_per_sec"] / before["ops_per_sec"] - 1) * 100
+                line += f"  ({change:+.1f}% ops/s vs baseline)"
+            print(line, file=sys.stderr if args.json == "-" else sys.stdout)
+
+    if args.json:
+        report = {
+            "host": args.host,
+            "port": args.port,
+            "time": int(time.time()),
+            "python": platform.python_version(),
+            "results": results
+        }
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as file:
+                json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a running KVIS server")
+    parser.add_argument("--host", default="localhost", help="Server host")
+    parser.add_argument("--port", type=int, default=6379, help="Server port")
+    parser.add_argument("--clients", type=int, nargs="+", default=[50],
+                        help="Numbers of parallel connections to run")
+    parser.add_argument("--requests", type=int, default=100000, help="Total requests per test")
+    parser.add_argument("--pipeline", type=int, nargs="+", default=[1, 16, 128],
+                        help="Pipeline depths to run")
+    parser.add_argument("--tests", nargs="+", type=str.upper, choices=TESTS,
+                        default=["PING", "SET", "GET", "MGET", "SETPX"],
+                        help="Commands to benchmark; WAIT needs replicas")
+    parser.add_argument("--value-size", type=int, nargs="+", default=[3],
+                        help="Value sizes in bytes for SET, SETPX and WAIT")
+    parser.add_argument("--keyspace", type=int, default=0,
+                        help="Use random keys below this number instead of key:0 to key:<pipeline-1>")
+    parser.add_argument("--mget-keys", type=int, default=10, help="Number of keys per MGET")
+    parser.add_argument("--px", type=int, default=60000, help="Expiry in milliseconds for SETPX")
+    parser.add_argument("--wait-replicas", type=int, default=1, help="Number of replicas WAIT waits for")
+    parser.add_argument("--wait-timeout", type=int, default=1000, help="WAIT timeout in milliseconds")
+    parser.add_argument("--json", help="Write the results as JSON to this file (- for stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare throughput with")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,260 @@
+import asyncio
+import itertools
+import resource
+import socket
+import time
+
+from globals import clients, client_stats, tracking_table, tracking_prefixes, tracking_state
+from config import server_config
+
+# File descriptors kept free for files, listening sockets and replication.
+RESERVED_FDS = 32
+
+# How often idle clients and stuck output buffers are looked for, in seconds.
+CLIENTS_CRON_INTERVAL = 1
+
+client_ids = itertools.count(1)
+
+
+def adjust_open_files_limit():
+    """
+    Raise the open files limit so that --maxclients connections fit in it,
+    or lower maxclients to what the limit allows, like Redis at startup.
+    """
+    wanted = server_config["maxclients"] + RESERVED_FDS
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= wanted:
+        return
+    new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+    except (ValueError, OSError):
+        new_soft = soft
+    if new_soft < wanted:
+        server_config["maxclients"] = max(new_soft - RESERVED_FDS, 1)
+        print(f"Open files limit is {new_soft}, maxclients lowered to {server_config['maxclients']}")
+    else:
+        print(f"Increased maximum number of open files to {new_soft}")
+
+
+def set_keepalive(sock):
+    """
+    Turn on TCP keepalive probes for a client socket, so connections to
+    hosts that went away are eventually closed: the first probe is sent
+    after --tcp-keepalive seconds of silence.
+    """
+    interval = server_config["tcp_keepalive"]
+    if not interval or sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(interval // 3, 1))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+
+def client_class(client):
+    """
+    Return the output buffer limit class of a client: pubsub or normal.
+    """
+    return "pubsub" if client.channels or client.patterns else "normal"
+
+
+def check_output_limit(client, size, limits):
+    """
+    Enforce output buffer limits (hard, soft, soft_seconds) on the 'size'
+    bytes waiting to be sent to a client, disconnecting it if they are
+    exceeded. Returns False if it was disconnected.
+    """
+    hard, soft, soft_seconds = limits
+    if hard and size > hard:
+        reason = f"output buffer of {size} bytes over the hard limit"
+    elif soft and size > soft:
+        now = time.monotonic()
+        if client.soft_limit_since is None:
+            client.soft_limit_since = now
+            return True
+        if now - client.soft_limit_since <= soft_seconds:
+            return True
+        reason = f"output buffer over the soft limit for {soft_seconds}s"
+    else:
+        client.soft_limit_since = None
+        return True
+    print(f"Disconnecting {client_class(client)} client {client.id}: {reason}")
+    client.transport.abort()
+    return False
+
+
+def deliver(targets, data, limits):
+    """
+    Write the encoded message 'data' (an out-of-band message such as a
+    Pub/Sub message) to every client in 'targets'.
+    The same bytes object goes to all of them; a client in the middle of a
+    batch that had to wait gets it after that batch's replies.
+    """
+    for client in targets:
+        if client.waiting is not None:
+            client.out.append(data)
+            continue
+        transport = client.transport
+        if transport.is_closing():
+            continue
+        transport.write(data)
+        check_output_limit(client, transport.get_write_buffer_size(), limits)
+
+
+def check_client_output(client):
+    """
+    Enforce the output buffer limits of the client's class on the replies
+    waiting in its transport (links between workers have none).
+    Returns False if it was disconnected.
+    """
+    limits = server_config["client_output_buffer_limit"][client_class(client)]
+    if not limits[0] and not limits[1] or client.id not in clients:
+        return True
+    return check_output_limit(client, client.transport.get_write_buffer_size(), limits)
+
+
+def format_addr(address):
+    """
+    Format a socket address as host:port.
+    """
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return str(address or "")
+
+
+def client_info(client, now):
+    """
+    Describe a client as one line of CLIENT LIST.
+    qbuf is the size of its unprocessed input, oll the number of replies
+    queued by a batch still running and omem the bytes written but not
+    sent yet.
+    """
+    flags = "P" if client.channels or client.patterns else "N"
+    if client.tracking:
+        flags += "t"
+    fields = [
+        f"id={client.id}",
+        f"addr={client.addr}",
+        f"laddr={client.laddr}",
+        f"name={client.name.decode(errors='replace')}",
+        f"age={int(now - client.created)}",
+        f"idle={int(now - client.last_interaction)}",
+        f"flags={flags}",
+        f"sub={len(client.channels)}",
+        f"psub={len(client.patterns)}",
+        f"qbuf={len(client.buffer)}",
+        f"oll={len(client.out)}",
+        f"omem={client.transport.get_write_buffer_size()}",
+        f"tot-cmds={client.commands}",
+        f"cmd={client.last_command.decode(errors='replace').lower()}"
+    ]
+    return " ".join(fields)
+
+
+def list_clients():
+    """
+    Build the reply text of CLIENT LIST.
+    """
+    now = time.monotonic()
+    return "".join(client_info(client, now) + "\n" for client in clients.values())
+
+
+def parse_kill_filters(args):
+    """
+    Parse the <filter> <value> pairs of CLIENT KILL (ID, ADDR, LADDR, TYPE
+    and SKIPME) into a dict. Raises ValueError for anything else.
+    """
+    if len(args) % 2:
+        raise ValueError("syntax error")
+    filters = {"skipme": True}
+    for name, value in zip(args[::2], args[1::2]):
+        name = name.lower().decode(errors="replace")
+        if name == "id":
+            if not value.isdigit() or int(value) == 0:
+                raise ValueError("client-id should be greater than 0")
+            filters["id"] = int(value)
+        elif name in ("addr", "laddr"):
+            filters[name] = value.decode(errors="replace")
+        elif name == "type":
+            filters["type"] = value.lower().decode(errors="replace")
+            if filters["type"] not in ("normal", "pubsub"):
+                raise ValueError(f"Unknown client type '{filters['type']}'")
+        elif name == "skipme":
+            if value.lower() not in (b"yes", b"no"):
+                raise ValueError("syntax error")
+            filters["skipme"] = value.lower() == b"yes"
+        else:
+            raise ValueError("syntax error")
+    return filters
+
+
+def kill_clients(current, filters):
+    """
+    Close the connections matching every filter of CLIENT KILL.
+    The current client, if it is not skipped, is closed once its replies
+    are written. Returns the number of clients killed.
+    """
+    killed = 0
+    for client in list(clients.values()):
+        if client is current and filters["skipme"] or \
+                "id" in filters and client.id != filters["id"] or \
+                "addr" in filters and client.addr != filters["addr"] or \
+                "laddr" in filters and client.laddr != filters["laddr"] or \
+                "type" in filters and client_class(client) != filters["type"]:
+            continue
+        if client is current:
+            asyncio.get_running_loop().call_soon(client.transport.close)
+        else:
+            client.transport.abort()
+        killed += 1
+    return killed
+
+
+def clients_cron():
+    """
+    Close clients idle for longer than --timeout, and apply the soft output
+    buffer limits to clients that are not being sent anything new.
+    Subscribers and clients waiting on a command are never timed out.
+    """
+    now = time.monotonic()
+    timeout = server_config["timeout"]
+    for client in list(clients.values()):
+        if client.transport.is_closing():
+            continue
+        if timeout and now - client.last_interaction > timeout and client.waiting is None and \
+                not client.channels and not client.patterns:
+            print(f"Closing client {client.id}: idle for over {timeout}s")
+            client.transport.close()
+        elif client.soft_limit_since is not None:
+            check_client_output(client)
+
+
+async def clients_cron_loop():
+    """
+    Background task running clients_cron() every CLIENTS_CRON_INTERVAL.
+    """
+    while True:
+        await asyncio.sleep(CLIENTS_CRON_INTERVAL)
+        try:
+            clients_cron()
+        except Exception as e:
+            print(f"Error in clients cron: {e}")
+
+
+def clients_info():
+    """
+    Build the text of INFO clients.
+    """
+    lines = [
+        "# Clients",
+        f"connected_clients:{len(clients)}",
+        f"maxclients:{server_config['maxclients']}",
+        f"pubsub_clients:{sum(1 for client in clients.values() if client.channels or client.patterns)}",
+        f"rejected_connections:{client_stats['rejected_connections']}",
+        f"tracking_clients:{tracking_state['clients']}",
+        f"tracking_total_keys:{len(tracking_table)}",
+        f"tracking_total_prefixes:{len(tracking_prefixes)}",
+    ]
+    return "\r\n".join(lines) + "\r\n"
@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import time
+
+from globals import command_stats, slowlog
+from config import server_config
+
+# Registry of commands. Upper-case command name (bytes) -> entry dict with the
+# handler, its arity, its flags and its statistics.
+COMMANDS = {}
+
+# Latencies below this many microseconds get a bucket each; above it every
+# power of two is split into LATENCY_SUB_BUCKETS buckets (about 12% precision).
+LATENCY_SUB_BUCKETS = 8
+LATENCY_LINEAR_LIMIT = 2 * LATENCY_SUB_BUCKETS
+
+# Histograms cover latencies up to 2**40 microseconds (about 12 days).
+LATENCY_BUCKETS = 40 * LATENCY_SUB_BUCKETS
+
+# Percentiles reported by INFO latencystats.
+LATENCY_PERCENTILES = (50, 99, 99.9)
+
+# Limits on what a SLOWLOG entry keeps of a command.
+SLOWLOG_MAX_ARGS = 32
+SLOWLOG_MAX_ARG_LEN = 128
+
+slowlog_ids = itertools.count()
+
+
+class CommandError(Exception):
+    """
+    Raised by a command handler to reply with an error, e.g.
+    CommandError("ERR syntax error"). The command is not replicated.
+    """
+
+
+def new_command_stats():
+    """
+    Create the counters kept for a command.
+    """
+    return {
+        "calls": 0,
+        "usec": 0,
+        "rejected_calls": 0,
+        "failed_calls": 0,
+        "histogram": [0] * LATENCY_BUCKETS
+    }
+
+
+def command(name, arity, *flags, first_key=0, last_key=0, key_step=1, merge=None):
+    """
+    Register the decorated function as the handler of command 'name'.
+    A positive 'arity' is the exact number of arguments including the name,
+    a negative one the minimum. The keys are the arguments from 'first_key'
+    to 'last_key' (negative counts from the end), every 'key_step'; in
+    sharded mode they decide which worker runs the command, and 'merge'
+    tells how the replies are combined when they span several shards (see
+    shard.merge_replies). Flags:
+      write      modifies the dataset, applied by replicas from the stream
+      readonly   only reads the dataset
+      replicate  sent to replicas as is once it succeeded
+      denyoom    may use more memory, so it is refused when maxmemory is
+                 reached and nothing can be evicted
+      blocking   may wait for other clients, so it is kept out of SLOWLOG
+      allshards  run by every shard in sharded mode
+      pubsub     allowed while the client is subscribed to channels
+    Handlers take (client, result, out), where 'client' is the connection
+    (a server.ClientConnection, or None when replaying the AOF or the
+    replication stream). They may be coroutines, returning False if the
+    connection should no longer be read as a client.
+    """
+    def register(handler):
+        COMMANDS[name.upper().encode()] = {
+            "name": name.lower(),
+            "handler": handler,
+            "is_async": asyncio.iscoroutinefunction(handler),
+            "arity": arity,
+            "flags": frozenset(flags),
+            "replicate": "replicate" in flags,
+            "denyoom": "denyoom" in flags,
+            "first_key": first_key,
+            "last_key": last_key,
+            "key_step": key_step,
+            "merge": merge,
+            "sharded": first_key > 0 or "allshards" in flags,
+            "stats": command_stats.setdefault(name.lower(), new_command_stats())
+        }
+        return handler
+    return register
+
+
+def latency_bucket(usec):
+    """
+    Map a latency in microseconds to its histogram bucket.
+    """
+    if usec < LATENCY_LINEAR_LIMIT:
+        return usec
+    shift = usec.bit_length() - 4
+    bucket = (shift + 1) * LATENCY_SUB_BUCKETS + (usec >> shift) - LATENCY_SUB_BUCKETS
+    return min(bucket, LATENCY_BUCKETS - 1)
+
+
+def bucket_upper_bound(bucket):
+    """
+    Return the highest latency (microseconds) that falls in 'bucket'.
+    """
+    if bucket < LATENCY_LINEAR_LIMIT:
+        return bucket
+    shift = bucket // LATENCY_SUB_BUCKETS - 1
+    mantissa = bucket - shift * LATENCY_SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+
+def record_call(entry, result, usec):
+    """
+    Account for one successful call of 'entry' that took 'usec' microseconds.
+    """
+    stats = entry["stats"]
+    stats["calls"] += 1
+    stats["usec"] += usec
+    stats["histogram"][usec if usec < LATENCY_LINEAR_LIMIT else latency_bucket(usec)] += 1
+
+    if usec >= server_config["slowlog_log_slower_than"] >= 0 and "blocking" not in entry["flags"]:
+        log_slow_command(result, usec)
+
+
+def log_slow_command(result, usec):
+    """
+    Add a command to the slow log, dropping the oldest entry when it is full.
+    """
+    args = result[:SLOWLOG_MAX_ARGS]
+    if len(result) > SLOWLOG_MAX_ARGS:
+        args[-1] = b"... (%d more arguments)" % (len(result) - SLOWLOG_MAX_ARGS + 1)
+    args = [arg if len(arg) <= SLOWLOG_MAX_ARG_LEN else
+            arg[:SLOWLOG_MAX_ARG_LEN] + b"... (%d more bytes)" % (len(arg) - SLOWLOG_MAX_ARG_LEN)
+            for arg in args]
+    slowlog.appendleft((next(slowlog_ids), int(time.time()), usec, args))
+    while len(slowlog) > server_config["slowlog_max_len"]:
+        slowlog.pop()
+
+
+def encode_slowlog(count):
+    """
+    Encode the 'count' most recent SLOWLOG entries as a RESP array of
+    [id, timestamp, microseconds, [args...]] entries.
+    """
+    entries = list(slowlog)[:count]
+    parts = [b"*%d\r\n" % len(entries)]
+    for entry_id, timestamp, usec, args in entries:
+        parts.append(b"*4\r\n:%d\r\n:%d\r\n:%d\r\n*%d\r\n" % (entry_id, timestamp, usec, len(args)))
+        parts += [b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args]
+    return b"".join(parts)
+
+
+def reset_command_stats():
+    """
+    Clear the call counters and latency histograms of every command.
+    """
+    for stats in command_stats.values():
+        stats.update(new_command_stats())
+
+
+def percentile(histogram, calls, pct):
+    """
+    Return the latency below which 'pct' percent of the calls completed.
+    """
+    target = calls * pct / 100
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return bucket_upper_bound(bucket)
+    return 0
+
+
+def commandstats_info():
+    """
+    Build the text of INFO commandstats.
+    """
+    lines = ["# Commandstats"]
+    for name, stats in sorted(command_stats.items()):
+        if stats["calls"] or stats["rejected_calls"] or stats["failed_calls"]:
+            per_call = stats["usec"] / stats["calls"] if stats["calls"] else 0
+            lines.append(f"cmdstat_{name}:calls={stats['calls']},usec={stats['usec']},"
+                         f"usec_per_call={per_call:.2f},rejected_calls={stats['rejected_calls']},"
+                         f"failed_calls={stats['failed_calls']}")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def latencystats_info():
+    """
+    Build the text of INFO latencystats, with p50/p99/p99.9 per command.
+    """
+    lines = ["# Latencystats"]
+    for name, stats in sorted(command_stats.items()):
+        if stats["calls"]:
+            values = ",".join(f"p{pct:g}={percentile(stats['histogram'], stats['calls'], pct):.3f}"
+                              for pct in LATENCY_PERCENTILES)
+            lines.append(f"latency_percentiles_usec_{name}:{values}")
+    return "\r\n".join(lines) + "\r\n"
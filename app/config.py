@@ -4,9 +4,100 @@ server_config = {
     "dir": None,
     "dbfilename": None,
     "port": None,
-    "replicaof": None
+    "replicaof": None,
+    # Snapshot rules as "<seconds> <changes> ..." pairs, e.g. "900 1 300 10".
+    "save": None,
+    # Size in bytes of the replication backlog used for partial resyncs.
+    "repl_backlog_size": 1024 * 1024,
+    # Output buffer limits per client class as (hard, soft, soft_seconds) in bytes
+    # and seconds. A client is disconnected once its pending output exceeds the
+    # hard limit, or stays above the soft limit for soft_seconds. 0 disables a limit.
+    "client_output_buffer_limit": {
+        "normal": (0, 0, 0),
+        "replica": (256 * 1024 * 1024, 64 * 1024 * 1024, 60),
+        "pubsub": (32 * 1024 * 1024, 8 * 1024 * 1024, 60)
+    },
+    # Commands taking at least this many microseconds go to the SLOWLOG
+    # (0 logs every command, a negative value disables it).
+    "slowlog_log_slower_than": 10000,
+    # Number of entries kept in the SLOWLOG.
+    "slowlog_max_len": 128,
+    # Memory limit in bytes for the dataset (0 means no limit), the policy used
+    # to make room when it is reached, and how many keys each eviction samples.
+    "maxmemory": 0,
+    "maxmemory_policy": "noeviction",
+    "maxmemory_samples": 5,
+    # Append-only file: whether it is on, its name in 'dir', and when it is
+    # fsynced ("always" before replying, "everysec" or "no" to leave it to the OS).
+    "appendonly": False,
+    "appendfilename": "appendonly.aof",
+    "appendfsync": "everysec",
+    # Maximum number of connected clients; connections beyond it are refused.
+    "maxclients": 10000,
+    # Seconds after which an idle client is disconnected (0 never does), and
+    # interval of TCP keepalive probes on client connections (0 turns them off).
+    "timeout": 0,
+    "tcp_keepalive": 300,
+    # Maximum number of keys remembered for CLIENT TRACKING; the oldest are
+    # invalidated to make room.
+    "tracking_table_max_keys": 1000000,
+    # Lazy freeing: whether large values deleted by eviction, by expiry, by DEL
+    # and by FLUSHALL/FLUSHDB without ASYNC or SYNC are freed in the background.
+    # UNLINK and FLUSHALL ASYNC always are.
+    "lazyfree_lazy_eviction": False,
+    "lazyfree_lazy_expire": False,
+    "lazyfree_lazy_user_del": False,
+    "lazyfree_lazy_user_flush": False,
+    # Number of worker processes, each owning one shard of the keyspace.
+    "workers": 1,
+    # Event loop implementation: "asyncio" or "uvloop" (optional dependency).
+    "event_loop": "asyncio"
 }
 
+# Multipliers for the units accepted by parse_memory.
+MEMORY_UNITS = {
+    "": 1,
+    "b": 1,
+    "k": 1000,
+    "kb": 1024,
+    "m": 1000 ** 2,
+    "mb": 1024 ** 2,
+    "g": 1000 ** 3,
+    "gb": 1024 ** 3
+}
+
+
+def parse_memory(value):
+    """
+    Parse a memory size such as "1024", "64mb" or "1gb" into bytes.
+    Raises ValueError for anything else.
+    """
+    value = value.strip().lower()
+    number = value.rstrip("kmgb")
+    unit = value[len(number):]
+    if not number.isdigit() or unit not in MEMORY_UNITS:
+        raise ValueError(f"invalid memory size: {value!r}")
+    return int(number) * MEMORY_UNITS[unit]
+
+
+def parse_output_buffer_limit(value):
+    """
+    Parse "<class> <hard> <soft> <soft_seconds>" and store the limits in
+    server_config["client_output_buffer_limit"].
+    Raises ValueError for a malformed value or an unknown class.
+    """
+    parts = value.split()
+    if len(parts) != 4:
+        raise ValueError("expected <class> <hard> <soft> <soft_seconds>")
+    client_class = parts[0].lower()
+    if client_class == "slave":
+        client_class = "replica"
+    limits = server_config["client_output_buffer_limit"]
+    if client_class not in limits:
+        raise ValueError(f"unknown client class: {parts[0]!r}")
+    limits[client_class] = (parse_memory(parts[1]), parse_memory(parts[2]), int(parts[3]))
+
+
 def is_file_in_dir(directory, filename):
     """
     Check if file exists in the given directory.
@@ -15,4 +106,17 @@ def is_file_in_dir(directory, filename):
         file_path = os.path.join(directory, filename)
         return os.path.isfile(file_path)
     except:
-        return False
\ No newline at end of file
+        return False
+
+
+def check_workers(workers, replicaof):
+    """
+    Check --workers against the rest of the configuration. Replication
+    works on a single keyspace, so a sharded server can neither be a
+    replica nor sync one (PSYNC is refused).
+    Raises ValueError for an unsupported combination.
+    """
+    if workers < 1:
+        raise ValueError("--workers must be at least 1")
+    if workers > 1 and replicaof:
+        raise ValueError("--replicaof is not supported with --workers: replication needs a single keyspace")
@@ -0,0 +1,26 @@
+# CRC-64/Jones (reflected, polynomial 0xad93d23594c935a9), as used in RDB files.
+POLY = 0x95AC9329AC4BC9B5  # Bit-reversed form of the Jones polynomial
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+TABLE = _make_table()
+
+
+def crc64(data, crc=0):
+    """
+    Update the CRC-64 'crc' with 'data' and return the new value.
+    Feed a stream through in chunks by passing the previous result back in.
+    """
+    table = TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
@@ -0,0 +1,267 @@
+import itertools
+from collections import deque
+
+# A collection keeps the compact "listpack" encoding while it has at most
+# COMPACT_MAX_ITEMS entries (field/value pairs for a hash) and no string
+# longer than COMPACT_MAX_VALUE bytes, like Redis' *-max-listpack-* settings.
+COMPACT_MAX_ITEMS = 128
+COMPACT_MAX_VALUE = 64
+
+# Approximate bytes used per stored string besides its payload: the bytes
+# object's header and its slot in a list or deque, or its entry in a dict
+# or set. COLLECTION_OVERHEAD is the cost of an empty collection.
+COMPACT_ITEM_OVERHEAD = 41
+TABLE_ITEM_OVERHEAD = 72
+COLLECTION_OVERHEAD = 100
+
+# Encoding of each type once it outgrows the compact one.
+LARGE_ENCODINGS = {
+    "hash": "hashtable",
+    "list": "quicklist",
+    "set": "hashtable"
+}
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+
+class Collection:
+    """
+    A hash, list or set value in the keyspace (strings are stored as RESP
+    bulk replies instead, see parsers.encode_bulk).
+    A small collection keeps its strings in one flat Python list ("listpack"
+    encoding, [field, value, ...] for a hash): far less memory than a dict
+    or set, and just as fast to scan at that size. Past the thresholds it is
+    converted for good to a dict ("hashtable"), deque ("quicklist") or set
+    ("hashtable") in 'items'. 'size' is its estimated memory use.
+    """
+    __slots__ = ("type", "encoding", "items", "size")
+
+    def __init__(self, kind):
+        self.type = kind
+        self.encoding = "listpack"
+        self.items = []
+        self.size = COLLECTION_OVERHEAD
+
+
+def item_overhead(value):
+    """
+    Return the bytes used per stored string by the encoding of 'value'.
+    """
+    return TABLE_ITEM_OVERHEAD if value.encoding == "hashtable" else COMPACT_ITEM_OVERHEAD
+
+
+def collection_size(value):
+    """
+    Compute the estimated memory use of a collection from scratch.
+    """
+    items = value.items
+    strings = itertools.chain.from_iterable(items.items()) if isinstance(items, dict) else items
+    total = count = 0
+    for item in strings:
+        total += len(item)
+        count += 1
+    return COLLECTION_OVERHEAD + total + count * item_overhead(value)
+
+
+def convert_collection(value):
+    """
+    Switch a collection from the compact encoding to its large one.
+    """
+    items = value.items
+    if value.type == "hash":
+        value.items = dict(zip(items[::2], items[1::2]))
+    elif value.type == "list":
+        value.items = deque(items)
+    else:
+        value.items = set(items)
+    value.encoding = LARGE_ENCODINGS[value.type]
+    value.size = collection_size(value)
+
+
+def collection_from_items(kind, items):
+    """
+    Build a collection from a list of strings (alternating fields and
+    values for a hash), e.g. as read from an RDB file, choosing its
+    encoding from its size.
+    """
+    value = Collection(kind)
+    value.items = items
+    entries = len(items) // 2 if kind == "hash" else len(items)
+    if entries > COMPACT_MAX_ITEMS or any(len(item) > COMPACT_MAX_VALUE for item in items):
+        convert_collection(value)
+    else:
+        value.size = collection_size(value)
+    return value
+
+
+def copy_collection(value):
+    """
+    Return an independent copy of a collection.
+    """
+    copy = Collection(value.type)
+    copy.encoding = value.encoding
+    copy.items = value.items.copy()
+    copy.size = value.size
+    return copy
+
+
+def collection_items(value):
+    """
+    Return the strings of a collection as a list, alternating fields and
+    values for a hash.
+    """
+    items = value.items
+    if isinstance(items, dict):
+        return list(itertools.chain.from_iterable(items.items()))
+    return list(items)
+
+
+def hash_get(value, field):
+    """
+    Return the value of 'field' in a hash, or None.
+    """
+    items = value.items
+    if value.encoding == "listpack":
+        try:
+            return items[items[::2].index(field) * 2 + 1]
+        except ValueError:
+            return None
+    return items.get(field)
+
+
+def hash_set(value, field, field_value):
+    """
+    Set 'field' in a hash. Returns True if the field is new.
+    """
+    if value.encoding == "listpack":
+        if len(field) > COMPACT_MAX_VALUE or len(field_value) > COMPACT_MAX_VALUE:
+            convert_collection(value)
+        else:
+            items = value.items
+            try:
+                i = items[::2].index(field) * 2 + 1
+            except ValueError:
+                if len(items) < COMPACT_MAX_ITEMS * 2:
+                    items += (field, field_value)
+                    value.size += len(field) + len(field_value) + 2 * COMPACT_ITEM_OVERHEAD
+                    return True
+                convert_collection(value)
+            else:
+                value.size += len(field_value) - len(items[i])
+                items[i] = field_value
+                return False
+
+    table = value.items
+    old = table.get(field)
+    table[field] = field_value
+    if old is None:
+        value.size += len(field) + len(field_value) + 2 * TABLE_ITEM_OVERHEAD
+        return True
+    value.size += len(field_value) - len(old)
+    return False
+
+
+def hash_delete(value, field):
+    """
+    Remove 'field' from a hash. Returns True if it existed.
+    """
+    items = value.items
+    if value.encoding == "listpack":
+        try:
+            i = items[::2].index(field) * 2
+        except ValueError:
+            return False
+        old = items[i + 1]
+        del items[i:i + 2]
+    else:
+        old = items.pop(field, None)
+        if old is None:
+            return False
+    value.size -= len(field) + len(old) + 2 * item_overhead(value)
+    return True
+
+
+def list_push(value, elements, left):
+    """
+    Add 'elements' one by one to the head (left) or tail of a list.
+    Returns the new length of the list.
+    """
+    if value.encoding == "listpack" and (len(value.items) + len(elements) > COMPACT_MAX_ITEMS or
+                                         any(len(element) > COMPACT_MAX_VALUE for element in elements)):
+        convert_collection(value)
+    items = value.items
+    if not left:
+        items.extend(elements)
+    elif value.encoding == "listpack":
+        items[:0] = elements[::-1]
+    else:
+        items.extendleft(elements)
+    value.size += sum(map(len, elements)) + len(elements) * COMPACT_ITEM_OVERHEAD
+    return len(items)
+
+
+def list_pop(value, left):
+    """
+    Remove and return the first (left) or last element of a non-empty list.
+    """
+    items = value.items
+    if not left:
+        element = items.pop()
+    elif value.encoding == "listpack":
+        element = items.pop(0)
+    else:
+        element = items.popleft()
+    value.size -= len(element) + COMPACT_ITEM_OVERHEAD
+    return element
+
+
+def list_range(value, start, stop):
+    """
+    Return the elements of a list from index 'start' to 'stop', both
+    included; negative indexes count from the end, as in LRANGE.
+    """
+    items = value.items
+    length = len(items)
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop += length
+    stop = min(stop, length - 1)
+    if start > stop:
+        return []
+    if value.encoding == "listpack":
+        return items[start:stop + 1]
+    # A deque is walked from the nearest end
+    if start > length // 2:
+        return list(itertools.islice(reversed(items), length - 1 - stop, length - start))[::-1]
+    return list(itertools.islice(items, start, stop + 1))
+
+
+def set_add(value, member):
+    """
+    Add 'member' to a set. Returns True if it was not there yet.
+    """
+    items = value.items
+    if member in items:
+        return False
+    if value.encoding == "listpack":
+        if len(items) < COMPACT_MAX_ITEMS and len(member) <= COMPACT_MAX_VALUE:
+            items.append(member)
+            value.size += len(member) + COMPACT_ITEM_OVERHEAD
+            return True
+        convert_collection(value)
+        items = value.items
+    items.add(member)
+    value.size += len(member) + TABLE_ITEM_OVERHEAD
+    return True
+
+
+def set_remove(value, member):
+    """
+    Remove 'member' from a set. Returns True if it was there.
+    """
+    if member not in value.items:
+        return False
+    value.items.remove(member)
+    value.size -= len(member) + item_overhead(value)
+    return True
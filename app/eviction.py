@@ -0,0 +1,190 @@
+import random
+import time
+from operator import itemgetter
+
+from parsers import encode_command
+from replication import propagate
+from keyspace import remove_key
+from globals import db, memory_state, rdb_state, lazyfree_state
+from config import server_config
+
+MAXMEMORY_POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "volatile-lru", "volatile-ttl")
+
+# Access metadata is 24 bits wide. The LRU clock ticks every
+# LRU_CLOCK_RESOLUTION seconds, so it wraps after about 19 days.
+LRU_CLOCK_MAX = (1 << 24) - 1
+LRU_CLOCK_RESOLUTION = 0.1
+
+# LFU counters are logarithmic: the higher the counter, the less likely an
+# access increments it. New keys start at LFU_INIT_VAL so they are not evicted
+# right away, and counters drop by one every LFU_DECAY_TIME minutes unused.
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1
+
+# Best eviction candidates remembered between samples.
+EVICTION_POOL_SIZE = 16
+
+# Candidate keys are sampled at random positions of the SCAN slots, or of the
+# expiry heap for volatile policies: both index every key without a copy.
+# Picks landing on a free slot or a stale heap entry are dropped.
+# The pool holds (key, score) pairs for 'policy', best candidate first.
+sample_state = {
+    "policy": None,
+    "pool": []
+}
+
+
+def init_eviction():
+    """
+    Enable the access metadata needed by the configured maxmemory policy.
+    """
+    policy = server_config["maxmemory_policy"]
+    if server_config["maxmemory"] and policy.endswith("lru"):
+        memory_state["track_access"] = "lru"
+    elif server_config["maxmemory"] and policy.endswith("lfu"):
+        memory_state["track_access"] = "lfu"
+    else:
+        memory_state["track_access"] = None
+
+
+def lru_clock():
+    """
+    Return the current LRU clock.
+    """
+    return int(time.monotonic() / LRU_CLOCK_RESOLUTION) & LRU_CLOCK_MAX
+
+
+def lfu_minutes():
+    """
+    Return the current time in minutes, as kept in LFU metadata.
+    """
+    return int(time.monotonic() / 60) & 0xFFFF
+
+
+def lfu_decayed_counter(meta, now):
+    """
+    Return the counter stored in 'meta', decayed for the minutes since it
+    was last touched.
+    """
+    counter = meta & 0xFF
+    elapsed = (now - (meta >> 8)) & 0xFFFF
+    return max(counter - elapsed // LFU_DECAY_TIME, 0)
+
+
+def touch_key(key):
+    """
+    Record an access to 'key' for the LRU or LFU policy.
+    """
+    if memory_state["track_access"] == "lru":
+        db["key_meta"][key] = lru_clock()
+        return
+
+    now = lfu_minutes()
+    meta = db["key_meta"].get(key)
+    counter = LFU_INIT_VAL if meta is None else lfu_decayed_counter(meta, now)
+    if counter < 255 and random.random() < 1 / (max(counter - LFU_INIT_VAL, 0) * LFU_LOG_FACTOR + 1):
+        counter += 1
+    db["key_meta"][key] = (now << 8) | counter
+
+
+def eviction_score(key, policy, now):
+    """
+    Rank a candidate key; the higher the score, the better it is to evict.
+    """
+    if policy == "volatile-ttl":
+        return -db["expires"][key]
+    if policy == "allkeys-lfu":
+        meta = db["key_meta"].get(key)
+        return 255 - (LFU_INIT_VAL if meta is None else lfu_decayed_counter(meta, now))
+    # Idle time; keys never touched (e.g. loaded from disk) count as idle
+    return (now - db["key_meta"].get(key, now + 1)) & LRU_CLOCK_MAX
+
+
+def sample_keys(volatile, count):
+    """
+    Pick up to 'count' random keys, only among keys with an expiry time if
+    'volatile'. The same key may come up more than once.
+    """
+    if volatile:
+        entries, expires = db["expiry_heap"], db["expires"]
+        if not entries:
+            return []
+        return [key for timestamp, key in random.choices(entries, k=count) if expires.get(key) == timestamp]
+    slots = db["scan_slots"]
+    if not slots:
+        return []
+    return [key for key in random.choices(slots, k=count) if key is not None]
+
+
+def pick_victim(policy):
+    """
+    Choose the key to evict under 'policy', or None if there is none.
+    Sampled keys are merged into a small pool of the best candidates seen,
+    so each eviction benefits from earlier samples as well.
+    """
+    volatile = policy.startswith("volatile")
+    source = db["expires"] if volatile else db["dict"]
+    now = lfu_minutes() if policy == "allkeys-lfu" else lru_clock()
+    if sample_state["policy"] != policy:
+        sample_state["policy"] = policy
+        sample_state["pool"] = []
+
+    for _ in range(3):
+        pool = dict(sample_state["pool"])
+        for key in sample_keys(volatile, server_config["maxmemory_samples"]):
+            pool[key] = eviction_score(key, policy, now)
+        # Sorting on the score alone leaves ties in sampling order
+        pool = sorted(pool.items(), key=itemgetter(1), reverse=True)[:EVICTION_POOL_SIZE]
+        for i, (key, _) in enumerate(pool):
+            if key in source:
+                sample_state["pool"] = pool[i + 1:]
+                return key
+        sample_state["pool"] = []
+        if not source:
+            return None
+    # The samples kept missing, e.g. most slots were freed by a mass delete
+    return next(iter(source), None)
+
+
+def free_memory():
+    """
+    Evict keys until memory use is within maxmemory.
+    Evicted keys are sent to replicas and the AOF as one DEL. Replicas never evict by
+    themselves, they follow the master's DELs.
+    Returns False if memory is still over the limit, e.g. with noeviction.
+    """
+    maxmemory = server_config["maxmemory"]
+    if not maxmemory or memory_state["used"] <= maxmemory or server_config["replicaof"]:
+        return True
+
+    policy = server_config["maxmemory_policy"]
+    evicted = []
+    while memory_state["used"] > maxmemory and policy != "noeviction":
+        key = pick_victim(policy)
+        if key is None:
+            break
+        remove_key(key, lazy=server_config["lazyfree_lazy_eviction"])
+        evicted.append(key)
+
+    if evicted:
+        memory_state["evicted_keys"] += len(evicted)
+        rdb_state["changes"] += len(evicted)
+        propagate(encode_command([b"DEL", *evicted]))
+    return memory_state["used"] <= maxmemory
+
+
+def memory_info():
+    """
+    Build the text of INFO memory.
+    """
+    lines = [
+        "# Memory",
+        f"used_memory:{memory_state['used']}",
+        f"maxmemory:{server_config['maxmemory']}",
+        f"maxmemory_policy:{server_config['maxmemory_policy']}",
+        f"evicted_keys:{memory_state['evicted_keys']}",
+        f"lazyfree_pending_objects:{lazyfree_state['pending']}",
+        f"lazyfreed_objects:{lazyfree_state['freed']}",
+    ]
+    return "\r\n".join(lines) + "\r\n"
@@ -0,0 +1,117 @@
+import asyncio
+import heapq
+import time
+
+from parsers import encode_command
+from replication import propagate
+from keyspace import remove_key
+from globals import db, rdb_state
+from config import server_config
+
+# How often the active expiry cycle runs, in seconds.
+ACTIVE_EXPIRE_INTERVAL = 0.1
+
+# Maximum time a single expiry cycle may spend reclaiming keys, in seconds.
+ACTIVE_EXPIRE_BUDGET = 0.005
+
+# Number of heap entries handled between two checks of the time budget.
+ACTIVE_EXPIRE_BATCH = 64
+
+
+def propagate_expired(keys):
+    """
+    Tell replicas and the AOF about expired keys with an explicit DEL.
+    """
+    if keys:
+        propagate(encode_command([b"DEL", *keys]))
+
+
+def expire_if_needed(key):
+    """
+    Check whether 'key' is past its expiry time.
+    On a master the key is deleted and the deletion sent to replicas. A
+    replica only reports the key as expired and waits for the master's DEL.
+    Returns True if the key is expired.
+    """
+    timestamp = db["expires"].get(key)
+    if timestamp is None or timestamp > time.time():
+        return False
+
+    reclaim_expired([key])
+    return True
+
+
+def reclaim_expired(keys):
+    """
+    Delete keys a lookup found expired, and send one DEL for all of them to
+    replicas. Does nothing on a replica, which waits for the master's DEL.
+    """
+    if server_config["replicaof"]:
+        return
+    keys = [key for key in dict.fromkeys(keys) if key in db["expires"]]
+    lazy = server_config["lazyfree_lazy_expire"]
+    for key in keys:
+        remove_key(key, lazy)
+    rdb_state["changes"] += len(keys)
+    propagate_expired(keys)
+
+
+def pop_expired(now, deadline):
+    """
+    Remove keys whose expiry time is before 'now', earliest first, until
+    none are left or time.perf_counter() passes 'deadline'.
+    Returns (expired_keys, finished) where 'finished' is False if the time
+    budget ran out before every expired key was reclaimed.
+    """
+    expired = []
+    lazy = server_config["lazyfree_lazy_expire"]
+    while db["expiry_heap"] and db["expiry_heap"][0][0] <= now:
+        for _ in range(ACTIVE_EXPIRE_BATCH):
+            if not db["expiry_heap"] or db["expiry_heap"][0][0] > now:
+                break
+            timestamp, key = heapq.heappop(db["expiry_heap"])
+            # Skip entries left behind by a key that was deleted or re-set
+            if db["expires"].get(key) != timestamp:
+                continue
+            remove_key(key, lazy)
+            expired.append(key)
+        if time.perf_counter() >= deadline:
+            return expired, not db["expiry_heap"] or db["expiry_heap"][0][0] > now
+    return expired, True
+
+
+def compact_expiry_heap():
+    """
+    Rebuild the heap from db["expires"] once stale entries dominate it.
+    """
+    if len(db["expiry_heap"]) > 2 * len(db["expires"]) + 1024:
+        db["expiry_heap"][:] = [(timestamp, key) for key, timestamp in db["expires"].items()]
+        heapq.heapify(db["expiry_heap"])
+
+
+async def active_expire_cycle():
+    """
+    Run one bounded expiry cycle.
+    Returns True if every expired key was reclaimed within the time budget.
+    """
+    deadline = time.perf_counter() + ACTIVE_EXPIRE_BUDGET
+    expired, finished = pop_expired(time.time(), deadline)
+    rdb_state["changes"] += len(expired)
+    propagate_expired(expired)
+    compact_expiry_heap()
+    return finished
+
+
+async def active_expire_loop():
+    """
+    Background task reclaiming expired keys on a master.
+    When a cycle runs out of budget the next one starts as soon as pending
+    client work has had a turn, instead of waiting for the next interval.
+    """
+    while True:
+        try:
+            finished = await active_expire_cycle()
+        except Exception as e:
+            print(f"Error in active expiry cycle: {e}")
+            finished = True
+        await asyncio.sleep(ACTIVE_EXPIRE_INTERVAL if finished else 0)
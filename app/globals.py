@@ -1,14 +1,159 @@
+import secrets
+import time
+from collections import deque
+
 # Arbitrary metadata
 meta_data = {}
 
-# The main in-memory key-value store.
-global_hashmap = {}
+# The keyspace, behind one holder so FLUSHALL can swap in empty containers in
+# O(1) and leave the old ones to lazyfree.
+#  'dict': the main in-memory key-value store. bytes key -> value as a RESP bulk
+#          string (see parsers.encode_bulk), so GET can write it out as is.
+#  'expires': the expiry map. bytes key -> float(timestamp in seconds).
+#  'scan_slots', 'scan_positions', 'scan_free_slots': stable positions of the
+#          keys for SCAN: the key in each slot (None for a free slot), the slot
+#          of each key, and the free slots, reused by new keys. Keys never move,
+#          so a SCAN cursor (a slot index) stays valid whatever happens between.
+#  'expiry_heap': min-heap of (timestamp, key) pairs ordered by expiry time, used
+#          by the active expiry cycle. Entries whose timestamp no longer matches
+#          'expires' are stale.
+#  'key_meta': access metadata for eviction, as one 24-bit int per key: an LRU
+#          clock, or an LFU counter in the low 8 bits with the minute it was last
+#          decayed above them.
+db = {
+    "dict": {},
+    "expires": {},
+    "scan_slots": [],
+    "scan_positions": {},
+    "scan_free_slots": [],
+    "expiry_heap": [],
+    "key_meta": {}
+}
+
+# Snapshot bookkeeping: writes since the last successful save, when that save
+# finished, and the pid of a running background save (None if there is none).
+rdb_state = {
+    "changes": 0,
+    "last_save": time.time(),
+    "bgsave_pid": None,
+    "last_bgsave_status": "ok"
+}
 
-# The in-memory expiry map. key -> float(timestamp in seconds).
-expiry_hashmap = {}
+# Replication stream state. 'replid' and 'master_repl_offset' identify the stream
+# and count its bytes: on a master every byte sent to replicas, on a replica every
+# byte processed from its master ('synced' is set once it holds a full copy).
+# 'backlog' is the master's ring buffer with the last 'backlog_histlen' bytes of
+# the stream, created when the first replica attaches.
+repl_state = {
+    "replid": secrets.token_hex(20),
+    "master_repl_offset": 0,
+    "backlog": None,
+    "backlog_idx": 0,
+    "backlog_histlen": 0,
+    "synced": False,
+    "link_up": False,
+    # Master offset at which the last REPLCONF GETACK was sent, and whether one
+    # is about to be sent for pending WAITs.
+    "getack_offset": -1,
+    "getack_scheduled": False
+}
 
-# A dictionary to track slaves. Keys are (reader, writer) pairs, values are integer ACK counters.
+# A dictionary to track slaves. Keys are (reader, writer) pairs, values are state
+# dicts with the last acknowledged offset and the output queued for the replica's flush task
+# (see replication.new_slave_state).
 slaves = {}
 
-# Keep track of the last count of write acknowledgments from slaves.
-slaves_write_count = 0
\ No newline at end of file
+# Replicas receiving a full resync snapshot, with the same state dicts; their
+# queued writes are sent once the snapshot is through.
+syncing_slaves = {}
+
+# Per-command statistics, keyed by lower-case command name (see
+# commands.new_command_stats): calls, total microseconds and a latency histogram.
+command_stats = {}
+
+# Slow commands as (id, unix time, microseconds, args) tuples, newest first.
+slowlog = deque()
+
+# Memory accounting: estimated bytes used by the dataset (see keyspace.entry_size),
+# keys evicted under maxmemory, and which access metadata is kept ("lru", "lfu"
+# or None when the eviction policy does not need it).
+memory_state = {
+    "used": 0,
+    "evicted_keys": 0,
+    "track_access": None
+}
+
+# Append-only file state. 'fd' is the open log (None when AOF is off) and
+# 'buffer' the commands waiting to be written to it. 'fed', 'written' and
+# 'synced' count the bytes logged so far, written to the file and known to be
+# on disk. 'rewrite_buffer' collects the writes made while BGREWRITEAOF runs
+# (None when no rewrite is running), and 'rewrite_task' finishes that rewrite.
+aof_state = {
+    "fd": None,
+    "buffer": [],
+    "write_scheduled": False,
+    "fed": 0,
+    "written": 0,
+    "synced": 0,
+    "size": 0,
+    "fsync_task": None,
+    "rewrite_buffer": None,
+    "rewrite_task": None,
+    "last_rewrite_status": "ok",
+    "last_write_status": "ok"
+}
+
+# Sharded mode (--workers): this worker's shard and the number of shards, the
+# links forwarding commands to the other workers (shard index -> shard.ShardLink)
+# and the connections serving theirs (server.ClientConnection objects).
+# The sockets and the pipe watching the parent are set up before the fork.
+shard_state = {
+    "index": 0,
+    "count": 1,
+    "links": {},
+    "peer_clients": set(),
+    "link_sockets": {},
+    "peer_sockets": [],
+    "parent_watch": None
+}
+
+# Pub/Sub subscriptions: channel -> subscribed clients and pattern -> subscribed
+# clients (dicts of server.ClientConnection -> None, in subscription order).
+# Patterns are also indexed by their literal prefix (see pubsub.pattern_prefix):
+# prefix -> {pattern: compiled match function}, with the number of prefixes of
+# each length, so a PUBLISH only tries the patterns that can match its channel.
+pubsub_channels = {}
+pubsub_patterns = {}
+pubsub_prefixes = {}
+pubsub_prefix_lengths = {}
+
+# Connected clients: client id -> server.ClientConnection (connections handed
+# over to replication leave it), and connections refused because of maxclients.
+clients = {}
+client_stats = {
+    "rejected_connections": 0
+}
+
+# Lazy freeing (see lazyfree): containers waiting to be emptied in the
+# background, how many are pending and freed so far, and whether a step is
+# scheduled on the event loop.
+lazyfree_state = {
+    "queue": deque(),
+    "pending": 0,
+    "freed": 0,
+    "scheduled": False
+}
+
+# Client-side caching (see tracking): key -> id of the client that read it, or a
+# set of ids once several did; BCAST prefix -> ids of the clients registered for
+# it, with the number of prefixes of each length; and the number of tracking
+# clients with the invalidations queued for each (client id -> {key: None},
+# or None once every key was flushed).
+tracking_table = {}
+tracking_prefixes = {}
+tracking_prefix_lengths = {}
+tracking_state = {
+    "clients": 0,
+    "pending": {},
+    "scheduled": False
+}
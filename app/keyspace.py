@@ -0,0 +1,259 @@
+import heapq
+import re
+import time
+from functools import lru_cache
+
+from datatypes import Collection, copy_collection
+from lazyfree import free_lazily, free_value_lazily
+from tracking import invalidate_key, invalidate_all
+from globals import db, memory_state, tracking_table, tracking_prefix_lengths
+
+# Number of slots examined per SCAN call when no COUNT is given.
+SCAN_DEFAULT_COUNT = 10
+
+# Approximate bytes used by a key besides its name and value: the two bytes
+# objects' headers and its slot in the dict.
+ENTRY_OVERHEAD = 120
+
+
+def value_size(value):
+    """
+    Estimate the memory used by a value: a RESP bulk reply or a collection.
+    """
+    return value.size if isinstance(value, Collection) else len(value)
+
+
+def entry_size(key, value):
+    """
+    Estimate the memory used by a key and its value, in bytes.
+    """
+    return len(key) + value_size(value) + ENTRY_OVERHEAD
+
+
+def store_value(key, value):
+    """
+    Set 'key' to 'value' (a RESP bulk reply or a collection) and account
+    for its memory. Clients tracking the key are told it changed.
+    """
+    old = db["dict"].get(key)
+    db["dict"][key] = value
+    if tracking_table or tracking_prefix_lengths:
+        invalidate_key(key)
+    if old is None:
+        memory_state["used"] += entry_size(key, value)
+        if db["scan_free_slots"]:
+            position = db["scan_free_slots"].pop()
+            db["scan_slots"][position] = key
+        else:
+            position = len(db["scan_slots"])
+            db["scan_slots"].append(key)
+        db["scan_positions"][key] = position
+    else:
+        memory_state["used"] += value_size(value) - value_size(old)
+
+
+def remove_key(key, lazy=False):
+    """
+    Delete 'key' with its expiry and access metadata. With 'lazy', a large
+    collection value is freed in the background (see lazyfree). Clients
+    tracking the key are told it changed.
+    Returns False if the key did not exist.
+    """
+    value = db["dict"].pop(key, None)
+    if value is None:
+        return False
+    if tracking_table or tracking_prefix_lengths:
+        invalidate_key(key)
+    memory_state["used"] -= entry_size(key, value)
+    position = db["scan_positions"].pop(key)
+    db["scan_slots"][position] = None
+    db["scan_free_slots"].append(position)
+    db["expires"].pop(key, None)
+    db["key_meta"].pop(key, None)
+    if lazy:
+        free_value_lazily(value)
+    return True
+
+
+def flush_keyspace(lazy):
+    """
+    Delete every key, for FLUSHALL. Empty containers are swapped into 'db',
+    which costs the same for any number of keys. With 'lazy', the old ones
+    are freed in the background (large collection values included);
+    otherwise they are dropped here.
+    Returns the number of keys deleted.
+    """
+    count = len(db["dict"])
+    old = list(db.values())
+    db.update({name: type(container)() for name, container in db.items()})
+    memory_state["used"] = 0
+    invalidate_all()
+    if lazy:
+        for container in old:
+            free_lazily(container)
+    return count
+
+
+def recount_memory():
+    """
+    Recompute the memory estimate from scratch, after a bulk load or clear.
+    """
+    memory_state["used"] = sum(len(key) + value_size(value) for key, value in db["dict"].items()) + \
+        len(db["dict"]) * ENTRY_OVERHEAD
+
+
+def index_keys():
+    """
+    Give every key a SCAN slot from scratch, after a bulk load or clear.
+    """
+    db["scan_slots"] = list(db["dict"])
+    db["scan_positions"] = dict(zip(db["scan_slots"], range(len(db["scan_slots"]))))
+    db["scan_free_slots"] = []
+
+
+def copy_keyspace():
+    """
+    Return a copy of db["dict"] that later writes leave untouched,
+    for snapshots written while the server keeps running. Strings are
+    immutable and shared; collections are copied.
+    """
+    keyspace = db["dict"].copy()
+    for key, value in keyspace.items():
+        if isinstance(value, Collection):
+            keyspace[key] = copy_collection(value)
+    return keyspace
+
+
+def set_expiry(key, timestamp):
+    """
+    Give 'key' an absolute expiry time (seconds since the epoch).
+    """
+    db["expires"][key] = timestamp
+    heapq.heappush(db["expiry_heap"], (timestamp, key))
+
+
+def set_expiries(expiries):
+    """
+    Add many expiry times at once, e.g. when loading a snapshot.
+    The heap is rebuilt in one pass instead of one push per key.
+    """
+    db["expires"].update(expiries)
+    db["expiry_heap"].extend((timestamp, key) for key, timestamp in expiries.items())
+    heapq.heapify(db["expiry_heap"])
+
+
+def clear_expiry(key):
+    """
+    Remove the expiry time of 'key', if any.
+    Its heap entry becomes stale and is skipped when it reaches the top.
+    """
+    db["expires"].pop(key, None)
+
+
+def translate_class(pattern, i):
+    """
+    Translate the character class starting after the '[' at 'pattern[i - 1]'
+    into a regex class, the way Redis' stringmatchlen() reads it: '^'
+    negates it, a backslash escapes the next character, reversed ranges
+    like 'z-a' are swapped, and a class missing its ']' runs to the end of
+    the pattern. Every byte is written as an escape, so the regex is
+    always valid.
+    Returns (regex, index just past the class).
+    """
+    n = len(pattern)
+    negate = i < n and pattern[i] == 0x5E  # '^'
+    if negate:
+        i += 1
+    items = []
+    while i < n:
+        c = pattern[i]
+        if c == 0x5C and i + 1 < n:  # '\'
+            items.append(b"\\x%02x" % pattern[i + 1])
+            i += 2
+        elif c == 0x5D:  # ']'
+            i += 1
+            break
+        elif i + 2 < n and pattern[i + 1] == 0x2D:  # '-'
+            start, end = sorted((c, pattern[i + 2]))
+            items.append(b"\\x%02x-\\x%02x" % (start, end))
+            i += 3
+        else:
+            items.append(b"\\x%02x" % c)
+            i += 1
+    if not items:
+        return (b"." if negate else b"(?!)"), i
+    return b"[" + (b"^" if negate else b"") + b"".join(items) + b"]", i
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    """
+    Translate a Redis glob pattern (bytes) into a compiled regex.
+    Supports '*', '?', '[...]' classes (see translate_class) and backslash
+    escapes.
+    Raises ValueError if the result is not a valid regex.
+    """
+    i, n = 0, len(pattern)
+    regex = b""
+    while i < n:
+        c = pattern[i:i + 1]
+        i += 1
+        if c == b"*":
+            regex += b".*"
+        elif c == b"?":
+            regex += b"."
+        elif c == b"\\" and i < n:
+            regex += re.escape(pattern[i:i + 1])
+            i += 1
+        elif c == b"[":
+            part, i = translate_class(pattern, i)
+            regex += part
+        else:
+            regex += re.escape(c)
+    try:
+        return re.compile(regex + b"\\Z", re.DOTALL)
+    except re.error as e:
+        raise ValueError(f"invalid pattern: {e}")
+
+
+def is_live(key, now):
+    """
+    Check that 'key' has not passed its expiry time.
+    """
+    timestamp = db["expires"].get(key)
+    return timestamp is None or timestamp > now
+
+
+def keys_matching(pattern):
+    """
+    Return all live keys matching the glob 'pattern'.
+    """
+    now = time.time()
+    if pattern == b"*":
+        return [k for k in db["dict"] if is_live(k, now)]
+    match = compile_pattern(pattern).match
+    return [k for k in db["dict"] if match(k) and is_live(k, now)]
+
+
+def scan_keys(cursor, pattern=None, count=SCAN_DEFAULT_COUNT):
+    """
+    Run one step of a SCAN iteration: examine 'count' slots from 'cursor'
+    (see db["scan_slots"]). Keys keep their slot for as long as they exist, so
+    every key present for the whole iteration is returned exactly once,
+    however the keyspace changes in between, and the server keeps nothing
+    per iteration: any number of them can run at once.
+    Returns (next_cursor, keys); next_cursor is 0 once the walk is done.
+    Raises ValueError for a negative cursor.
+    """
+    if cursor < 0:
+        raise ValueError("invalid cursor")
+    end = cursor + max(count, 1)
+    batch = db["scan_slots"][cursor:end]
+    next_cursor = end if end < len(db["scan_slots"]) else 0
+
+    now = time.time()
+    keys = [k for k in batch if k is not None and is_live(k, now)]
+    if pattern is not None and pattern != b"*":
+        match = compile_pattern(pattern).match
+        keys = [k for k in keys if match(k)]
+    return next_cursor, keys
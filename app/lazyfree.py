@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from datatypes import Collection
+from globals import lazyfree_state
+
+# Containers with at most this many items are freed right away: dropping
+# them is as cheap as queueing them.
+LAZYFREE_THRESHOLD = 64
+
+# Maximum time spent freeing per event loop turn, in seconds.
+LAZYFREE_BUDGET = 0.001
+
+# Number of items dropped between two checks of the time budget.
+LAZYFREE_BATCH = 256
+
+
+def free_lazily(container):
+    """
+    Hand a dict, set, list or deque that is no longer referenced anywhere
+    else to the background reclaimer, which empties it a few items at a
+    time between event loop turns. Deallocating a container with millions
+    of items at once would stall every client for as long.
+    Small containers, or any container when no event loop is running (e.g.
+    while loading the AOF), are simply dropped.
+    """
+    if len(container) <= LAZYFREE_THRESHOLD:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    lazyfree_state["queue"].append(container)
+    lazyfree_state["pending"] += 1
+    if not lazyfree_state["scheduled"]:
+        lazyfree_state["scheduled"] = True
+        loop.call_soon(lazyfree_step)
+
+
+def free_value_lazily(value):
+    """
+    Free a value removed from the keyspace in the background, if it is a
+    large collection. Strings are a single allocation and are dropped.
+    """
+    if isinstance(value, Collection):
+        free_lazily(value.items)
+
+
+def drop_items(container):
+    """
+    Remove up to LAZYFREE_BATCH items from a container, freeing them.
+    Large collections found among them (e.g. keyspace values after
+    FLUSHALL ASYNC) are queued rather than freed in one go.
+    """
+    count = min(LAZYFREE_BATCH, len(container))
+    if isinstance(container, dict):
+        popitem = container.popitem
+        batch = [popitem()[1] for _ in range(count)]
+    elif isinstance(container, list):
+        batch = container[-count:]
+        del container[-count:]
+    else:
+        pop = container.pop
+        batch = [pop() for _ in range(count)]
+    for item in batch:
+        if isinstance(item, Collection):
+            free_lazily(item.items)
+
+
+def lazyfree_step():
+    """
+    Free queued containers for at most LAZYFREE_BUDGET (at least one batch),
+    then let other work run and continue on the next event loop turn.
+    """
+    queue = lazyfree_state["queue"]
+    deadline = time.perf_counter() + LAZYFREE_BUDGET
+    while queue:
+        container = queue[0]
+        drop_items(container)
+        if not container:
+            queue.popleft()
+            lazyfree_state["pending"] -= 1
+            lazyfree_state["freed"] += 1
+        if time.perf_counter() >= deadline:
+            break
+    if queue:
+        asyncio.get_running_loop().call_soon(lazyfree_step)
+    else:
+        lazyfree_state["scheduled"] = False
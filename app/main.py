@@ -1,16 +1,80 @@
 import argparse
 import asyncio
+import os
 
-from config import server_config, is_file_in_dir
+from config import server_config, is_file_in_dir, parse_output_buffer_limit, parse_memory, check_workers
 from rdb import read_file
+from eviction import init_eviction, MAXMEMORY_POLICIES
+from aof import load_aof, aof_path, APPENDFSYNC_POLICIES
+from clients import adjust_open_files_limit
+from shard import start_workers, drop_foreign_keys
 from server import start_server
 
+EVENT_LOOPS = ("asyncio", "uvloop")
+
+
+def load_dataset():
+    """
+    Read the dataset from the AOF or the RDB file, if there is one.
+    Returns False if there was nothing to read.
+    """
+    # The AOF is more recent than the snapshot, so it wins when both exist;
+    # otherwise, if we have a db file in the specified directory, read it
+    if server_config["appendonly"] and os.path.isfile(aof_path()):
+        print("Reading AOF file...")
+        load_aof(aof_path())
+    elif server_config["dir"] and server_config["dbfilename"] and \
+       is_file_in_dir(server_config["dir"], server_config["dbfilename"]):
+        print("Reading RDB file...")
+        read_file(server_config["dir"], server_config["dbfilename"])
+    else:
+        return False
+    return True
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Redis-like server")
     parser.add_argument("--dir", required=False, help="Directory to store data files")
     parser.add_argument("--dbfilename", required=False, help="Name of the database file")
     parser.add_argument("--port", required=False, help="Server port")
     parser.add_argument("--replicaof", required=False, help="Replica of master (host port)")
+    parser.add_argument("--repl-backlog-size", type=int, default=server_config["repl_backlog_size"],
+                        help="Replication backlog size in bytes")
+    parser.add_argument("--save", required=False,
+                        help="Snapshot after <seconds> if at least <changes> writes happened, e.g. \"900 1 300 10\"")
+    parser.add_argument("--client-output-buffer-limit", action="append", default=[],
+                        help="Output buffer limits for a client class, e.g. \"replica 256mb 64mb 60\"")
+    parser.add_argument("--slowlog-log-slower-than", type=int, default=server_config["slowlog_log_slower_than"],
+                        help="Log commands taking at least this many microseconds in the SLOWLOG")
+    parser.add_argument("--slowlog-max-len", type=int, default=server_config["slowlog_max_len"],
+                        help="Number of SLOWLOG entries kept")
+    parser.add_argument("--maxmemory", type=parse_memory, default=server_config["maxmemory"],
+                        help="Memory limit for the dataset, e.g. 100mb (0 means no limit)")
+    parser.add_argument("--maxmemory-policy", choices=MAXMEMORY_POLICIES, default=server_config["maxmemory_policy"],
+                        help="How keys are evicted once maxmemory is reached")
+    parser.add_argument("--maxmemory-samples", type=int, default=server_config["maxmemory_samples"],
+                        help="Number of keys sampled for each eviction")
+    parser.add_argument("--appendonly", choices=("yes", "no"), default="no",
+                        help="Log every write to an append-only file")
+    parser.add_argument("--appendfilename", default=server_config["appendfilename"],
+                        help="Name of the append-only file")
+    parser.add_argument("--appendfsync", choices=APPENDFSYNC_POLICIES, default=server_config["appendfsync"],
+                        help="When the append-only file is synced to disk")
+    parser.add_argument("--maxclients", type=int, default=server_config["maxclients"],
+                        help="Maximum number of connected clients")
+    parser.add_argument("--timeout", type=int, default=server_config["timeout"],
+                        help="Close clients idle for this many seconds (0 never does)")
+    parser.add_argument("--tcp-keepalive", type=int, default=server_config["tcp_keepalive"],
+                        help="Seconds between TCP keepalive probes on client connections (0 turns them off)")
+    parser.add_argument("--tracking-table-max-keys", type=int, default=server_config["tracking_table_max_keys"],
+                        help="Maximum number of keys remembered for CLIENT TRACKING")
+    for option in ("eviction", "expire", "user-del", "user-flush"):
+        parser.add_argument(f"--lazyfree-lazy-{option}", choices=("yes", "no"), default="no",
+                            help=f"Free large values in the background for {option.replace('user-', '')}")
+    parser.add_argument("--workers", type=int, default=server_config["workers"],
+                        help="Number of worker processes, each owning a shard of the keyspace")
+    parser.add_argument("--event-loop", choices=EVENT_LOOPS, default=server_config["event_loop"],
+                        help="Event loop implementation (uvloop must be installed)")
     args = parser.parse_args()
 
     # Set server configuration from args
@@ -18,12 +82,58 @@ if __name__ == "__main__":
     server_config["dbfilename"] = args.dbfilename
     server_config["port"] = args.port
     server_config["replicaof"] = args.replicaof
+    server_config["save"] = args.save
+    server_config["repl_backlog_size"] = args.repl_backlog_size
+    server_config["slowlog_log_slower_than"] = args.slowlog_log_slower_than
+    server_config["slowlog_max_len"] = args.slowlog_max_len
+    server_config["maxmemory"] = args.maxmemory
+    server_config["maxmemory_policy"] = args.maxmemory_policy
+    server_config["maxmemory_samples"] = args.maxmemory_samples
+    init_eviction()
+    server_config["appendonly"] = args.appendonly == "yes"
+    server_config["appendfilename"] = args.appendfilename
+    server_config["appendfsync"] = args.appendfsync
+    for limit in args.client_output_buffer_limit:
+        try:
+            parse_output_buffer_limit(limit)
+        except ValueError as e:
+            parser.error(f"--client-output-buffer-limit: {e}")
+    for option in ("eviction", "expire", "user_del", "user_flush"):
+        server_config[f"lazyfree_lazy_{option}"] = getattr(args, f"lazyfree_lazy_{option}") == "yes"
+    server_config["tracking_table_max_keys"] = args.tracking_table_max_keys
+    server_config["maxclients"] = args.maxclients
+    if args.maxclients < 1:
+        parser.error("--maxclients must be at least 1")
+    adjust_open_files_limit()
+    server_config["timeout"] = args.timeout
+    server_config["tcp_keepalive"] = args.tcp_keepalive
+    server_config["workers"] = args.workers
+    try:
+        check_workers(args.workers, args.replicaof)
+    except ValueError as e:
+        parser.error(str(e))
+    server_config["event_loop"] = args.event_loop
+    if args.event_loop == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            parser.error("--event-loop uvloop: uvloop is not installed")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    # If we have a db file in the specified directory, read it
-    if server_config["dir"] and server_config["dbfilename"] and \
-       is_file_in_dir(server_config["dir"], server_config["dbfilename"]):
-        print("Reading RDB file...")
-        read_file(server_config["dir"], server_config["dbfilename"])
+    if server_config["workers"] > 1:
+        unsharded = server_config["dbfilename"], server_config["appendfilename"]
+        # Only the workers return, with their own shard and file names
+        start_workers(server_config["workers"])
+        # Until a worker has files of its own, it takes its keys from the
+        # unsharded ones
+        if not load_dataset():
+            sharded = server_config["dbfilename"], server_config["appendfilename"]
+            server_config["dbfilename"], server_config["appendfilename"] = unsharded
+            if load_dataset():
+                drop_foreign_keys()
+            server_config["dbfilename"], server_config["appendfilename"] = sharded
+    else:
+        load_dataset()
 
     # Start the asyncio server
     asyncio.run(start_server())
@@ -1,49 +1,239 @@
+CRLF = b"\r\n"
+
+
+def _parse_frame(data, pos):
+    """
+    Parse a single RESP value starting at 'pos'.
+    Bulk strings are read by their declared length and returned as bytes,
+    so they may hold any binary payload.
+    Returns (value, next_pos), or (None, -1) if the frame is not complete yet.
+    """
+    end = data.find(CRLF, pos)
+    if end == -1:
+        return None, -1
+
+    first_byte = data[pos]
+
+    if first_byte == 0x2B:  # '+' Simple String
+        return data[pos + 1:end].decode(), end + 2
+
+    elif first_byte == 0x2D:  # '-' Error
+        return {"error": data[pos + 1:end].decode()}, end + 2
+
+    elif first_byte == 0x3A:  # ':' Integer
+        return int(data[pos + 1:end]), end + 2
+
+    elif first_byte == 0x24:  # '$' Bulk String
+        length = int(data[pos + 1:end])
+        if length == -1:
+            return None, end + 2  # Null bulk string
+        if length < 0:
+            raise ValueError("invalid bulk length")
+        start = end + 2
+        stop = start + length
+        if stop + 2 > len(data):
+            return None, -1
+        if data[stop:stop + 2] != CRLF:
+            raise ValueError("expected CRLF after bulk string")
+        return bytes(data[start:stop]), stop + 2
+
+    elif first_byte == 0x2A:  # '*' Array
+        num_elements = int(data[pos + 1:end])
+        if num_elements == -1:
+            return None, end + 2  # Null array
+        result = []
+        pos = end + 2
+        for _ in range(num_elements):
+            value, pos = _parse_frame(data, pos)
+            if pos == -1:
+                return None, -1
+            result.append(value)
+        return result, pos
+
+    else:
+        raise ValueError("Unknown RESP type")
+
+
 def parse_input(data):
     """
     Redis protocol parser (RESP).
     Returns (parsed_result, leftover_bytes).
+    Raises ValueError if 'data' does not hold a complete frame.
     """
     if not data:
         raise ValueError("No data to parse")
 
-    first_byte = data[0]
-
-    if first_byte == b"+"[0]:  # Simple String
-        return data[1:].decode().strip(), b""
+    result, pos = _parse_frame(data, 0)
+    if pos == -1:
+        raise ValueError("Incomplete RESP frame")
+    return result, data[pos:]
 
-    elif first_byte == b"-"[0]:  # Error
-        return {"error": data[1:].decode().strip()}, b""
 
-    elif first_byte == b":"[0]:  # Integer
-        return int(data[1:].strip()), b""
+def new_parse_state():
+    """
+    Create the parse state of a connection, for parse_commands(): the
+    arguments of a command array read so far, how many are still
+    expected and where the next one starts.
+    """
+    return {"args": None, "remaining": 0, "offset": 0}
 
-    elif first_byte == b"$"[0]:  # Bulk String
-        lines = data.split(b"\r\n")
-        length = int(lines[0][1:])
-        if length == -1:
-            return None, b""  # Null bulk string
-        return lines[1].decode(), b""
-
-    elif first_byte == b"*"[0]:  # Array
-        lines = data.split(b"\r\n")
-        num_elements = int(lines[0][1:])
-        if num_elements == 0:
-            return [], b""  # Empty array
-        result = []
-        i = 1
-        processed_length = len(lines[0]) + 2
 
-        while i < num_elements * 2:
-            line = lines[i]
-            processed_length += len(line) + 2
-            if line.startswith(b"$"):
-                result.append(lines[i + 1].decode())
-                processed_length += len(lines[i + 1]) + 2
-                i += 1
-            i += 1
+def _parse_length(data, start, end, kind):
+    """
+    Read the length in a '*' or '$' header line.
+    """
+    try:
+        return int(data[start:end])
+    except ValueError:
+        raise ValueError(f"Protocol error: invalid {kind} length")
 
-        leftover_data = data[processed_length:]
-        return result, leftover_data
 
+def _parse_command(data, pos, state):
+    """
+    Parse a command array starting at 'pos', or resume the one recorded in
+    'state'. Its elements must be bulk strings, as in Redis.
+    A command that is not complete yet keeps the arguments read so far in
+    'state', so the next call only parses the bytes received since.
+    Returns (args, next_pos), or (None, -1) if the command is not complete.
+    """
+    size = len(data)
+    if state is not None and state["args"] is not None:
+        args, remaining, pos = state["args"], state["remaining"], state["offset"]
     else:
-        raise ValueError("Unknown RESP type")
+        end = data.find(CRLF, pos)
+        if end == -1:
+            return None, -1
+        remaining = _parse_length(data, pos + 1, end, "multibulk")
+        args = []
+        pos = end + 2
+        if remaining <= 0:
+            # Empty and null arrays are skipped
+            return args, pos
+
+    while remaining:
+        if pos >= size:
+            break
+        if data[pos] != 0x24:  # '$'
+            raise ValueError(f"Protocol error: expected '$', got '{chr(data[pos])}'")
+        end = data.find(CRLF, pos)
+        if end == -1:
+            break
+        length = _parse_length(data, pos + 1, end, "bulk")
+        if length < 0:
+            raise ValueError("Protocol error: invalid bulk length")
+        start = end + 2
+        stop = start + length
+        if stop + 2 > size:
+            break
+        if data[stop:stop + 2] != CRLF:
+            raise ValueError("Protocol error: expected CRLF after bulk string")
+        args.append(bytes(data[start:stop]))
+        pos = stop + 2
+        remaining -= 1
+
+    if remaining:
+        if state is not None:
+            state["args"], state["remaining"], state["offset"] = args, remaining, pos
+        return None, -1
+    if state is not None:
+        state["args"] = None
+    return args, pos
+
+
+def parse_commands(buffer, ends=None, state=None):
+    """
+    Parse every complete command at the start of a connection buffer.
+    Commands are RESP arrays of bulk strings, or inline commands (space
+    separated words) as sent by telnet-like clients. A trailing partial
+    frame is left alone so it can be completed by the next read.
+    With a 'state' from new_parse_state(), the arguments of that partial
+    command are kept in it, so a large command arriving over many reads is
+    parsed once rather than from its start on every read. The caller must
+    then remove the consumed bytes from the buffer before the next call.
+    If a list is given as 'ends', the end offset of each command is appended
+    to it, for callers that account for the stream byte by byte.
+    Raises ValueError for a protocol error.
+    Returns (commands, consumed_bytes).
+    """
+    commands = []
+    pos = 0
+    size = len(buffer)
+
+    while pos < size:
+        if buffer[pos] == 0x2A or state is not None and state["args"] is not None:  # '*'
+            result, next_pos = _parse_command(buffer, pos, state)
+            if next_pos == -1:
+                break
+        else:
+            end = buffer.find(b"\n", pos)
+            if end == -1:
+                break
+            result = bytes(buffer[pos:end]).split()
+            next_pos = end + 1
+
+        if result:
+            commands.append(result)
+            if ends is not None:
+                ends.append(next_pos)
+        pos = next_pos
+
+    if state is not None and state["args"] is not None:
+        # The partial command now starts the buffer
+        state["offset"] -= pos
+    return commands, pos
+
+
+def split_replies(buffer):
+    """
+    Split the complete RESP replies at the start of 'buffer' into their
+    encoded frames, e.g. to pass replies received from another server on
+    to clients as they are.
+    Returns (frames, consumed_bytes).
+    """
+    frames = []
+    pos = 0
+    size = len(buffer)
+    while pos < size:
+        _, next_pos = _parse_frame(buffer, pos)
+        if next_pos == -1:
+            break
+        frames.append(bytes(buffer[pos:next_pos]))
+        pos = next_pos
+    return frames, pos
+
+
+def encode_bulk(value):
+    """
+    Encode bytes as a RESP bulk string.
+    String values are kept in this form in db["dict"], so that a GET
+    can reply with the stored buffer as is.
+    """
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def bulk_value(reply):
+    """
+    Return the payload of a RESP bulk string created by encode_bulk().
+    """
+    return reply[reply.index(CRLF) + 2:-2]
+
+
+def encode_array(items):
+    """
+    Encode a list of bytes as a RESP array of bulk strings, in one buffer.
+    """
+    parts = [b"*%d\r\n" % len(items)]
+    parts += [b"$%d\r\n%s\r\n" % (len(item), item) for item in items]
+    return b"".join(parts)
+
+
+def encode_command(args):
+    """
+    Encode a command (list of str or bytes arguments) as a RESP array.
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
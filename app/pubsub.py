@@ -0,0 +1,157 @@
+from parsers import encode_bulk
+from keyspace import compile_pattern
+from clients import deliver
+from globals import pubsub_channels, pubsub_patterns, pubsub_prefixes, pubsub_prefix_lengths
+from config import server_config
+
+# Characters that start the glob part of a pattern.
+GLOB_CHARS = b"*?[\\"
+
+MESSAGE_HEADER = b"*3\r\n$7\r\nmessage\r\n"
+PMESSAGE_HEADER = b"*4\r\n$8\r\npmessage\r\n"
+
+
+def pattern_prefix(pattern):
+    """
+    Return the literal part of a pattern before its first glob character,
+    e.g. b"news." for b"news.*". Only channels starting with it can match.
+    """
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+def subscription_count(client):
+    """
+    Return the number of channels and patterns a client is subscribed to.
+    """
+    return len(client.channels) + len(client.patterns)
+
+
+def encode_subscription(kind, name, count):
+    """
+    Encode the confirmation of a (P)SUBSCRIBE or (P)UNSUBSCRIBE for one
+    channel or pattern ('name' may be None when there was none).
+    """
+    name = b"$-1\r\n" if name is None else encode_bulk(name)
+    return b"*3\r\n" + encode_bulk(kind) + name + b":%d\r\n" % count
+
+
+def subscribe(client, channel):
+    """
+    Subscribe a client to a channel. Returns False if it already was.
+    """
+    if channel in client.channels:
+        return False
+    client.channels.add(channel)
+    # Dicts keep the subscribers in the order they subscribed
+    pubsub_channels.setdefault(channel, {})[client] = None
+    return True
+
+
+def unsubscribe(client, channel):
+    """
+    Unsubscribe a client from a channel. Returns False if it was not subscribed.
+    """
+    if channel not in client.channels:
+        return False
+    client.channels.discard(channel)
+    subscribers = pubsub_channels[channel]
+    del subscribers[client]
+    if not subscribers:
+        del pubsub_channels[channel]
+    return True
+
+
+def psubscribe(client, pattern):
+    """
+    Subscribe a client to a pattern. Returns False if it already was.
+    Patterns are indexed by their literal prefix (see pattern_prefix), with
+    their compiled regex.
+    Raises ValueError for an invalid pattern, before changing anything.
+    """
+    if pattern in client.patterns:
+        return False
+    subscribers = pubsub_patterns.get(pattern)
+    if subscribers is None:
+        match = compile_pattern(pattern).match
+        subscribers = pubsub_patterns[pattern] = {}
+        prefix = pattern_prefix(pattern)
+        patterns = pubsub_prefixes.get(prefix)
+        if patterns is None:
+            patterns = pubsub_prefixes[prefix] = {}
+            pubsub_prefix_lengths[len(prefix)] = pubsub_prefix_lengths.get(len(prefix), 0) + 1
+        patterns[pattern] = match
+    client.patterns.add(pattern)
+    subscribers[client] = None
+    return True
+
+
+def punsubscribe(client, pattern):
+    """
+    Unsubscribe a client from a pattern. Returns False if it was not subscribed.
+    """
+    if pattern not in client.patterns:
+        return False
+    client.patterns.discard(pattern)
+    subscribers = pubsub_patterns[pattern]
+    del subscribers[client]
+    if not subscribers:
+        del pubsub_patterns[pattern]
+        prefix = pattern_prefix(pattern)
+        patterns = pubsub_prefixes[prefix]
+        del patterns[pattern]
+        if not patterns:
+            del pubsub_prefixes[prefix]
+            pubsub_prefix_lengths[len(prefix)] -= 1
+            if not pubsub_prefix_lengths[len(prefix)]:
+                del pubsub_prefix_lengths[len(prefix)]
+    return True
+
+
+def unsubscribe_all(client):
+    """
+    Drop every subscription of a client, e.g. once it disconnected.
+    """
+    for channel in list(client.channels):
+        unsubscribe(client, channel)
+    for pattern in list(client.patterns):
+        punsubscribe(client, pattern)
+
+
+def matching_patterns(channel):
+    """
+    Return the subscribed patterns matching 'channel'.
+    Only the patterns whose literal prefix starts the channel are tried,
+    found with one dict lookup per distinct prefix length, however many
+    patterns there are.
+    """
+    matches = []
+    for length in pubsub_prefix_lengths:
+        patterns = pubsub_prefixes.get(channel[:length])
+        if patterns is not None:
+            matches += [pattern for pattern, match in patterns.items() if match(channel)]
+    return matches
+
+
+def publish(channel, message):
+    """
+    Send a message to the subscribers of 'channel' and of the patterns
+    matching it. It is encoded once for the channel and once per matching
+    pattern, whatever the number of subscribers.
+    Returns the number of clients it was sent to.
+    """
+    limits = server_config["client_output_buffer_limit"]["pubsub"]
+    payload = encode_bulk(channel) + encode_bulk(message)
+    receivers = 0
+    subscribers = pubsub_channels.get(channel)
+    if subscribers:
+        deliver(subscribers, MESSAGE_HEADER + payload, limits)
+        receivers += len(subscribers)
+    if pubsub_prefix_lengths:
+        for pattern in matching_patterns(channel):
+            subscribers = pubsub_patterns[pattern]
+            deliver(subscribers, PMESSAGE_HEADER + encode_bulk(pattern) + payload, limits)
+            receivers += len(subscribers)
+    return receivers
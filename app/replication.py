@@ -1,15 +1,34 @@
 import asyncio
+import secrets
 import time
 
-from parsers import parse_input
-from globals import slaves, slaves_write_count, global_hashmap, expiry_hashmap
+from parsers import parse_input, parse_commands, new_parse_state, encode_command
+from rdb import iter_rdb_chunks, check_rdb_header, parse_rdb
+from keyspace import flush_keyspace, set_expiries, recount_memory, index_keys, copy_keyspace
+from commands import COMMANDS
+from aof import feed_aof, rewrite_new_dataset
+from globals import db, slaves, syncing_slaves, repl_state, aof_state
 from config import server_config
 
+# Read size used while receiving a snapshot and the command stream from the master.
+RDB_READ_SIZE = 64 * 1024
+
+# Delay before a replica reconnects to its master after losing the link.
+RECONNECT_DELAY = 1
+
+GETACK_COMMAND = encode_command([b"REPLCONF", b"GETACK", b"*"])
+
+# Blocked WAIT calls as (stream offset, number of replicas, future) tuples.
+ack_waiters = []
+
 
 async def slave_read_loop(reader, writer):
     """
     Continuously reads data from a slave connection.
     """
+    key = (reader, writer)
+    buffer = bytearray()
+    parse_state = new_parse_state()
     try:
         while True:
             data = await reader.read(1024)
@@ -17,61 +36,325 @@ async def slave_read_loop(reader, writer):
                 print("Slave disconnected")
                 break
 
-            leftover = data
-            while leftover:
-                parsed, leftover = parse_input(leftover)
-                if isinstance(parsed, list) and len(parsed) >= 2:
+            buffer += data
+            commands, consumed = parse_commands(buffer, state=parse_state)
+            del buffer[:consumed]
+            for parsed in commands:
+                if len(parsed) >= 2:
                     cmd = parsed[0].upper()
-                    if cmd == "REPLCONF" and parsed[1].upper() == "ACK":
-                        if (reader, writer) in slaves:
-                            slaves[(reader, writer)] += 1
+                    if cmd == b"REPLCONF" and parsed[1].upper() == b"ACK" and len(parsed) > 2:
+                        state = slaves.get(key)
+                        if state is not None:
+                            state["ack_offset"] = max(state["ack_offset"], int(parsed[2]))
+                            notify_ack_waiters()
     except Exception as e:
         print(f"Error in slave read loop: {e}")
     finally:
-        if (reader, writer) in slaves:
-            del slaves[(reader, writer)]
+        drop_slave(key)
         writer.close()
         await writer.wait_closed()
 
 
-async def write_to_slave(data):
+def new_slave_state():
+    """
+    Create the bookkeeping kept for a replica: the last stream offset it
+    acknowledged, the writes waiting to be handed to its socket, and when
+    its output first went over the soft limit.
+    """
+    return {
+        "ack_offset": 0,
+        "pending": [],
+        "pending_size": 0,
+        "soft_limit_since": None,
+        "wakeup": asyncio.Event()
+    }
+
+
+def add_slave(key, state):
+    """
+    Start streaming writes to a replica and give it its own flush task.
     """
-    Forward the given 'data' to all connected slaves.
+    slaves[key] = state
+    asyncio.create_task(slave_flush_loop(key, state))
+    state["wakeup"].set()
+
+
+def drop_slave(key):
     """
-    global slaves_write_count
-    for key in slaves:
-        slaves[key] = 0  # reset acknowledgments
+    Forget a replica and stop its flush task. Safe to call more than once.
+    """
+    state = slaves.pop(key, None) or syncing_slaves.pop(key, None)
+    if state is not None:
+        state["pending"] = []
+        state["pending_size"] = 0
+        state["wakeup"].set()
+
+
+def disconnect_slave(key, reason):
+    """
+    Drop a lagging replica and close its connection without flushing.
+    It can reconnect and catch up with a partial or full resync.
+    """
+    print(f"Disconnecting replica: {reason}")
+    drop_slave(key)
+    key[1].transport.abort()
+
+
+def check_output_limits(key, state, now):
+    """
+    Enforce the replica output buffer limits on the bytes queued for 'key',
+    both not yet written and still in the transport's buffer.
+    Returns False if the replica was disconnected.
+    """
+    hard, soft, soft_seconds = server_config["client_output_buffer_limit"]["replica"]
+    size = state["pending_size"] + key[1].transport.get_write_buffer_size()
+    if hard and size > hard:
+        disconnect_slave(key, f"output buffer of {size} bytes over the hard limit")
+        return False
+    if soft and size > soft:
+        if state["soft_limit_since"] is None:
+            state["soft_limit_since"] = now
+        elif now - state["soft_limit_since"] > soft_seconds:
+            disconnect_slave(key, f"output buffer over the soft limit for {soft_seconds}s")
+            return False
+    else:
+        state["soft_limit_since"] = None
+    return True
+
+
+def propagate(data):
+    """
+    Log an encoded write command to the AOF and send it to replicas.
+    On a replica, the writes it makes itself (for its own clients, or keys
+    it expires or evicts) are only logged: its offset and backlog count
+    the bytes received from its master, which it acknowledges and resumes
+    from with PSYNC.
+    """
+    feed_aof(data)
+    if not server_config["replicaof"]:
+        write_to_slave(data)
+
+
+def write_to_slave(data):
+    """
+    Queue the given 'data' for all connected slaves.
+    Nothing is written here: each replica's flush task sends everything
+    queued since its last write in one call, so the client's reply never
+    waits on a replica's socket.
+    """
+    feed_backlog(data)
+    if not slaves and not syncing_slaves:
+        return
+
+    now = time.monotonic()
+    # Replicas still receiving their snapshot get the write once it is sent
+    for key, state in list(syncing_slaves.items()):
+        state["pending"].append(data)
+        state["pending_size"] += len(data)
+        check_output_limits(key, state, now)
 
-    for reader, writer in list(slaves.keys()):
-        try:
-            writer.write(data)
+    for key, state in list(slaves.items()):
+        state["pending"].append(data)
+        state["pending_size"] += len(data)
+        if check_output_limits(key, state, now):
+            state["wakeup"].set()
+
+
+async def slave_flush_loop(key, state):
+    """
+    Write a replica's queued data to its socket whenever there is some.
+    Each replica has its own loop, so waiting for a slow replica to drain
+    only delays that replica.
+    """
+    writer = key[1]
+    try:
+        while slaves.get(key) is state:
+            await state["wakeup"].wait()
+            state["wakeup"].clear()
+            if slaves.get(key) is not state:
+                break
+            if state["pending"]:
+                pending = state["pending"]
+                state["pending"] = []
+                state["pending_size"] = 0
+                writer.writelines(pending)
             await writer.drain()
-        except Exception as e:
-            print(f"Error forwarding to slave: {e}")
-            del slaves[(reader, writer)]
+    except Exception as e:
+        print(f"Error forwarding to slave: {e}")
+        drop_slave(key)
 
 
-async def wait_for_slaves(count, timeout):
+def create_backlog():
     """
-    Wait for 'count' slaves to ACK or until 'timeout' ms passes.
+    Allocate the replication backlog, if it does not exist yet.
     """
-    global slaves_write_count
-    start_time = time.time()
+    if repl_state["backlog"] is None:
+        repl_state["backlog"] = bytearray(server_config["repl_backlog_size"])
+        repl_state["backlog_idx"] = 0
+        repl_state["backlog_histlen"] = 0
 
-    # Ask each slave for ACK
-    for reader, writer in slaves:
-        writer.write(b"*3\r\n$8\r\nREPLCONF\r\n$6\r\nGETACK\r\n$1\r\n*\r\n")
-        await writer.drain()
 
-    while True:
-        acks = sum(1 for v in slaves.values() if v >= 1)
-        slaves_write_count = acks
-        if slaves_write_count >= count:
-            print("ok")
-            return
-        if time.time() - start_time >= timeout / 1000:
-            return
-        await asyncio.sleep(0.01)
+def feed_backlog(data):
+    """
+    Account for 'data' sent to replicas and keep it in the ring buffer.
+    """
+    repl_state["master_repl_offset"] += len(data)
+    backlog = repl_state["backlog"]
+    if backlog is None:
+        return
+
+    size = len(backlog)
+    if len(data) > size:
+        data = data[-size:]
+    idx = repl_state["backlog_idx"]
+    first = min(len(data), size - idx)
+    backlog[idx:idx + first] = data[:first]
+    if first < len(data):
+        # Wrap around to the start of the buffer
+        backlog[:len(data) - first] = data[first:]
+    repl_state["backlog_idx"] = (idx + len(data)) % size
+    repl_state["backlog_histlen"] = min(repl_state["backlog_histlen"] + len(data), size)
+
+
+def read_backlog(offset):
+    """
+    Return the stream bytes a replica is missing, from 'offset' (the next
+    byte it wants, 1-based as in PSYNC) up to the current master offset.
+    Returns None if part of that range has already left the backlog.
+    """
+    backlog = repl_state["backlog"]
+    missing = repl_state["master_repl_offset"] - (offset - 1)
+    if backlog is None or missing < 0 or missing > repl_state["backlog_histlen"]:
+        return None
+    if missing == 0:
+        return b""
+
+    idx = repl_state["backlog_idx"]
+    begin = (idx - missing) % len(backlog)
+    if begin < idx:
+        return bytes(backlog[begin:idx])
+    return bytes(backlog[begin:] + backlog[:idx])
+
+
+async def sync_replica(reader, writer, replid, offset):
+    """
+    Answer a replica's PSYNC <replid> <offset>.
+    If it follows this stream and the bytes it missed are still in the
+    backlog, reply +CONTINUE and send only those; otherwise fall back to a
+    full resync. Either way the replica ends up in 'slaves'.
+    """
+    create_backlog()
+    try:
+        offset = int(offset)
+    except ValueError:
+        offset = -1
+
+    missing = None
+    if replid.decode(errors="replace") == repl_state["replid"] and offset > 0:
+        missing = read_backlog(offset)
+
+    if missing is None:
+        await full_resync(reader, writer)
+        return
+
+    writer.write(b"+CONTINUE %s\r\n" % repl_state["replid"].encode())
+    writer.write(missing)
+    add_slave((reader, writer), new_slave_state())
+    print(f"Partial resynchronization accepted, sending {len(missing)} bytes of backlog")
+
+
+async def full_resync(reader, writer):
+    """
+    Reply +FULLRESYNC and send a snapshot of the live dataset to a replica.
+    The snapshot is streamed over the socket (diskless) in chunks, framed as
+    "$EOF:<mark>\\r\\n<rdb><mark>" since its size is not known up front.
+    Writes made during the transfer are queued and sent right after it,
+    and the replica then joins 'slaves' to receive the live stream.
+    """
+    key = (reader, writer)
+    state = new_slave_state()
+    syncing_slaves[key] = state
+    try:
+        # A copy later writes cannot disturb gives a consistent point-in-time
+        # view. The reply carries the stream offset it corresponds to.
+        keyspace, expiries = copy_keyspace(), db["expires"].copy()
+        writer.write(b"+FULLRESYNC %s %d\r\n" % (repl_state["replid"].encode(),
+                                                 repl_state["master_repl_offset"]))
+        mark = secrets.token_hex(20).encode()
+        writer.write(b"$EOF:" + mark + b"\r\n")
+        for chunk in iter_rdb_chunks(keyspace, expiries, checksum=False):
+            writer.write(chunk)
+            await writer.drain()
+        writer.write(mark)
+        if syncing_slaves.pop(key, None) is not state:
+            raise ConnectionError("Replica was disconnected during sync")
+        # The writes queued meanwhile go out through the flush task
+        add_slave(key, state)
+        print(f"Synchronization with replica succeeded ({len(keyspace)} keys)")
+    finally:
+        syncing_slaves.pop(key, None)
+
+
+def count_acks(offset):
+    """
+    Count the replicas that acknowledged the stream up to 'offset'.
+    """
+    return sum(1 for state in slaves.values() if state["ack_offset"] >= offset)
+
+
+def notify_ack_waiters():
+    """
+    Wake every WAIT whose replica count has been reached.
+    Called whenever a replica acknowledges a new offset.
+    """
+    for offset, numreplicas, future in ack_waiters:
+        if not future.done() and count_acks(offset) >= numreplicas:
+            future.set_result(None)
+
+
+def request_acks(offset):
+    """
+    Make sure replicas are asked to acknowledge the stream up to 'offset'.
+    The GETACK goes out once the current event loop turn is over, so all
+    WAITs issued meanwhile share it, and none is sent if one already
+    covers 'offset'.
+    """
+    if repl_state["getack_offset"] >= offset or repl_state["getack_scheduled"]:
+        return
+    repl_state["getack_scheduled"] = True
+    asyncio.get_running_loop().call_soon(send_getack)
+
+
+def send_getack():
+    """
+    Send REPLCONF GETACK through the stream, so replicas answer with the
+    offset they reached just before it.
+    """
+    repl_state["getack_scheduled"] = False
+    repl_state["getack_offset"] = repl_state["master_repl_offset"]
+    write_to_slave(GETACK_COMMAND)
+
+
+async def wait_for_slaves(numreplicas, timeout, offset):
+    """
+    Wait until 'numreplicas' replicas acknowledged the replication stream
+    up to 'offset' (the end of the waiting client's last write), or until
+    'timeout' ms pass (0 waits forever).
+    Returns the number of replicas that acknowledged it.
+    """
+    if count_acks(offset) >= numreplicas:
+        return count_acks(offset)
+
+    waiter = (offset, numreplicas, asyncio.get_running_loop().create_future())
+    ack_waiters.append(waiter)
+    request_acks(offset)
+    try:
+        await asyncio.wait_for(waiter[2], timeout / 1000 if timeout > 0 else None)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        ack_waiters.remove(waiter)
+    return count_acks(offset)
 
 
 async def connect_to_master(host, port):
@@ -89,8 +372,8 @@ async def connect_to_master(host, port):
 
         if data == "PONG":
             # REPLCONF listening-port
-            resp = f"*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n$4\r\n{server_config['port']}\r\n"
-            writer.write(resp.encode())
+            port = str(server_config["port"] or 6379)
+            writer.write(encode_command([b"REPLCONF", b"listening-port", port]))
             await writer.drain()
 
             response = await reader.read(1024)
@@ -105,80 +388,200 @@ async def connect_to_master(host, port):
                 data, _ = parse_input(response)
 
                 if data == "OK":
-                    # PSYNC ? -1
-                    writer.write(b"*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n")
+                    # PSYNC <replid> <offset>, or PSYNC ? -1 without a previous sync
+                    if repl_state["synced"]:
+                        next_offset = str(repl_state["master_repl_offset"] + 1)
+                        writer.write(encode_command([b"PSYNC", repl_state["replid"], next_offset]))
+                    else:
+                        writer.write(b"*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n")
                     await writer.drain()
 
-                    response = await reader.read(4096)
-                    print(response)
-
-                    meta_pos = response.find(b'$')
-                    if meta_pos != -1:
-                        # Attempt to find R in "REDIS" header
-                        meta_pos += response[meta_pos:].find(b"R")
-                        meta = response[meta_pos:]
-                        header = meta[:9].decode('ascii')
-                        magic, version = header[:5], header[5:]
-                        print(f"Magic: {magic}, Version: {version}")
-
-                        if magic != "REDIS" or not version.isdigit():
-                            print("Invalid RDB header from master")
-                            return
-
-                        # We could parse initial RDB data here if needed.
-                        leftover_data = meta[9:]
-                        get_ack_offset = 0
-
-                        if leftover_data:
-                            unprocessed_part, _ = parse_input(leftover_data)
-                            if isinstance(unprocessed_part, list) and len(unprocessed_part) > 0:
-                                if unprocessed_part[0] == "REPLCONF":
-                                    resp = "*3\r\n$8\r\nREPLCONF\r\n$3\r\nACK\r\n$1\r\n0\r\n"
-                                    writer.write(resp.encode())
-                                    await writer.drain()
-
-                        print(get_ack_offset)
-
-                        # Keep reading subsequent replication commands
-                        from parsers import parse_input  # local import to avoid issues
-                        from globals import global_hashmap, expiry_hashmap
-                        import time
-
-                        while True:
-                            response = await reader.read(1024)
-                            get_ack_offset += len(response)
-                            print(response)
-
-                            if not response:
-                                print("Client (master) disconnected")
-                                writer.close()
-                                await writer.wait_closed()
-                                break
-
-                            result, buffer = parse_input(response)
-                            print(get_ack_offset)
-
-                            while result:
-                                print(result)
-                                if isinstance(result, list):
-                                    cmd = result[0].upper()
-                                    if cmd == "REPLCONF":
-                                        resp = (
-                                            f"*3\r\n$8\r\nREPLCONF\r\n$3\r\nACK\r\n"
-                                            f"${len(str(get_ack_offset))}\r\n{get_ack_offset}\r\n"
-                                        )
-                                        writer.write(resp.encode())
-                                        await writer.drain()
-
-                                    elif cmd == "SET":
-                                        global_hashmap[result[1]] = result[2]
-                                        if len(result) > 3 and result[3] == "px" and result[1] in global_hashmap:
-                                            expiry_hashmap[result[1]] = time.time() + (int(result[4]) / 1000)
-
-                                if buffer:
-                                    result, buffer = parse_input(buffer)
-                                else:
-                                    break
+                    line, buffer = await read_line(reader, b"")
+                    print(line.decode(errors="replace"))
+                    if line.startswith(b"+FULLRESYNC"):
+                        _, replid, offset = line.split()
+                        repl_state["synced"] = False
+                        buffer = await receive_rdb(reader, buffer)
+                        if server_config["appendonly"]:
+                            # The log must start over from the new dataset
+                            asyncio.create_task(rewrite_new_dataset())
+                        repl_state["replid"] = replid.decode()
+                        repl_state["master_repl_offset"] = int(offset)
+                        repl_state["synced"] = True
+                    elif line.startswith(b"+CONTINUE"):
+                        # Keep the dataset; the master sends what was missed
+                        parts = line.split()
+                        if len(parts) > 1:
+                            repl_state["replid"] = parts[1].decode()
+                    else:
+                        print("Unexpected PSYNC reply from master")
+                        return
+
+                    repl_state["link_up"] = True
+                    await replica_apply_loop(reader, writer, buffer)
 
     except Exception as e:
         print(f"Error connecting to master: {e}")
+    finally:
+        repl_state["link_up"] = False
+
+
+async def master_link_loop(host, port):
+    """
+    Keep a replica connected to its master, reconnecting after a lost link.
+    Reconnects ask for a partial resync from the last processed offset.
+    """
+    while True:
+        await connect_to_master(host, port)
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def read_line(reader, buffer):
+    """
+    Read from 'reader' until 'buffer' holds a CRLF-terminated line.
+    Returns (line, rest) with the CRLF stripped from 'line'.
+    """
+    while b"\r\n" not in buffer:
+        data = await reader.read(1024)
+        if not data:
+            raise ConnectionError("Master closed the connection")
+        buffer += data
+    line, _, rest = buffer.partition(b"\r\n")
+    return line, rest
+
+
+async def read_more(reader, buffer, target):
+    """
+    Read until 'buffer' is at least 'target' bytes long.
+    """
+    chunks, size = [buffer], len(buffer)
+    while size < target:
+        data = await reader.read(RDB_READ_SIZE)
+        if not data:
+            raise ConnectionError("Master closed the connection during sync")
+        chunks.append(data)
+        size += len(data)
+    return b"".join(chunks)
+
+
+async def receive_rdb(reader, buffer):
+    """
+    Load the snapshot that follows +FULLRESYNC while it is being received.
+    Both "$<length>" framing and the diskless "$EOF:<mark>" framing, where
+    the payload is followed by the 40-byte mark, are accepted. The current
+    dataset is replaced by the master's.
+    'buffer' holds bytes already read after the +FULLRESYNC line; returns
+    the bytes received after the payload (the start of the command stream).
+    """
+    line, buffer = await read_line(reader, buffer)
+    if not line.startswith(b"$"):
+        raise ValueError("Expected an RDB payload from master")
+    mark = line[5:] if line.startswith(b"$EOF:") else None
+
+    flush_keyspace(False)
+    expires = {}
+    started = time.perf_counter()
+    received = 0
+
+    buffer = await read_more(reader, buffer, 9)
+    check_rdb_header(buffer)
+    offset, done = 9, False
+    while True:
+        offset, done, needed = parse_rdb(buffer, offset, db["dict"], expires)
+        received += offset
+        buffer = buffer[offset:]
+        if done:
+            break
+        # Parse again only once the pending record can be complete, so a
+        # huge value is not re-copied on every read
+        buffer = await read_more(reader, buffer, max(needed - offset, len(buffer) + 1))
+        offset = 0
+
+    if mark is not None:
+        buffer = await read_more(reader, buffer, len(mark))
+        if buffer[:len(mark)] != mark:
+            raise ValueError("RDB payload from master does not end with the EOF mark")
+        buffer = buffer[len(mark):]
+
+    set_expiries(expires)
+    recount_memory()
+    index_keys()
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"Full resync: loaded {len(db['dict'])} keys ({received} bytes) in {elapsed:.3f} seconds")
+    return buffer
+
+
+async def replica_apply_loop(reader, writer, buffer):
+    """
+    Apply the replication stream sent by the master after the snapshot.
+    Every complete command in the buffer is applied before the next read,
+    and a command split across reads waits in the buffer until it is whole.
+    Write commands run through the same handlers as on the master; their
+    replies are dropped.
+    'master_repl_offset' advances by the exact size of each processed command.
+    """
+    buffer = bytearray(buffer)
+    parse_state = new_parse_state()
+    while True:
+        ends = []
+        commands, consumed = parse_commands(buffer, ends, parse_state)
+        del buffer[:consumed]
+        base_offset = repl_state["master_repl_offset"]
+
+        acked = False
+        discarded = []
+        for result, end in zip(commands, ends):
+            cmd = result[0].upper()
+            entry = COMMANDS.get(cmd)
+            if entry is not None and "write" in entry["flags"]:
+                try:
+                    entry["handler"](None, result, discarded)
+                except Exception as e:
+                    print(f"Error applying {entry['name']} from master: {e}")
+                else:
+                    if aof_state["fd"] is not None:
+                        feed_aof(encode_command(result))
+                discarded.clear()
+            elif cmd == b"REPLCONF" and len(result) > 1 and result[1].upper() == b"GETACK":
+                # The ACK covers everything before this GETACK
+                ack_offset = str(repl_state["master_repl_offset"])
+                writer.write(encode_command([b"REPLCONF", b"ACK", ack_offset]))
+                acked = True
+            repl_state["master_repl_offset"] = base_offset + end
+        if acked:
+            await writer.drain()
+
+        data = await reader.read(RDB_READ_SIZE)
+        if not data:
+            print("Client (master) disconnected")
+            writer.close()
+            await writer.wait_closed()
+            break
+        buffer += data
+
+
+def replication_info():
+    """
+    Build the text of INFO replication.
+    """
+    if server_config["replicaof"]:
+        host, port = server_config["replicaof"].split()
+        lines = [
+            "role:slave",
+            f"master_host:{host}",
+            f"master_port:{port}",
+            f"master_link_status:{'up' if repl_state['link_up'] else 'down'}",
+        ]
+    else:
+        lines = ["role:master", f"connected_slaves:{len(slaves)}"]
+
+    histlen = repl_state["backlog_histlen"]
+    lines += [
+        f"master_replid:{repl_state['replid']}",
+        f"master_repl_offset:{repl_state['master_repl_offset']}",
+        f"repl_backlog_active:{int(repl_state['backlog'] is not None)}",
+        f"repl_backlog_size:{server_config['repl_backlog_size']}",
+        f"repl_backlog_first_byte_offset:{repl_state['master_repl_offset'] - histlen + 1}",
+        f"repl_backlog_histlen:{histlen}",
+    ]
+    return "# Replication\r\n" + "\r\n".join(lines) + "\r\n"
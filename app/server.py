@@ -1,127 +1,1087 @@
 import asyncio
 import time
 
-from parsers import parse_input
-from replication import write_to_slave, slave_read_loop, wait_for_slaves
-from globals import global_hashmap, expiry_hashmap, slaves, server_config, slaves_write_count
-
-
-async def handle_client(reader, writer):
-    """
-    Handle an individual client connection.
-    """
-    while True:
-        data = await reader.read(1024)
-        if not data:
-            print("Client disconnected")
-            writer.close()
-            await writer.wait_closed()
-            break
-
-        result, _ = parse_input(data)
-        if not result:
-            continue
-
-        cmd = result[0].upper()
-
-        # ECHO
-        if cmd == "ECHO":
-            writer.write(f"+{result[1]}\r\n".encode())
-            await writer.drain()
-
-        # PING
-        elif cmd == "PING":
-            writer.write(b"+PONG\r\n")
-            await writer.drain()
-
-        # SET
-        elif cmd == "SET":
-            await write_to_slave(data)
-            global_hashmap[result[1]] = result[2]
-            writer.write(b"+OK\r\n")
-            await writer.drain()
-
-            # If expiration is set
-            if len(result) > 3 and result[3].lower() == "px" and result[1] in global_hashmap:
-                expiry_hashmap[result[1]] = time.time() + (int(result[4]) / 1000)
-
-        # GET
-        elif cmd == "GET":
-            if result[1] in global_hashmap:
-                now = time.time()
-                if (result[1] not in expiry_hashmap) or (expiry_hashmap[result[1]] > now):
-                    val = global_hashmap[result[1]]
-                    writer.write(f"${len(val)}\r\n{val}\r\n".encode())
-                else:
-                    # Key is expired
-                    writer.write(b"$-1\r\n")
-            else:
-                writer.write(b"$-1\r\n")
-            await writer.drain()
-
-        # CONFIG GET
-        elif cmd == "CONFIG" and result[1].upper() == "GET":
-            if result[2].lower() == "dir":
-                d = server_config["dir"] or ""
-                writer.write(f"*2\r\n$3\r\ndir\r\n${len(d)}\r\n{d}\r\n".encode())
-            elif result[2].lower() == "dbfilename":
-                db = server_config["dbfilename"] or ""
-                writer.write(f"*2\r\n$10\r\ndbfilename\r\n${len(db)}\r\n{db}\r\n".encode())
-            await writer.drain()
-
-        # KEYS
-        elif cmd == "KEYS":
-            if result[1] == "*":
-                keys = list(global_hashmap.keys())
-                resp = f"*{len(keys)}\r\n"
-                for k in keys:
-                    resp += f"${len(k)}\r\n{k}\r\n"
-                writer.write(resp.encode())
-                await writer.drain()
-
-        # INFO
-        elif cmd == "INFO":
-            if server_config["replicaof"]:
-                # Slave info
-                writer.write(b"$10\r\nrole:slave\r\n")
+from parsers import parse_commands, new_parse_state, encode_command, encode_bulk, encode_array, bulk_value
+from replication import propagate, slave_read_loop, wait_for_slaves, sync_replica, \
+    replication_info
+from expiry import expire_if_needed, reclaim_expired, active_expire_loop
+from keyspace import set_expiry, clear_expiry, store_value, remove_key, is_live, keys_matching, scan_keys, \
+    compile_pattern, flush_keyspace, SCAN_DEFAULT_COUNT
+from datatypes import Collection, WRONGTYPE, hash_get, hash_set, hash_delete, list_push, list_pop, \
+    list_range, set_add, set_remove, collection_items
+from pubsub import subscribe, unsubscribe, psubscribe, punsubscribe, unsubscribe_all, publish, \
+    subscription_count, encode_subscription
+from clients import client_ids, set_keepalive, format_addr, check_client_output, list_clients, \
+    parse_kill_filters, kill_clients, clients_cron_loop, clients_info
+from tracking import parse_tracking_options, enable_tracking, disable_tracking, track_keys, invalidate_key
+from eviction import free_memory, touch_key, memory_info
+from rdb import save, bgsave, rdb_save_loop
+from commands import COMMANDS, CommandError, command, record_call, encode_slowlog, \
+    reset_command_stats, commandstats_info, latencystats_info
+from aof import bgrewriteaof, fsync_aof, start_aof, aof_fsync_loop, persistence_info
+from shard import split_command, forward_command, merge_replies, open_shard_links, scan_shard_cursor, \
+    next_scan_cursor, forward_scan, key_positions
+from globals import db, rdb_state, memory_state, aof_state, repl_state, slowlog, shard_state, pubsub_channels, \
+    pubsub_patterns, clients, client_stats, tracking_table, tracking_prefix_lengths
+from config import server_config
+
+# Reply for a missing key.
+NULL_BULK = b"$-1\r\n"
+
+# Stop reading a client's commands while more than this many bytes of its
+# replies are waiting to be sent, until they are down to OUTPUT_LOW_WATER.
+OUTPUT_HIGH_WATER = 1024 * 1024
+OUTPUT_LOW_WATER = 256 * 1024
+
+# A long batch writes its replies once OUTPUT_CHUNK bytes of them are queued,
+# so output limits and backpressure apply in the middle of it.
+OUTPUT_CHUNK = OUTPUT_LOW_WATER
+
+# Number of entries returned by SLOWLOG GET without a count.
+SLOWLOG_DEFAULT_COUNT = 10
+
+
+class ClientConnection(asyncio.Protocol):
+    """
+    A client connection.
+    Incoming bytes are accumulated in a per-connection buffer, and every
+    complete command in it is executed right in data_received(), so
+    pipelined commands and values larger than a single read are handled
+    correctly. The replies of a batch are written together, synchronously,
+    once it has been processed.
+    A command that has to wait (a coroutine handler, a reply forwarded from
+    another shard, or an fsync with appendfsync always) moves the rest of
+    the batch to a task; reading is paused until it is done, so commands
+    still run and reply in order. So does a long batch whose client stops
+    reading its replies, until they drain.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.buffer = bytearray()
+        self.parse_state = new_parse_state()
+        self.out = []
+        # Task finishing a batch that had to wait, if any
+        self.waiting = None
+        self.write_paused = False
+        self.eof = False
+        # Set once the connection is handed over to replication
+        self.detached = False
+        # Pub/Sub subscriptions, and when pending output went over the soft limit
+        self.channels = set()
+        self.patterns = set()
+        self.soft_limit_since = None
+        # CLIENT TRACKING state, and the CLIENT CACHING answer for the next command
+        self.tracking = False
+        self.tracking_redirect = None
+        self.tracking_prefixes = []
+        self.tracking_optin = self.tracking_optout = False
+        self.caching = None
+        # Future resolved once the replies written are down to OUTPUT_LOW_WATER
+        self.drain_waiter = None
+        # For CLIENT LIST
+        self.id = next(client_ids)
+        self.addr = self.laddr = ""
+        self.name = b""
+        self.created = self.last_interaction = time.monotonic()
+        self.commands = 0
+        self.last_command = b"NULL"
+        # Replication offset just past the client's last write, for WAIT
+        self.woff = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if len(clients) >= server_config["maxclients"]:
+            client_stats["rejected_connections"] += 1
+            transport.write(b"-ERR max number of clients reached\r\n")
+            transport.close()
+            return
+        clients[self.id] = self
+        self.addr = format_addr(transport.get_extra_info("peername"))
+        self.laddr = format_addr(transport.get_extra_info("sockname"))
+        set_keepalive(transport.get_extra_info("socket"))
+        transport.set_write_buffer_limits(high=OUTPUT_HIGH_WATER, low=OUTPUT_LOW_WATER)
+
+    def connection_lost(self, exc):
+        if clients.pop(self.id, None) is None:
+            return
+        print("Client disconnected")
+        if self.channels or self.patterns:
+            unsubscribe_all(self)
+        if self.tracking:
+            disable_tracking(self)
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+
+    def eof_received(self):
+        # Keep the connection open until the replies of a waiting batch are out
+        self.eof = True
+        return self.waiting is not None
+
+    def pause_writing(self):
+        # The client is not reading its replies: stop reading its commands
+        self.write_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        if self.waiting is None:
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.buffer += data
+        self.last_interaction = time.monotonic()
+        if self.waiting is None:
+            self.process_buffer()
+
+    def process_buffer(self):
+        """
+        Run the complete commands in the buffer and write their replies.
+        """
+        try:
+            commands, consumed = parse_commands(self.buffer, state=self.parse_state)
+        except ValueError as e:
+            self.transport.write(f"-ERR {e}\r\n".encode())
+            self.transport.close()
+            return
+        del self.buffer[:consumed]
+        if not commands:
+            return
+        self.commands += len(commands)
+        self.last_command = commands[-1][0]
+
+        out = self.out
+        logged = aof_state["fed"]
+        queued = reply_bytes(out)
+        for index, result in enumerate(commands):
+            start = len(out)
+            pending = process_command(self, result, out)
+            if pending is not None:
+                self.wait_for(self.finish_batch(pending, commands[index + 1:], logged))
+                return
+            queued += reply_bytes(out, start)
+            if queued >= OUTPUT_CHUNK and self.replies_ready(logged):
+                queued = 0
+                if not self.write_replies():
+                    return
+                if self.write_paused:
+                    # The client is not reading: finish the batch once it does
+                    self.wait_for(self.finish_batch(self.drained(), commands[index + 1:], logged))
+                    return
+        if not self.replies_ready(logged):
+            self.wait_for(self.finish_batch(None, [], logged))
+            return
+        if out:
+            self.write_replies()
+
+    def replies_ready(self, logged):
+        """
+        Check that the queued replies can be written now: no write of the
+        batch (AOF offset 'logged' at its start) waits for an fsync with
+        appendfsync always, and in sharded mode no reply is still expected
+        from another worker.
+        """
+        return (aof_state["fed"] == logged or server_config["appendfsync"] != "always") and \
+            (shard_state["count"] == 1 or not any(isinstance(reply, asyncio.Future) for reply in self.out))
+
+    def write_replies(self):
+        """
+        Write the queued replies and enforce the client's output buffer
+        limits. Returns False if the client was disconnected.
+        """
+        self.transport.writelines(self.out)
+        self.out.clear()
+        return check_client_output(self)
+
+    def drained(self):
+        """
+        Return a future resolved once the client has read enough of its
+        replies for writing to resume (or has disconnected).
+        """
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+        if not self.write_paused or self.transport.is_closing():
+            self.drain_waiter.set_result(None)
+        return self.drain_waiter
+
+    def wait_for(self, batch):
+        """
+        Pause reading while the coroutine 'batch' finishes the current batch.
+        """
+        self.transport.pause_reading()
+        self.waiting = asyncio.ensure_future(batch)
+        self.waiting.add_done_callback(self.batch_done)
+
+    async def finish_batch(self, pending, commands, logged):
+        """
+        Finish a batch that had to wait: await the command that started
+        waiting ('pending', if any), run the rest of the batch the same way,
+        wait for the AOF fsync with appendfsync always, and write the replies.
+        """
+        if pending is not None and await pending is False:
+            return
+        queued = reply_bytes(self.out)
+        for result in commands:
+            if self.transport.is_closing():
+                return
+            start = len(self.out)
+            pending = process_command(self, result, self.out)
+            if pending is not None and await pending is False:
+                return
+            queued += reply_bytes(self.out, start)
+            if queued >= OUTPUT_CHUNK and (aof_state["fed"] == logged or server_config["appendfsync"] != "always"):
+                queued = 0
+                await self.flush()
+                if self.write_paused:
+                    await self.drained()
+        if aof_state["fed"] != logged and server_config["appendfsync"] == "always":
+            await fsync_aof(aof_state["fed"])
+        await self.flush()
+
+    def batch_done(self, task):
+        self.waiting = None
+        if task.cancelled() or self.detached:
+            return
+        if task.exception() is not None:
+            print(f"Error processing commands: {task.exception()!r}")
+            self.transport.close()
+        elif self.eof:
+            self.transport.close()
+        else:
+            if not self.write_paused:
+                self.transport.resume_reading()
+            if self.buffer:
+                self.process_buffer()
+
+    async def flush(self):
+        """
+        Write all queued replies with a single call and clear the queue.
+        In sharded mode the queue may hold futures of replies from other
+        workers; they are waited for in order.
+        """
+        out = self.out
+        for i, reply in enumerate(out):
+            if isinstance(reply, asyncio.Future):
+                out[i] = await reply
+        if out and not self.transport.is_closing():
+            self.transport.writelines(out)
+            check_client_output(self)
+        out.clear()
+
+    def detach(self):
+        """
+        Hand the connection over to stream-based code (replication), with
+        the bytes received but not processed yet.
+        Returns a (reader, writer) pair.
+        """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        self.detached = True
+        clients.pop(self.id, None)
+        self.transport.set_protocol(protocol)
+        protocol.connection_made(self.transport)
+        if self.buffer:
+            reader.feed_data(bytes(self.buffer))
+            self.buffer.clear()
+        self.transport.resume_reading()
+        return reader, asyncio.StreamWriter(self.transport, protocol, reader, loop)
+
+
+def reply_bytes(out, start=0):
+    """
+    Return the size of the replies queued in 'out' from index 'start' on.
+    Replies still expected from another worker are not counted.
+    """
+    return sum(len(reply) for reply in out[start:] if not isinstance(reply, asyncio.Future))
+
+
+def process_command(client, result, out, route=True):
+    """
+    Execute a single parsed command for a client.
+    The command is looked up in the registry, its arity checked, and the
+    time its handler takes is recorded for INFO commandstats, INFO
+    latencystats and SLOWLOG. In sharded mode, commands with keys of other
+    shards are routed to their workers first, unless 'route' is False or
+    the command comes from another worker.
+    Replies are appended to 'out' and written once the whole batch is done.
+    Returns None once the command is done. A command that has to wait
+    returns an awaitable finishing it instead, which yields False if the
+    connection should no longer be read as a client.
+    """
+    entry = COMMANDS.get(result[0].upper())
+    if entry is None:
+        name = result[0].decode(errors="replace")
+        out.append(f"-ERR unknown command '{name}'\r\n".encode())
+        return None
+    arity = entry["arity"]
+    if len(result) != arity if arity >= 0 else len(result) < -arity:
+        entry["stats"]["rejected_calls"] += 1
+        out.append(f"-ERR wrong number of arguments for '{entry['name']}' command\r\n".encode())
+        return None
+
+    if client is not None and (client.channels or client.patterns) and "pubsub" not in entry["flags"]:
+        out.append(f"-ERR Can't execute '{entry['name']}': only (P)SUBSCRIBE / (P)UNSUBSCRIBE / PING "
+                   f"are allowed in this context\r\n".encode())
+        return None
+
+    if entry["sharded"] and route and shard_state["count"] > 1 and client not in shard_state["peer_clients"]:
+        return process_sharded(client, entry, result, out)
+
+    if entry["denyoom"] and server_config["maxmemory"] and not free_memory():
+        entry["stats"]["rejected_calls"] += 1
+        out.append(b"-OOM command not allowed when used memory > 'maxmemory'.\r\n")
+        return None
+
+    if entry["is_async"]:
+        return process_async_command(client, entry, result, out)
+
+    start = time.perf_counter_ns()
+    try:
+        entry["handler"](client, result, out)
+    except (CommandError, ValueError) as e:
+        command_failed(entry, e, out)
+        return None
+
+    if entry["replicate"]:
+        propagate(encode_command(result))
+        if client is not None:
+            client.woff = repl_state["master_repl_offset"]
+    elif client is not None and client.tracking and entry["first_key"] and "readonly" in entry["flags"]:
+        track_keys(client, [result[i] for i in key_positions(entry, result)])
+    record_call(entry, result, (time.perf_counter_ns() - start) // 1000)
+    return None
+
+
+async def process_async_command(client, entry, result, out):
+    """
+    Execute a command whose handler is a coroutine, like process_command().
+    Returns False if the connection should no longer be read as a client.
+    """
+    start = time.perf_counter_ns()
+    try:
+        keep_reading = await entry["handler"](client, result, out)
+    except (CommandError, ValueError) as e:
+        command_failed(entry, e, out)
+        return True
+
+    if entry["replicate"]:
+        propagate(encode_command(result))
+        if client is not None:
+            client.woff = repl_state["master_repl_offset"]
+    record_call(entry, result, (time.perf_counter_ns() - start) // 1000)
+    return keep_reading is not False
+
+
+def command_failed(entry, error, out):
+    """
+    Reply with the error raised by a command handler.
+    """
+    entry["stats"]["failed_calls"] += 1
+    if isinstance(error, CommandError):
+        out.append(f"-{error}\r\n".encode())
+    else:
+        out.append(b"-ERR value is not an integer or out of range\r\n")
+
+
+def process_sharded(client, entry, result, out):
+    """
+    Run a command whose keys may belong to other workers' shards.
+    Each shard involved gets the part of the command holding its keys (or
+    the whole command, for allshards commands). This worker's part runs
+    right away, the others are forwarded, and the reply merged from all of
+    them is queued as a future in place of the command's reply.
+    Returns None or an awaitable, like process_command().
+    """
+    parts = split_command(entry, result)
+    local = parts.pop(shard_state["index"], None)
+    if not parts:
+        return process_command(client, result, out, route=False)
+    if entry["merge"] is None and (local is not None or len(parts) > 1):
+        entry["stats"]["rejected_calls"] += 1
+        out.append(b"-CROSSSLOT Keys in request don't hash to the same shard\r\n")
+        return None
+
+    replies = {shard: forward_command(shard, args) for shard, args in parts.items()}
+    if local is None:
+        out.append(replies.popitem()[1] if len(replies) == 1 else
+                   asyncio.ensure_future(merge_replies(entry, result, replies)))
+        return None
+
+    local_out = []
+    pending = process_command(client, local, local_out, route=False)
+    if pending is None:
+        replies[shard_state["index"]] = b"".join(local_out)
+        out.append(asyncio.ensure_future(merge_replies(entry, result, replies)))
+        return None
+
+    async def finish_local():
+        await pending
+        replies[shard_state["index"]] = b"".join(local_out)
+        out.append(asyncio.ensure_future(merge_replies(entry, result, replies)))
+    return finish_local()
+
+
+@command("ECHO", 2, "readonly")
+def echo_command(client, result, out):
+    out.append(encode_bulk(result[1]))
+
+
+@command("PING", -1, "pubsub")
+def ping_command(client, result, out):
+    if client is not None and (client.channels or client.patterns):
+        # Subscribers get the reply in the form of a message
+        out.append(encode_array([b"pong", result[1] if len(result) > 1 else b""]))
+    else:
+        out.append(b"+PONG\r\n")
+
+
+@command("SET", -3, "write", "replicate", "denyoom", first_key=1, last_key=1)
+def set_command(client, result, out):
+    # A plain SET discards any previous expiration
+    expire_ms = None
+    keep_ttl = False
+    condition = None
+    i = 3
+    while i < len(result):
+        option = result[i].upper()
+        if option in (b"NX", b"XX") and condition is None:
+            condition = option
+        elif option == b"KEEPTTL" and expire_ms is None:
+            keep_ttl = True
+        elif option in (b"EX", b"PX", b"EXAT", b"PXAT") and expire_ms is None and not keep_ttl and \
+                i + 1 < len(result):
+            i += 1
+            amount = int(result[i])
+            if amount <= 0:
+                raise CommandError("ERR invalid expire time in 'set' command")
+            if option in (b"EX", b"EXAT"):
+                amount *= 1000
+            expire_ms = int(time.time() * 1000) + amount if option in (b"EX", b"PX") else amount
+        else:
+            raise CommandError("ERR syntax error")
+        i += 1
+
+    # Replicas and the AOF get the absolute time, so replaying the command
+    # later does not extend the key's life
+    if expire_ms is not None:
+        result[3:] = [b"PXAT", b"%d" % expire_ms] + ([condition] if condition else [])
+    if condition is not None or keep_ttl:
+        # An expired key does not exist, and its expiration is not kept
+        exists = result[1] in db["dict"] and not expire_if_needed(result[1])
+        if condition is not None and exists != (condition == b"XX"):
+            out.append(NULL_BULK)
+            return
+
+    store_value(result[1], encode_bulk(result[2]))
+    if memory_state["track_access"]:
+        touch_key(result[1])
+    rdb_state["changes"] += 1
+    out.append(b"+OK\r\n")
+    if expire_ms is not None:
+        set_expiry(result[1], expire_ms / 1000)
+    elif not keep_ttl:
+        clear_expiry(result[1])
+
+
+@command("GET", 2, "readonly", first_key=1, last_key=1)
+def get_command(client, result, out):
+    # Values are stored as ready-made bulk replies
+    reply = db["dict"].get(result[1])
+    if reply is None:
+        out.append(NULL_BULK)
+    elif result[1] in db["expires"] and expire_if_needed(result[1]):
+        # Key is expired
+        out.append(NULL_BULK)
+    elif isinstance(reply, Collection):
+        raise CommandError(WRONGTYPE)
+    else:
+        out.append(reply)
+        if memory_state["track_access"]:
+            touch_key(result[1])
+
+
+@command("MGET", -2, "readonly", first_key=1, last_key=-1, merge="concat")
+def mget_command(client, result, out):
+    # One pass over the keys; the reply is built as a single buffer
+    now = time.time()
+    get, expiries = db["dict"].get, db["expires"]
+    track_access = memory_state["track_access"]
+    parts = [b"*%d\r\n" % (len(result) - 1)]
+    expired = []
+    for key in result[1:]:
+        reply = get(key)
+        if reply is None:
+            parts.append(NULL_BULK)
+        elif key in expiries and expiries[key] <= now:
+            expired.append(key)
+            parts.append(NULL_BULK)
+        elif isinstance(reply, Collection):
+            parts.append(NULL_BULK)
+        else:
+            parts.append(reply)
+            if track_access:
+                touch_key(key)
+    if expired:
+        reclaim_expired(expired)
+    out.append(b"".join(parts))
+
+
+@command("MSET", -3, "write", "replicate", "denyoom", first_key=1, last_key=-1, key_step=2,
+         merge="all_succeeded")
+def mset_command(client, result, out):
+    if len(result) % 2 == 0:
+        raise CommandError("ERR wrong number of arguments for 'mset' command")
+    keys = result[1::2]
+    for key, value in zip(keys, result[2::2]):
+        store_value(key, encode_bulk(value))
+    if db["expires"]:
+        for key in keys:
+            clear_expiry(key)
+    if memory_state["track_access"]:
+        for key in keys:
+            touch_key(key)
+    rdb_state["changes"] += len(keys)
+    out.append(b"+OK\r\n")
+
+
+@command("EXISTS", -2, "readonly", first_key=1, last_key=-1, merge="sum")
+def exists_command(client, result, out):
+    # A key named several times is counted each time
+    now = time.time()
+    expiries = db["expires"]
+    count = 0
+    expired = []
+    for key in result[1:]:
+        if key in db["dict"]:
+            if key in expiries and expiries[key] <= now:
+                expired.append(key)
             else:
-                # Master info
-                writer.write(
-                    b"$87\r\nrole:master:master_replid:8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb:master_repl_offset:0\r\n"
-                )
-            await writer.drain()
-
-        # REPLCONF
-        elif cmd == "REPLCONF":
-            writer.write(b"+OK\r\n")
-            await writer.drain()
-            if result[1].lower() == "listening-port" and len(result) > 2:
-                slaves[(reader, writer)] = 1
-
-        # PSYNC
-        elif cmd == "PSYNC":
-            # Full sync scenario
-            writer.write(b"+FULLRESYNC 8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb 0\r\n")
-            await writer.drain()
-
-            # Sample RDB payload
-            resp = b"$88\r\n"
-            resp += bytes.fromhex(
-                "524544495330303131fa0972656469732d76657205372e322e30fa0a72656469732d62697473c040"
-                "fa056374696d65c26d08bc65fa08757365642d6d656dc2b0c41000fa08616f662d62617365c000fff06e"
-                "3bfec0ff5aa2"
-            )
-            writer.write(resp)
-            await writer.drain()
-
-            asyncio.create_task(slave_read_loop(reader, writer))
-            break
-
-        # WAIT
-        elif cmd == "WAIT":
-            await wait_for_slaves(int(result[1]), int(result[2]))
-            writer.write(f":{slaves_write_count}\r\n".encode())
-            await writer.drain()
+                count += 1
+    if expired:
+        reclaim_expired(expired)
+    out.append(b":%d\r\n" % count)
+
+
+@command("DEL", -2, "write", "replicate", first_key=1, last_key=-1, merge="sum")
+@command("UNLINK", -2, "write", "replicate", first_key=1, last_key=-1, merge="sum")
+def del_command(client, result, out):
+    # Also sent by the master for expired keys. UNLINK frees large values in
+    # the background; DEL does too with --lazyfree-lazy-user-del
+    lazy = server_config["lazyfree_lazy_user_del"] or result[0].upper() == b"UNLINK"
+    now = time.time()
+    deleted = 0
+    for key in result[1:]:
+        if key in db["dict"]:
+            deleted += is_live(key, now)
+            remove_key(key, lazy)
+    rdb_state["changes"] += deleted
+    out.append(b":%d\r\n" % deleted)
+
+
+def lookup_collection(key, kind):
+    """
+    Return the collection of type 'kind' stored at 'key', or None if the key
+    does not exist. Raises CommandError if it holds another type.
+    """
+    value = db["dict"].get(key)
+    if value is None or (key in db["expires"] and expire_if_needed(key)):
+        return None
+    if not isinstance(value, Collection) or value.type != kind:
+        raise CommandError(WRONGTYPE)
+    if memory_state["track_access"]:
+        touch_key(key)
+    return value
+
+
+def writable_collection(key, kind):
+    """
+    Return the collection of type 'kind' stored at 'key', creating an empty
+    one if the key does not exist.
+    """
+    value = lookup_collection(key, kind)
+    if value is None:
+        value = Collection(kind)
+        store_value(key, value)
+    return value
+
+
+def collection_changed(key, value, size_before, changes):
+    """
+    Account for a write to the collection at 'key', whose size was
+    'size_before'. A collection left empty is deleted, as in Redis.
+    """
+    memory_state["used"] += value.size - size_before
+    rdb_state["changes"] += changes
+    if not value.items:
+        remove_key(key)
+    elif tracking_table or tracking_prefix_lengths:
+        invalidate_key(key)
+
+
+@command("HSET", -4, "write", "replicate", "denyoom", first_key=1, last_key=1)
+def hset_command(client, result, out):
+    if len(result) % 2:
+        raise CommandError("ERR wrong number of arguments for 'hset' command")
+    value = writable_collection(result[1], "hash")
+    size_before = value.size
+    added = 0
+    for field, field_value in zip(result[2::2], result[3::2]):
+        added += hash_set(value, field, field_value)
+    collection_changed(result[1], value, size_before, 1)
+    out.append(b":%d\r\n" % added)
+
+
+@command("HGET", 3, "readonly", first_key=1, last_key=1)
+def hget_command(client, result, out):
+    value = lookup_collection(result[1], "hash")
+    field_value = hash_get(value, result[2]) if value is not None else None
+    out.append(NULL_BULK if field_value is None else encode_bulk(field_value))
+
+
+@command("HGETALL", 2, "readonly", first_key=1, last_key=1)
+def hgetall_command(client, result, out):
+    value = lookup_collection(result[1], "hash")
+    out.append(encode_array(collection_items(value) if value is not None else []))
+
+
+@command("HDEL", -3, "write", "replicate", first_key=1, last_key=1)
+def hdel_command(client, result, out):
+    value = lookup_collection(result[1], "hash")
+    deleted = 0
+    if value is not None:
+        size_before = value.size
+        for field in result[2:]:
+            deleted += hash_delete(value, field)
+        collection_changed(result[1], value, size_before, deleted)
+    out.append(b":%d\r\n" % deleted)
+
+
+@command("LPUSH", -3, "write", "replicate", "denyoom", first_key=1, last_key=1)
+@command("RPUSH", -3, "write", "replicate", "denyoom", first_key=1, last_key=1)
+def push_command(client, result, out):
+    value = writable_collection(result[1], "list")
+    size_before = value.size
+    length = list_push(value, result[2:], left=result[0].upper() == b"LPUSH")
+    collection_changed(result[1], value, size_before, 1)
+    out.append(b":%d\r\n" % length)
+
+
+@command("LPOP", 2, "write", "replicate", first_key=1, last_key=1)
+@command("RPOP", 2, "write", "replicate", first_key=1, last_key=1)
+def pop_command(client, result, out):
+    value = lookup_collection(result[1], "list")
+    if value is None:
+        out.append(NULL_BULK)
+        return
+    size_before = value.size
+    element = list_pop(value, left=result[0].upper() == b"LPOP")
+    collection_changed(result[1], value, size_before, 1)
+    out.append(encode_bulk(element))
+
+
+@command("LRANGE", 4, "readonly", first_key=1, last_key=1)
+def lrange_command(client, result, out):
+    try:
+        start, stop = int(result[2]), int(result[3])
+    except ValueError:
+        raise CommandError("ERR value is not an integer or out of range")
+    value = lookup_collection(result[1], "list")
+    out.append(encode_array(list_range(value, start, stop) if value is not None else []))
+
+
+@command("SADD", -3, "write", "replicate", "denyoom", first_key=1, last_key=1)
+def sadd_command(client, result, out):
+    value = writable_collection(result[1], "set")
+    size_before = value.size
+    added = 0
+    for member in result[2:]:
+        added += set_add(value, member)
+    collection_changed(result[1], value, size_before, added)
+    out.append(b":%d\r\n" % added)
+
+
+@command("SREM", -3, "write", "replicate", first_key=1, last_key=1)
+def srem_command(client, result, out):
+    value = lookup_collection(result[1], "set")
+    removed = 0
+    if value is not None:
+        size_before = value.size
+        for member in result[2:]:
+            removed += set_remove(value, member)
+        collection_changed(result[1], value, size_before, removed)
+    out.append(b":%d\r\n" % removed)
+
+
+@command("SMEMBERS", 2, "readonly", first_key=1, last_key=1)
+def smembers_command(client, result, out):
+    value = lookup_collection(result[1], "set")
+    out.append(encode_array(collection_items(value) if value is not None else []))
+
+
+@command("SISMEMBER", 3, "readonly", first_key=1, last_key=1)
+def sismember_command(client, result, out):
+    value = lookup_collection(result[1], "set")
+    out.append(b":1\r\n" if value is not None and result[2] in value.items else b":0\r\n")
+
+
+@command("TYPE", 2, "readonly", first_key=1, last_key=1)
+def type_command(client, result, out):
+    value = db["dict"].get(result[1])
+    if value is None or (result[1] in db["expires"] and expire_if_needed(result[1])):
+        out.append(b"+none\r\n")
+    elif isinstance(value, Collection):
+        out.append(b"+%s\r\n" % value.type.encode())
+    else:
+        out.append(b"+string\r\n")
+
+
+@command("OBJECT", 3, "readonly", first_key=2, last_key=2)
+def object_command(client, result, out):
+    if result[1].upper() != b"ENCODING":
+        raise CommandError("ERR unknown subcommand or wrong number of arguments for 'object' command")
+    value = db["dict"].get(result[2])
+    if value is None or (result[2] in db["expires"] and expire_if_needed(result[2])):
+        out.append(NULL_BULK)
+    elif isinstance(value, Collection):
+        out.append(encode_bulk(value.encoding.encode()))
+    else:
+        # Redis' string encodings: integers, short strings and the rest
+        string = bulk_value(value)
+        if string.lstrip(b"-").isdigit() and len(string) < 20:
+            encoding = b"int"
+        else:
+            encoding = b"embstr" if len(string) <= 44 else b"raw"
+        out.append(encode_bulk(encoding))
+
+
+@command("SUBSCRIBE", -2, "pubsub")
+@command("PSUBSCRIBE", -2, "pubsub")
+def subscribe_command(client, result, out):
+    if client is None:
+        return
+    pattern = result[0].upper() == b"PSUBSCRIBE"
+    kind = b"psubscribe" if pattern else b"subscribe"
+    if pattern:
+        # Check every pattern before subscribing to any
+        try:
+            for name in result[1:]:
+                compile_pattern(name)
+        except ValueError as e:
+            raise CommandError(f"ERR {e}")
+    for name in result[1:]:
+        if pattern:
+            psubscribe(client, name)
+        else:
+            subscribe(client, name)
+        out.append(encode_subscription(kind, name, subscription_count(client)))
+
+
+@command("UNSUBSCRIBE", -1, "pubsub")
+@command("PUNSUBSCRIBE", -1, "pubsub")
+def unsubscribe_command(client, result, out):
+    if client is None:
+        return
+    pattern = result[0].upper() == b"PUNSUBSCRIBE"
+    kind = b"punsubscribe" if pattern else b"unsubscribe"
+    # Without arguments, from every channel (or pattern)
+    names = result[1:] or sorted(client.patterns if pattern else client.channels)
+    if not names:
+        out.append(encode_subscription(kind, None, subscription_count(client)))
+    for name in names:
+        if pattern:
+            punsubscribe(client, name)
+        else:
+            unsubscribe(client, name)
+        out.append(encode_subscription(kind, name, subscription_count(client)))
+
+
+@command("PUBLISH", 3, "allshards", merge="sum")
+def publish_command(client, result, out):
+    # In sharded mode every worker sends it to its own subscribers
+    out.append(b":%d\r\n" % publish(result[1], result[2]))
+
+
+@command("PUBSUB", -2)
+def pubsub_command(client, result, out):
+    subcommand = result[1].upper()
+    if subcommand == b"CHANNELS" and len(result) <= 3:
+        channels = list(pubsub_channels)
+        if len(result) == 3:
+            try:
+                match = compile_pattern(result[2]).match
+            except ValueError as e:
+                raise CommandError(f"ERR {e}")
+            channels = [channel for channel in channels if match(channel)]
+        out.append(encode_array(channels))
+    elif subcommand == b"NUMSUB":
+        parts = [b"*%d\r\n" % (2 * (len(result) - 2))]
+        for channel in result[2:]:
+            parts.append(encode_bulk(channel) + b":%d\r\n" % len(pubsub_channels.get(channel, ())))
+        out.append(b"".join(parts))
+    elif subcommand == b"NUMPAT" and len(result) == 2:
+        out.append(b":%d\r\n" % len(pubsub_patterns))
+    else:
+        raise CommandError("ERR unknown subcommand or wrong number of arguments for 'pubsub' command")
+
+
+@command("CLIENT", -2)
+def client_command(client, result, out):
+    subcommand = result[1].upper()
+    if subcommand == b"LIST" and len(result) == 2:
+        out.append(encode_bulk(list_clients().encode()))
+    elif subcommand == b"ID" and len(result) == 2 and client is not None:
+        out.append(b":%d\r\n" % client.id)
+    elif subcommand == b"SETNAME" and len(result) == 3 and client is not None:
+        if b" " in result[2] or b"\n" in result[2]:
+            raise CommandError("ERR Client names cannot contain spaces, newlines or special characters.")
+        client.name = result[2]
+        out.append(b"+OK\r\n")
+    elif subcommand == b"GETNAME" and len(result) == 2 and client is not None:
+        out.append(encode_bulk(client.name) if client.name else NULL_BULK)
+    elif subcommand == b"KILL" and len(result) == 3:
+        # Old form: CLIENT KILL <addr>
+        if not kill_clients(client, {"skipme": False, "addr": result[2].decode(errors="replace")}):
+            raise CommandError("ERR No such client")
+        out.append(b"+OK\r\n")
+    elif subcommand == b"KILL" and len(result) > 3:
+        try:
+            filters = parse_kill_filters(result[2:])
+        except ValueError as e:
+            raise CommandError(f"ERR {e}")
+        out.append(b":%d\r\n" % kill_clients(client, filters))
+    elif subcommand == b"TRACKING" and len(result) >= 3 and client is not None:
+        client_tracking(client, result[2].upper(), result[3:])
+        out.append(b"+OK\r\n")
+    elif subcommand == b"CACHING" and len(result) == 3 and client is not None:
+        answer = result[2].lower()
+        if answer not in (b"yes", b"no"):
+            raise CommandError("ERR syntax error")
+        if client.tracking_optin and answer == b"yes" or client.tracking_optout and answer == b"no":
+            client.caching = answer == b"yes"
+        elif not client.tracking:
+            raise CommandError("ERR CLIENT CACHING can be called only when the client is in tracking mode "
+                               "with OPTIN or OPTOUT mode enabled")
+        else:
+            raise CommandError("ERR CLIENT CACHING yes is only valid when tracking is enabled in OPTIN mode"
+                               if answer == b"yes" else
+                               "ERR CLIENT CACHING no is only valid when tracking is enabled in OPTOUT mode")
+        out.append(b"+OK\r\n")
+    elif subcommand == b"GETREDIR" and len(result) == 2 and client is not None:
+        if not client.tracking:
+            out.append(b":-1\r\n")
+        else:
+            out.append(b":%d\r\n" % (client.tracking_redirect or 0))
+    else:
+        raise CommandError("ERR unknown subcommand or wrong number of arguments for 'client' command")
+
+
+def client_tracking(client, mode, args):
+    """
+    Turn CLIENT TRACKING on or off for a client. Keys are tracked by the
+    worker that owns them, so tracking is refused in sharded mode.
+    """
+    if mode == b"OFF" and not args:
+        disable_tracking(client)
+    elif mode == b"ON":
+        if shard_state["count"] > 1:
+            raise CommandError("ERR CLIENT TRACKING is not supported in sharded mode")
+        try:
+            enable_tracking(client, parse_tracking_options(args))
+        except ValueError as e:
+            raise CommandError(f"ERR {e}")
+    else:
+        raise CommandError("ERR syntax error")
+
+
+@command("FLUSHALL", -1, "write", "replicate", "allshards", merge="all_succeeded")
+@command("FLUSHDB", -1, "write", "replicate", "allshards", merge="all_succeeded")
+def flushall_command(client, result, out):
+    # There is a single database, so FLUSHDB is FLUSHALL
+    if len(result) > 2:
+        raise CommandError("ERR syntax error")
+    mode = result[1].upper() if len(result) == 2 else None
+    if mode not in (None, b"ASYNC", b"SYNC"):
+        raise CommandError("ERR syntax error")
+    lazy = mode == b"ASYNC" or mode is None and server_config["lazyfree_lazy_user_flush"]
+    rdb_state["changes"] += flush_keyspace(lazy)
+    out.append(b"+OK\r\n")
+
+
+@command("CONFIG", -2)
+def config_command(client, result, out):
+    subcommand = result[1].upper()
+    if subcommand == b"GET" and len(result) == 3:
+        if result[2].lower() == b"dir":
+            d = server_config["dir"] or ""
+            out.append(f"*2\r\n$3\r\ndir\r\n${len(d)}\r\n{d}\r\n".encode())
+        elif result[2].lower() == b"dbfilename":
+            db = server_config["dbfilename"] or ""
+            out.append(f"*2\r\n$10\r\ndbfilename\r\n${len(db)}\r\n{db}\r\n".encode())
+        elif result[2].lower() == b"save":
+            rules = (server_config["save"] or "").encode()
+            out.append(encode_array([b"save", rules]))
+        elif result[2].lower() == b"maxmemory":
+            out.append(encode_array([b"maxmemory", b"%d" % server_config["maxmemory"]]))
+        elif result[2].lower() == b"maxmemory-policy":
+            out.append(encode_array([b"maxmemory-policy", server_config["maxmemory_policy"].encode()]))
+        else:
+            out.append(b"*0\r\n")
+    elif subcommand == b"RESETSTAT" and len(result) == 2:
+        reset_command_stats()
+        out.append(b"+OK\r\n")
+    else:
+        raise CommandError("ERR unknown CONFIG subcommand or wrong number of arguments")
+
+
+@command("KEYS", 2, "readonly", "allshards", merge="concat")
+def keys_command(client, result, out):
+    try:
+        keys = keys_matching(result[1])
+    except ValueError as e:
+        raise CommandError(f"ERR {e}")
+    out.append(encode_array(keys))
+
+
+@command("SCAN", -2, "readonly")
+def scan_command(client, result, out):
+    pattern, count = None, SCAN_DEFAULT_COUNT
+    if len(result) % 2:
+        raise CommandError("ERR syntax error")
+    for option, value in zip(result[2::2], result[3::2]):
+        option = option.upper()
+        if option == b"MATCH":
+            pattern = value
+        elif option == b"COUNT":
+            count = int(value)
+            if count < 1:
+                raise CommandError("ERR syntax error")
+        else:
+            raise CommandError("ERR syntax error")
+    if pattern is not None:
+        try:
+            compile_pattern(pattern)
+        except ValueError as e:
+            raise CommandError(f"ERR {e}")
+    try:
+        cursor = int(result[1])
+        if cursor < 0:
+            raise ValueError
+    except ValueError:
+        raise CommandError("ERR invalid cursor")
+    # In sharded mode the shards are walked one after the other
+    sharded = shard_state["count"] > 1 and client not in shard_state["peer_clients"]
+    if sharded:
+        shard, cursor = scan_shard_cursor(cursor)
+        if shard != shard_state["index"]:
+            out.append(asyncio.ensure_future(forward_scan(shard, [b"SCAN", b"%d" % cursor, *result[2:]])))
+            return
+    cursor, keys = scan_keys(cursor, pattern, count)
+    if sharded:
+        cursor = next_scan_cursor(shard, cursor)
+    out.append(b"*2\r\n" + encode_bulk(b"%d" % cursor) + encode_array(keys))
+
+
+@command("SAVE", 1, "allshards", merge="all_succeeded")
+def save_command(client, result, out):
+    if rdb_state["bgsave_pid"] is not None:
+        raise CommandError("ERR Background save already in progress")
+    try:
+        save()
+    except OSError as e:
+        raise CommandError(f"ERR {e}")
+    out.append(b"+OK\r\n")
+
+
+@command("BGSAVE", 1, "allshards", merge="all_succeeded")
+async def bgsave_command(client, result, out):
+    if not await bgsave():
+        raise CommandError("ERR Background save already in progress")
+    out.append(b"+Background saving started\r\n")
+
+
+@command("BGREWRITEAOF", 1, "allshards", merge="all_succeeded")
+async def bgrewriteaof_command(client, result, out):
+    if not server_config["appendonly"]:
+        raise CommandError("ERR AOF is turned off")
+    if not await bgrewriteaof():
+        raise CommandError("ERR Background append only file rewriting already in progress")
+    out.append(b"+Background append only file rewriting started\r\n")
+
+
+@command("LASTSAVE", 1)
+def lastsave_command(client, result, out):
+    out.append(b":%d\r\n" % rdb_state["last_save"])
+
+
+@command("INFO", -1)
+def info_command(client, result, out):
+    sections = [section.lower() for section in result[1:]] or [b"replication"]
+    if b"all" in sections or b"everything" in sections:
+        sections = list(INFO_SECTIONS)
+    text = "\r\n".join(INFO_SECTIONS[section]() for section in sections if section in INFO_SECTIONS)
+    out.append(encode_bulk(text.encode()))
+
+
+@command("SLOWLOG", -2)
+def slowlog_command(client, result, out):
+    subcommand = result[1].upper()
+    if subcommand == b"GET" and len(result) <= 3:
+        count = int(result[2]) if len(result) == 3 else SLOWLOG_DEFAULT_COUNT
+        out.append(encode_slowlog(len(slowlog) if count < 0 else count))
+    elif subcommand == b"LEN" and len(result) == 2:
+        out.append(b":%d\r\n" % len(slowlog))
+    elif subcommand == b"RESET" and len(result) == 2:
+        slowlog.clear()
+        out.append(b"+OK\r\n")
+    else:
+        raise CommandError("ERR unknown SLOWLOG subcommand or wrong number of arguments")
+
+
+@command("REPLCONF", -1)
+def replconf_command(client, result, out):
+    out.append(b"+OK\r\n")
+
+
+@command("PSYNC", 3, "blocking")
+async def psync_command(client, result, out):
+    if shard_state["count"] > 1:
+        raise CommandError("ERR replication is not supported with --workers")
+    await client.flush()
+
+    # Partial or full resync, then hand the connection to replication
+    reader, writer = client.detach()
+    try:
+        await sync_replica(reader, writer, result[1], result[2])
+    except Exception as e:
+        print(f"Error during resync: {e}")
+        writer.close()
+        return False
+    asyncio.create_task(slave_read_loop(reader, writer))
+    return False
+
+
+@command("WAIT", 3, "blocking")
+async def wait_command(client, result, out):
+    # Don't hold earlier replies back while blocking
+    numreplicas, timeout = int(result[1]), int(result[2])
+    if timeout < 0:
+        raise CommandError("ERR timeout is negative")
+    await client.flush()
+    acked = await wait_for_slaves(numreplicas, timeout, client.woff)
+    out.append(b":%d\r\n" % acked)
+
+
+# INFO section name -> function building its text.
+INFO_SECTIONS = {
+    b"clients": clients_info,
+    b"replication": replication_info,
+    b"memory": memory_info,
+    b"persistence": persistence_info,
+    b"commandstats": commandstats_info,
+    b"latencystats": latencystats_info
+}
 
 
 async def start_server():
@@ -132,13 +1092,29 @@ async def start_server():
     if server_config["port"]:
         port = int(server_config["port"])
 
-    srv = await asyncio.start_server(handle_client, "localhost", port)
+    # Workers all listen on the port, the kernel spreads connections among them
+    sharded = shard_state["count"] > 1
+    loop = asyncio.get_running_loop()
+    srv = await loop.create_server(ClientConnection, "localhost", port, reuse_port=sharded)
     address = srv.sockets[0].getsockname()
-    print(f"Server running on {address}")
+    if sharded:
+        await open_shard_links(ClientConnection)
+        print(f"Server running on {address} (shard {shard_state['index']} of {shard_state['count']})")
+    else:
+        print(f"Server running on {address}")
 
     async with srv:
+        asyncio.create_task(rdb_save_loop())
+        asyncio.create_task(clients_cron_loop())
+        if server_config["appendonly"]:
+            start_aof()
+            if server_config["appendfsync"] == "everysec":
+                asyncio.create_task(aof_fsync_loop())
         if server_config["replicaof"]:
-            from replication import connect_to_master
+            from replication import master_link_loop
             host, master_port = server_config["replicaof"].split()
-            asyncio.create_task(connect_to_master(host, int(master_port)))
+            asyncio.create_task(master_link_loop(host, int(master_port)))
+        else:
+            # Replicas leave expiry to the master, which sends explicit DELs
+            asyncio.create_task(active_expire_loop())
         await srv.serve_forever()
@@ -0,0 +1,323 @@
+import asyncio
+import os
+import signal
+import socket
+import sys
+import zlib
+from collections import deque
+
+from parsers import split_replies, encode_command, encode_bulk
+from keyspace import remove_key
+from aof import write_aof_buffer
+from globals import db, shard_state, clients
+from config import server_config
+
+# Reply to forwarded commands once the worker owning their shard is gone.
+SHARD_DOWN_REPLY = b"-ERR shard unavailable\r\n"
+
+
+def shard_of(key):
+    """
+    Return the index of the shard owning 'key'.
+    CRC32 is used rather than hash(), as bytes hashes differ between runs
+    and the persisted shard files must keep their keys.
+    """
+    return zlib.crc32(key) % shard_state["count"]
+
+
+def shard_file_name(filename):
+    """
+    Return the name this worker uses for the persistence file 'filename',
+    e.g. dump-shard0of4.rdb for dump.rdb.
+    """
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}-shard{shard_state['index']}of{shard_state['count']}{ext}"
+
+
+def start_workers(count):
+    """
+    Fork 'count' worker processes, one per shard, and return in each of them.
+    Every pair of workers is connected by two socket pairs, one for each
+    direction: a worker forwards commands over its end of one, and serves
+    the other worker's commands on its end of the other as on any client
+    connection. The parent process only supervises the workers and never
+    returns: once one of them exits, it stops the others and exits too.
+    """
+    pairs = {(i, j): socket.socketpair() for i in range(count) for j in range(count) if i != j}
+    # Workers watch this pipe to exit with the parent
+    parent_watch, parent_alive = os.pipe()
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            os.close(parent_alive)
+            shard_state["index"] = index
+            shard_state["count"] = count
+            shard_state["parent_watch"] = parent_watch
+            for (i, j), (forward_end, serve_end) in pairs.items():
+                if i == index:
+                    shard_state["link_sockets"][j] = forward_end
+                    serve_end.close()
+                elif j == index:
+                    shard_state["peer_sockets"].append(serve_end)
+                    forward_end.close()
+                else:
+                    forward_end.close()
+                    serve_end.close()
+            # The memory limit is shared out between the shards
+            server_config["maxmemory"] //= count
+            server_config["dbfilename"] = shard_file_name(server_config["dbfilename"] or "dump.rdb")
+            server_config["appendfilename"] = shard_file_name(server_config["appendfilename"])
+            return
+        pids.append(pid)
+
+    for forward_end, serve_end in pairs.values():
+        forward_end.close()
+        serve_end.close()
+    os.close(parent_watch)
+    supervise_workers(pids)
+
+
+def supervise_workers(pids):
+    """
+    Wait for a worker to exit, then stop the others and exit.
+    """
+    print(f"Started {len(pids)} workers: {', '.join(map(str, pids))}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    status = 0
+    try:
+        pid, status = os.wait()
+        print(f"Worker {pid} exited, stopping the others")
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    sys.exit(1 if status else 0)
+
+
+def parent_exited():
+    """
+    Exit once the supervising process is gone, e.g. killed with SIGKILL.
+    """
+    print("Parent process exited, stopping worker")
+    write_aof_buffer()
+    os._exit(1)
+
+
+def drop_foreign_keys():
+    """
+    Remove the keys owned by other shards, after this worker loaded a file
+    holding the whole dataset.
+    """
+    index = shard_state["index"]
+    foreign = [key for key in db["dict"] if shard_of(key) != index]
+    for key in foreign:
+        remove_key(key)
+    print(f"Kept {len(db['dict'])} keys of shard {index}, dropped {len(foreign)}")
+
+
+class ShardLink(asyncio.Protocol):
+    """
+    Connection forwarding commands to the worker owning another shard.
+    That worker answers in order, so each reply resolves the oldest
+    waiting future.
+    """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.transport = None
+        self.buffer = bytearray()
+        self.queue = []
+        self.write_scheduled = False
+        self.waiters = deque()
+        self.up = True
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        replies, consumed = split_replies(self.buffer)
+        del self.buffer[:consumed]
+        waiters = self.waiters
+        for reply in replies:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(reply)
+
+    def connection_lost(self, exc):
+        print(f"Lost the link to shard {self.shard}")
+        self.up = False
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(SHARD_DOWN_REPLY)
+
+    def write_queue(self):
+        """
+        Write the commands queued for the other worker.
+        """
+        self.write_scheduled = False
+        if self.up:
+            self.transport.writelines(self.queue)
+        self.queue.clear()
+
+
+async def open_shard_links(protocol_factory):
+    """
+    Start forwarding commands to the other workers, and serving theirs with
+    connections made by 'protocol_factory'.
+    """
+    loop = asyncio.get_running_loop()
+    loop.add_reader(shard_state["parent_watch"], parent_exited)
+
+    for sock in shard_state["peer_sockets"]:
+        _, client = await loop.connect_accepted_socket(protocol_factory, sock)
+        # Links between workers are not clients: no maxclients, CLIENT LIST or timeout
+        clients.pop(client.id, None)
+        shard_state["peer_clients"].add(client)
+    shard_state["peer_sockets"].clear()
+
+    for shard, sock in shard_state["link_sockets"].items():
+        _, link = await loop.connect_accepted_socket(lambda: ShardLink(shard), sock)
+        shard_state["links"][shard] = link
+    shard_state["link_sockets"].clear()
+
+
+def forward_command(shard, args):
+    """
+    Send a command to the worker owning 'shard'.
+    Returns a future resolved with its encoded reply. Commands are queued
+    and sent once the current event loop turn is over, so everything
+    forwarded to a shard in between goes out with one write.
+    """
+    link = shard_state["links"][shard]
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    if not link.up:
+        future.set_result(SHARD_DOWN_REPLY)
+        return future
+    link.waiters.append(future)
+    link.queue.append(encode_command(args))
+    if not link.write_scheduled:
+        link.write_scheduled = True
+        loop.call_soon(link.write_queue)
+    return future
+
+
+def key_positions(entry, result):
+    """
+    Return the positions of the keys in the arguments of a command.
+    """
+    last = entry["last_key"]
+    end = len(result) + last + 1 if last < 0 else last + 1
+    return range(entry["first_key"], end, entry["key_step"])
+
+
+def split_command(entry, result):
+    """
+    Split a command by the shards owning its keys.
+    Returns {shard index: args}, with the keys of each shard (and the
+    values following them, e.g. for MSET) in their original order.
+    Commands flagged allshards go to every shard unchanged.
+    """
+    count = shard_state["count"]
+    if "allshards" in entry["flags"]:
+        return dict.fromkeys(range(count), result)
+
+    positions = key_positions(entry, result)
+    if len(positions) == 1:
+        return {zlib.crc32(result[positions[0]]) % count: result}
+
+    step = entry["key_step"]
+    parts = {}
+    for i in positions:
+        shard = zlib.crc32(result[i]) % count
+        part = parts.get(shard)
+        if part is None:
+            part = parts[shard] = [result[0]]
+        part += result[i:i + step]
+    if len(parts) == 1:
+        return dict.fromkeys(parts, result)
+    return parts
+
+
+def array_items(reply):
+    """
+    Return the encoded elements of an encoded RESP array.
+    """
+    header_end = reply.index(b"\r\n") + 2
+    items, _ = split_replies(reply[header_end:])
+    return items
+
+
+async def merge_replies(entry, result, replies):
+    """
+    Combine the replies of the shards that ran a part of a command into the
+    reply to the whole command, following the command's merge policy:
+      concat         the elements of every array reply; for commands with
+                     keys, in the order of their keys (e.g. MGET)
+      sum            the sum of integer replies (e.g. DEL)
+      all_succeeded  this worker's reply, or any, once none is an error
+    'replies' maps shard index -> encoded reply, or a future resolving to it.
+    The first error reply found is returned as is.
+    """
+    for shard, reply in replies.items():
+        if isinstance(reply, asyncio.Future):
+            replies[shard] = reply = await reply
+        if reply.startswith(b"-"):
+            return reply
+
+    policy = entry["merge"]
+    if policy == "sum":
+        return b":%d\r\n" % sum(int(reply[1:-2]) for reply in replies.values())
+    if policy == "all_succeeded":
+        return replies.get(shard_state["index"]) or next(iter(replies.values()))
+
+    items = {shard: array_items(reply) for shard, reply in replies.items()}
+    if "allshards" in entry["flags"]:
+        parts = [item for shard in sorted(items) for item in items[shard]]
+    else:
+        count = shard_state["count"]
+        shard_items = {shard: iter(shard_list) for shard, shard_list in items.items()}
+        parts = [next(shard_items[zlib.crc32(result[i]) % count]) for i in key_positions(entry, result)]
+    return b"*%d\r\n" % len(parts) + b"".join(parts)
+
+
+def scan_shard_cursor(cursor):
+    """
+    Split a SCAN cursor into (shard, cursor within that shard).
+    The walk goes through the shards one after the other.
+    """
+    cursor, shard = divmod(cursor, shard_state["count"])
+    return shard, cursor
+
+
+def next_scan_cursor(shard, cursor):
+    """
+    Return the SCAN cursor following a step on 'shard' that returned 'cursor':
+    the next shard from its start once this one is done, 0 after the last.
+    """
+    if cursor:
+        return cursor * shard_state["count"] + shard
+    return shard + 1 if shard + 1 < shard_state["count"] else 0
+
+
+async def forward_scan(shard, args):
+    """
+    Run a SCAN step on another shard and turn its cursor into a global one.
+    """
+    reply = await forward_command(shard, args)
+    if reply.startswith(b"-"):
+        return reply
+    cursor, keys = array_items(reply)
+    cursor = next_scan_cursor(shard, int(cursor[cursor.index(b"\r\n") + 2:-2]))
+    return b"*2\r\n" + encode_bulk(b"%d" % cursor) + keys
@@ -0,0 +1,197 @@
+import asyncio
+import itertools
+
+from parsers import encode_array
+from clients import client_class, deliver
+from globals import clients, tracking_table, tracking_prefixes, tracking_prefix_lengths, tracking_state
+from config import server_config
+
+# Invalidation messages look like Pub/Sub messages on this channel, with an
+# array of keys as payload (a null array once every key was flushed).
+TRACKING_CHANNEL = b"__redis__:invalidate"
+INVALIDATE_HEADER = b"*3\r\n$7\r\nmessage\r\n$20\r\n" + TRACKING_CHANNEL + b"\r\n"
+
+
+def parse_tracking_options(args):
+    """
+    Parse the options of CLIENT TRACKING ON: REDIRECT <id>, BCAST,
+    PREFIX <prefix> (any number of times), OPTIN and OPTOUT.
+    Returns a dict of them. Raises ValueError for an invalid combination.
+    """
+    options = {"redirect": None, "bcast": False, "prefixes": [], "optin": False, "optout": False}
+    i = 0
+    while i < len(args):
+        option = args[i].upper()
+        if option in (b"REDIRECT", b"PREFIX") and i + 1 < len(args):
+            if option == b"REDIRECT":
+                if not args[i + 1].isdigit() or int(args[i + 1]) not in clients:
+                    raise ValueError("The client ID you want redirect to does not exist")
+                options["redirect"] = int(args[i + 1])
+            else:
+                options["prefixes"].append(args[i + 1])
+            i += 2
+            continue
+        if option not in (b"BCAST", b"OPTIN", b"OPTOUT"):
+            raise ValueError("syntax error")
+        options[option.lower().decode()] = True
+        i += 1
+    if options["prefixes"] and not options["bcast"]:
+        raise ValueError("PREFIX option requires BCAST mode to be enabled")
+    if options["bcast"] and (options["optin"] or options["optout"]):
+        raise ValueError("OPTIN and OPTOUT are not compatible with BCAST")
+    if options["optin"] and options["optout"]:
+        raise ValueError("You can't use both OPTIN and OPTOUT")
+    return options
+
+
+def enable_tracking(client, options):
+    """
+    Turn on tracking for a client with the options of parse_tracking_options.
+    In BCAST mode the client is registered for its prefixes (every key
+    without any) rather than for the keys it reads.
+    """
+    if client.tracking:
+        disable_tracking(client)
+    client.tracking = True
+    client.tracking_redirect = options["redirect"]
+    client.tracking_optin = options["optin"]
+    client.tracking_optout = options["optout"]
+    client.caching = None
+    client.tracking_prefixes = (options["prefixes"] or [b""]) if options["bcast"] else []
+    for prefix in client.tracking_prefixes:
+        ids = tracking_prefixes.get(prefix)
+        if ids is None:
+            ids = tracking_prefixes[prefix] = set()
+            tracking_prefix_lengths[len(prefix)] = tracking_prefix_lengths.get(len(prefix), 0) + 1
+        ids.add(client.id)
+    tracking_state["clients"] += 1
+
+
+def disable_tracking(client):
+    """
+    Turn off tracking for a client. Its id is left in the table, where it
+    is skipped and dropped by the next invalidation of each key.
+    """
+    if not client.tracking:
+        return
+    client.tracking = False
+    for prefix in client.tracking_prefixes:
+        ids = tracking_prefixes[prefix]
+        ids.discard(client.id)
+        if not ids:
+            del tracking_prefixes[prefix]
+            tracking_prefix_lengths[len(prefix)] -= 1
+            if not tracking_prefix_lengths[len(prefix)]:
+                del tracking_prefix_lengths[len(prefix)]
+    client.tracking_prefixes = []
+    tracking_state["clients"] -= 1
+
+
+def track_keys(client, keys):
+    """
+    Remember that a tracking client read 'keys', so it is told when they
+    change. With OPTIN only the next read after CLIENT CACHING yes is
+    tracked, with OPTOUT every read but the next one after CLIENT CACHING no.
+    The table maps each key to one client id, or to a set of them once
+    several clients read it.
+    """
+    caching, client.caching = client.caching, None
+    if client.tracking_prefixes or client.tracking_optin and not caching or \
+            client.tracking_optout and caching is False:
+        return
+    table = tracking_table
+    client_id = client.id
+    for key in keys:
+        readers = table.get(key)
+        if readers is None:
+            table[key] = client_id
+        elif readers.__class__ is int:
+            if readers != client_id:
+                table[key] = {readers, client_id}
+        else:
+            readers.add(client_id)
+    excess = len(table) - server_config["tracking_table_max_keys"]
+    if excess > 0:
+        # The oldest keys are forgotten, their clients told to drop them
+        for key in list(itertools.islice(table, excess)):
+            invalidate_key(key)
+
+
+def queue_invalidation(client_id, key):
+    """
+    Queue the invalidation of 'key' (None for every key) for a client.
+    Invalidations are sent once the current event loop turn is over, one
+    message per client with every key invalidated meanwhile.
+    """
+    pending = tracking_state["pending"]
+    keys = pending.get(client_id, ())
+    if keys is None:
+        return
+    if key is None:
+        pending[client_id] = None
+    elif keys:
+        keys[key] = None
+    else:
+        pending[client_id] = {key: None}
+    if not tracking_state["scheduled"]:
+        try:
+            asyncio.get_running_loop().call_soon(send_invalidations)
+        except RuntimeError:
+            # No event loop yet (loading the dataset): no client to tell
+            pending.clear()
+            return
+        tracking_state["scheduled"] = True
+
+
+def invalidate_key(key):
+    """
+    Tell the clients that read 'key', and the BCAST clients whose prefixes
+    it starts with, that it changed. The key leaves the table.
+    """
+    readers = tracking_table.pop(key, None)
+    if readers is not None:
+        if readers.__class__ is int:
+            queue_invalidation(readers, key)
+        else:
+            for client_id in readers:
+                queue_invalidation(client_id, key)
+    for length in tracking_prefix_lengths:
+        ids = tracking_prefixes.get(key[:length])
+        if ids is not None:
+            for client_id in ids:
+                queue_invalidation(client_id, key)
+
+
+def invalidate_all():
+    """
+    Tell every tracking client that all keys changed, after a flush.
+    """
+    tracking_table.clear()
+    if tracking_state["clients"]:
+        for client in clients.values():
+            if client.tracking:
+                queue_invalidation(client.id, None)
+
+
+def send_invalidations():
+    """
+    Send the queued invalidations to the client each tracking client
+    redirects them to, if it is subscribed to TRACKING_CHANNEL.
+    Connections only speak RESP2, where a message in the middle of the
+    replies of a client that is not subscribed would be read as a reply:
+    as in Redis, the invalidations of a client without a subscribed
+    REDIRECT target are dropped.
+    """
+    tracking_state["scheduled"] = False
+    pending = tracking_state["pending"]
+    limits = server_config["client_output_buffer_limit"]
+    for client_id, keys in pending.items():
+        client = clients.get(client_id)
+        if client is None or not client.tracking or client.tracking_redirect is None:
+            continue
+        client = clients.get(client.tracking_redirect)
+        if client is None or TRACKING_CHANNEL not in client.channels:
+            continue
+        payload = b"*-1\r\n" if keys is None else encode_array(list(keys))
+        deliver((client,), INVALIDATE_HEADER + payload, limits[client_class(client)])
+    pending.clear()
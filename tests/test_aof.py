@@ -0,0 +1,132 @@
+import asyncio
+import os
+
+import pytest
+
+import server  # noqa: F401  registers the command handlers
+from aof import start_aof, feed_aof, fsync_aof, load_aof, write_aof_base, bgrewriteaof, rewrite_new_dataset
+from commands import COMMANDS
+from keyspace import flush_keyspace, store_value
+from parsers import encode_bulk, encode_command
+from globals import db, aof_state
+from config import server_config
+
+
+@pytest.fixture(autouse=True)
+def aof_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(server_config, "dir", str(tmp_path))
+    monkeypatch.setitem(server_config, "appendfilename", "appendonly.aof")
+    flush_keyspace(False)
+    initial = dict(aof_state)
+    yield tmp_path
+    if aof_state["fd"] is not None:
+        os.close(aof_state["fd"])
+    aof_state.update(initial, buffer=[])
+    flush_keyspace(False)
+
+
+def run(*args):
+    """
+    Run a write command like a client would, logging it.
+    """
+    args = [arg if isinstance(arg, bytes) else arg.encode() for arg in args]
+    COMMANDS[args[0].upper()]["handler"](None, args, [])
+    feed_aof(encode_command(args))
+
+
+def reload(path):
+    flush_keyspace(False)
+    load_aof(str(path))
+    return dict(db["dict"])
+
+
+def test_replay_base_and_commands(aof_dir):
+    path = aof_dir / "appendonly.aof"
+    write_aof_base(str(path), {b"base": encode_bulk(b"1")}, {})
+    with open(path, "ab") as file:
+        file.write(encode_command(["SET", "a", "1"]) + encode_command(["RPUSH", "list", "x", "y"]) +
+                   encode_command(["DEL", "base"]))
+    keyspace = reload(path)
+    assert sorted(keyspace) == [b"a", b"list"]
+    assert keyspace[b"a"] == encode_bulk(b"1")
+
+
+def test_replay_drops_truncated_command(aof_dir):
+    path = aof_dir / "appendonly.aof"
+    data = encode_command(["SET", "a", "1"]) + encode_command(["SET", "b", "2"])
+    path.write_bytes(data[:-3])
+    assert sorted(reload(path)) == [b"a"]
+
+
+def test_replay_rejects_read_commands(aof_dir):
+    path = aof_dir / "appendonly.aof"
+    path.write_bytes(encode_command(["GET", "a"]))
+    with pytest.raises(ValueError):
+        reload(path)
+
+
+def test_rewrite_keeps_every_write_and_syncs(aof_dir, monkeypatch):
+    # Take the thread path, which runs the whole rewrite in this process
+    monkeypatch.delattr(os, "fork", raising=False)
+    synced_fds = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        synced_fds.append(os.fstat(fd))
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    path = aof_dir / "appendonly.aof"
+
+    async def scenario():
+        start_aof()
+        for i in range(100):
+            run("SET", f"key:{i}", f"{i}")
+        await fsync_aof()
+        assert await bgrewriteaof()
+        # Writes made while the rewrite runs go to both files
+        for i in range(100, 150):
+            run("SET", f"key:{i}", f"{i}")
+        run("DEL", "key:0")
+        while aof_state["rewrite_buffer"] is not None:
+            await asyncio.sleep(0.01)
+        assert aof_state["last_rewrite_status"] == "ok"
+        # Everything logged is on disk in the new file without another fsync
+        assert aof_state["synced"] == aof_state["written"]
+        new_file = os.fstat(aof_state["fd"])
+        assert any(os.path.samestat(stat, new_file) for stat in synced_fds)
+        directory = os.stat(aof_dir)
+        assert any(os.path.samestat(stat, directory) for stat in synced_fds)
+        run("SET", "after", "1")
+        await fsync_aof()
+
+    asyncio.run(scenario())
+    expected = dict(db["dict"])
+    assert not any(name.startswith("temp-rewriteaof") for name in os.listdir(aof_dir))
+    assert reload(path) == expected
+    assert len(expected) == 150
+
+
+def test_rewrite_after_full_resync(aof_dir):
+    path = aof_dir / "appendonly.aof"
+
+    async def scenario():
+        start_aof()
+        for i in range(100):
+            run("SET", f"old:{i}", f"{i}")
+        assert await bgrewriteaof()
+        # A full resync replaces the dataset while that rewrite runs
+        flush_keyspace(False)
+        for i in range(50):
+            store_value(f"new:{i}".encode(), encode_bulk(b"v"))
+        await rewrite_new_dataset()
+        while aof_state["rewrite_buffer"] is not None:
+            await asyncio.sleep(0.01)
+        assert aof_state["last_rewrite_status"] == "ok"
+        run("SET", "after", "1")
+        await fsync_aof()
+
+    asyncio.run(scenario())
+    expected = dict(db["dict"])
+    assert len(expected) == 51
+    assert reload(path) == expected
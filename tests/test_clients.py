@@ -0,0 +1,157 @@
+import time
+
+import pytest
+
+import server
+from clients import parse_kill_filters, format_addr, check_client_output, clients_cron
+from keyspace import store_value, flush_keyspace
+from parsers import encode_bulk, encode_command
+from globals import clients, client_stats
+from config import server_config
+
+
+class FakeTransport:
+    def __init__(self, buffered=0):
+        self.buffered = buffered
+        self.writes = []
+        self.closed = self.aborted = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def writelines(self, data):
+        self.writes.append(b"".join(data))
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def get_extra_info(self, name):
+        return None
+
+    def set_write_buffer_limits(self, high, low):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def is_closing(self):
+        return self.closed or self.aborted
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+@pytest.fixture
+def connection():
+    """
+    A connected client whose transport records what is written to it.
+    """
+    client = server.ClientConnection()
+    client.connection_made(FakeTransport())
+    yield client
+    clients.pop(client.id, None)
+
+
+def test_parse_kill_filters():
+    assert parse_kill_filters([]) == {"skipme": True}
+    filters = parse_kill_filters([b"ID", b"5", b"addr", b"127.0.0.1:5000", b"TYPE", b"PubSub", b"SKIPME", b"no"])
+    assert filters == {"id": 5, "addr": "127.0.0.1:5000", "type": "pubsub", "skipme": False}
+
+
+@pytest.mark.parametrize("args", [[b"ID"], [b"ID", b"0"], [b"ID", b"x"], [b"TYPE", b"master"],
+                                  [b"SKIPME", b"maybe"], [b"USER", b"default"]])
+def test_parse_kill_filter_errors(args):
+    with pytest.raises(ValueError):
+        parse_kill_filters(args)
+
+
+def test_format_addr():
+    assert format_addr(("127.0.0.1", 6379)) == "127.0.0.1:6379"
+    assert format_addr(None) == ""
+
+
+def test_pubsub_hard_limit(connection, monkeypatch):
+    monkeypatch.setitem(server_config["client_output_buffer_limit"], "pubsub", (1000, 0, 0))
+    connection.channels.add(b"news")
+    connection.transport.buffered = 1000
+    assert check_client_output(connection)
+    connection.transport.buffered = 1001
+    assert not check_client_output(connection)
+    assert connection.transport.aborted
+
+
+def test_soft_limit_needs_soft_seconds(connection, monkeypatch):
+    monkeypatch.setitem(server_config["client_output_buffer_limit"], "normal", (0, 1000, 10))
+    connection.transport.buffered = 2000
+    assert check_client_output(connection)
+    assert connection.soft_limit_since is not None
+    connection.soft_limit_since -= 5
+    assert check_client_output(connection)
+    connection.soft_limit_since -= 6
+    assert not check_client_output(connection)
+    assert connection.transport.aborted
+
+
+def test_soft_limit_resets_once_below(connection, monkeypatch):
+    monkeypatch.setitem(server_config["client_output_buffer_limit"], "normal", (0, 1000, 10))
+    connection.transport.buffered = 2000
+    check_client_output(connection)
+    connection.transport.buffered = 10
+    assert check_client_output(connection)
+    assert connection.soft_limit_since is None
+
+
+def test_no_limits_for_normal_clients(connection):
+    connection.transport.buffered = 10 ** 9
+    assert check_client_output(connection)
+
+
+def test_long_batch_flushes_by_bytes(connection):
+    reply = encode_bulk(b"x" * (server.OUTPUT_CHUNK // 4))
+    flush_keyspace(False)
+    store_value(b"big", reply)
+    try:
+        connection.data_received(encode_command([b"GET", b"big"]) * 10)
+    finally:
+        flush_keyspace(False)
+    writes = connection.transport.writes
+    assert [len(data) // len(reply) for data in writes] == [4, 4, 2]
+
+
+def test_maxclients(monkeypatch):
+    monkeypatch.setitem(server_config, "maxclients", len(clients))
+    rejected = client_stats["rejected_connections"]
+    client = server.ClientConnection()
+    client.connection_made(FakeTransport())
+    assert client.id not in clients
+    assert client.transport.writes == [b"-ERR max number of clients reached\r\n"]
+    assert client.transport.closed
+    assert client_stats["rejected_connections"] == rejected + 1
+
+
+def test_idle_timeout(connection, monkeypatch):
+    monkeypatch.setitem(server_config, "timeout", 10)
+    connection.last_interaction = time.monotonic() - 5
+    clients_cron()
+    assert not connection.transport.closed
+    connection.last_interaction -= 6
+    clients_cron()
+    assert connection.transport.closed
+
+
+def test_idle_timeout_spares_subscribers_and_waiting_clients(connection, monkeypatch):
+    monkeypatch.setitem(server_config, "timeout", 10)
+    connection.last_interaction = time.monotonic() - 60
+    connection.channels.add(b"news")
+    clients_cron()
+    connection.channels.clear()
+    connection.waiting = object()
+    clients_cron()
+    assert not connection.transport.closed
+    monkeypatch.setitem(server_config, "timeout", 0)
+    connection.waiting = None
+    clients_cron()
+    assert not connection.transport.closed
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import server  # noqa: F401  registers the command handlers
+from commands import COMMANDS, CommandError
+from config import check_workers, parse_memory, parse_output_buffer_limit, server_config
+from globals import shard_state
+
+APP_DIR = os.path.dirname(os.path.abspath(server.__file__))
+
+
+@pytest.mark.parametrize("value, expected", [("1024", 1024), ("64kb", 64 * 1024), ("1mb", 1 << 20),
+                                             ("2GB", 2 << 30), (" 3 ", 3)])
+def test_parse_memory(value, expected):
+    assert parse_memory(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "mb", "1tb", "-1", "1.5mb"])
+def test_parse_memory_errors(value):
+    with pytest.raises(ValueError):
+        parse_memory(value)
+
+
+def test_parse_output_buffer_limit(monkeypatch):
+    limits = {name: value for name, value in server_config["client_output_buffer_limit"].items()}
+    monkeypatch.setitem(server_config, "client_output_buffer_limit", limits)
+    parse_output_buffer_limit("slave 1mb 512kb 10")
+    assert limits["replica"] == (1 << 20, 512 << 10, 10)
+    for value in ("replica 1mb", "unknown 0 0 0"):
+        with pytest.raises(ValueError):
+            parse_output_buffer_limit(value)
+
+
+def test_check_workers():
+    check_workers(1, "localhost 6379")
+    check_workers(4, None)
+    with pytest.raises(ValueError, match="at least 1"):
+        check_workers(0, None)
+    with pytest.raises(ValueError, match="--replicaof is not supported with --workers"):
+        check_workers(2, "localhost 6379")
+
+
+def test_replica_of_sharded_server_is_refused_at_startup():
+    process = subprocess.run([sys.executable, "main.py", "--workers", "2", "--replicaof", "localhost 6379"],
+                             cwd=APP_DIR, capture_output=True, text=True, timeout=30)
+    assert process.returncode == 2
+    assert "--replicaof is not supported with --workers" in process.stderr
+
+
+def test_psync_is_refused_in_sharded_mode(monkeypatch):
+    monkeypatch.setitem(shard_state, "count", 2)
+    with pytest.raises(CommandError, match="not supported with --workers"):
+        asyncio.run(COMMANDS[b"PSYNC"]["handler"](None, [b"PSYNC", b"?", b"-1"], []))
@@ -0,0 +1,155 @@
+import random
+
+import pytest
+
+from datatypes import Collection, COMPACT_MAX_ITEMS, COMPACT_MAX_VALUE, collection_size, collection_from_items, \
+    copy_collection, collection_items, hash_get, hash_set, hash_delete, list_push, list_pop, list_range, \
+    set_add, set_remove
+
+
+def items(count, prefix=b"item"):
+    return [b"%s:%d" % (prefix, i) for i in range(count)]
+
+
+def new_list(elements):
+    value = Collection("list")
+    list_push(value, elements, False)
+    return value
+
+
+def test_hash_converts_past_max_items():
+    value = Collection("hash")
+    for field in items(COMPACT_MAX_ITEMS):
+        hash_set(value, field, b"v")
+    assert value.encoding == "listpack"
+    # Overwriting a field does not add an entry
+    assert not hash_set(value, b"item:0", b"w")
+    assert value.encoding == "listpack"
+    assert hash_set(value, b"one-more", b"v")
+    assert value.encoding == "hashtable"
+    assert isinstance(value.items, dict) and len(value.items) == COMPACT_MAX_ITEMS + 1
+    assert hash_get(value, b"item:0") == b"w" and hash_get(value, b"one-more") == b"v"
+
+
+@pytest.mark.parametrize("field, field_value", [
+    (b"f" * (COMPACT_MAX_VALUE + 1), b"v"), (b"f", b"v" * (COMPACT_MAX_VALUE + 1))
+])
+def test_hash_converts_for_long_strings(field, field_value):
+    value = Collection("hash")
+    hash_set(value, b"f", b"v" * COMPACT_MAX_VALUE)
+    assert value.encoding == "listpack"
+    hash_set(value, field, field_value)
+    assert value.encoding == "hashtable"
+    assert hash_get(value, field) == field_value
+
+
+def test_list_converts_past_max_items():
+    value = new_list(items(COMPACT_MAX_ITEMS))
+    assert value.encoding == "listpack"
+    list_push(value, [b"head"], True)
+    assert value.encoding == "quicklist"
+    assert list_range(value, 0, 1) == [b"head", b"item:0"]
+    assert len(value.items) == COMPACT_MAX_ITEMS + 1
+
+
+def test_list_converts_for_long_elements():
+    value = new_list([b"x" * COMPACT_MAX_VALUE])
+    assert value.encoding == "listpack"
+    list_push(value, [b"x" * (COMPACT_MAX_VALUE + 1)], False)
+    assert value.encoding == "quicklist"
+
+
+def test_set_converts():
+    value = Collection("set")
+    for member in items(COMPACT_MAX_ITEMS):
+        set_add(value, member)
+    assert not set_add(value, b"item:0")
+    assert value.encoding == "listpack"
+    set_add(value, b"one-more")
+    assert value.encoding == "hashtable" and isinstance(value.items, set)
+    other = Collection("set")
+    set_add(other, b"m" * (COMPACT_MAX_VALUE + 1))
+    assert other.encoding == "hashtable"
+
+
+@pytest.mark.parametrize("kind, strings, encoding", [
+    ("hash", items(COMPACT_MAX_ITEMS * 2), "listpack"),
+    ("hash", items(COMPACT_MAX_ITEMS * 2 + 2), "hashtable"),
+    ("list", items(COMPACT_MAX_ITEMS), "listpack"),
+    ("list", [b"x" * (COMPACT_MAX_VALUE + 1)], "quicklist"),
+    ("set", items(COMPACT_MAX_ITEMS + 1), "hashtable")
+])
+def test_collection_from_items(kind, strings, encoding):
+    value = collection_from_items(kind, list(strings))
+    assert value.encoding == encoding
+    assert value.size == collection_size(value)
+    assert sorted(collection_items(value)) == sorted(strings)
+
+
+def test_size_accounting_hash():
+    rng = random.Random(1)
+    value = Collection("hash")
+    for _ in range(2000):
+        field = b"f%d" % rng.randrange(300)
+        if rng.random() < 0.3:
+            hash_delete(value, field)
+        else:
+            hash_set(value, field, b"v" * rng.randrange(1, 80 if rng.random() < 0.01 else 20))
+        assert value.size == collection_size(value)
+    assert value.encoding == "hashtable"
+
+
+def test_size_accounting_list():
+    rng = random.Random(2)
+    value = Collection("list")
+    for _ in range(2000):
+        if value.items and rng.random() < 0.4:
+            list_pop(value, rng.random() < 0.5)
+        else:
+            list_push(value, [b"e" * rng.randrange(1, 30) for _ in range(rng.randrange(1, 4))], rng.random() < 0.5)
+        assert value.size == collection_size(value)
+    assert value.encoding == "quicklist"
+
+
+def test_size_accounting_set():
+    rng = random.Random(3)
+    value = Collection("set")
+    for _ in range(2000):
+        member = b"m%d" % rng.randrange(300)
+        if rng.random() < 0.3:
+            set_remove(value, member)
+        else:
+            set_add(value, member)
+        assert value.size == collection_size(value)
+    assert value.encoding == "hashtable"
+
+
+def test_lrange_on_quicklist():
+    elements = items(1000)
+    value = new_list(elements)
+    assert value.encoding == "quicklist"
+    for start, stop in [(0, -1), (0, 0), (10, 20), (900, 950), (-5, -1), (-1000, 3), (-2000, 2000),
+                        (600, 400), (999, 999), (1000, 1005), (-3, -10), (0, -1001)]:
+        expected = elements[start if start >= 0 else max(len(elements) + start, 0):
+                            (stop if stop >= 0 else len(elements) + stop) + 1]
+        assert list_range(value, start, stop) == expected, (start, stop)
+
+
+def test_lpop_rpop_on_quicklist():
+    value = new_list(items(COMPACT_MAX_ITEMS + 10))
+    assert list_pop(value, True) == b"item:0"
+    assert list_pop(value, False) == b"item:%d" % (COMPACT_MAX_ITEMS + 9)
+    assert list_range(value, 0, 0) == [b"item:1"]
+    while value.items:
+        list_pop(value, True)
+    # Emptied lists keep their encoding and account for nothing but the collection
+    assert value.encoding == "quicklist"
+    assert value.size == collection_size(value)
+
+
+def test_copy_collection_is_independent():
+    value = new_list(items(COMPACT_MAX_ITEMS + 1))
+    copy = copy_collection(value)
+    list_pop(value, True)
+    assert len(copy.items) == COMPACT_MAX_ITEMS + 1
+    assert copy.size == collection_size(copy)
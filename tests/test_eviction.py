@@ -0,0 +1,136 @@
+import random
+import time
+
+import pytest
+
+import eviction
+from eviction import touch_key, lfu_decayed_counter, lfu_minutes, lru_clock, sample_keys, pick_victim, \
+    free_memory, LFU_INIT_VAL
+from keyspace import store_value, remove_key, set_expiry, clear_expiry, flush_keyspace
+from parsers import encode_bulk
+from globals import db, memory_state
+from config import server_config
+
+
+@pytest.fixture(autouse=True)
+def empty_keyspace(monkeypatch):
+    monkeypatch.setitem(memory_state, "track_access", "lru")
+    monkeypatch.setitem(eviction.sample_state, "policy", None)
+    flush_keyspace(False)
+    yield
+    flush_keyspace(False)
+
+
+@pytest.fixture
+def sample_everything(monkeypatch):
+    """
+    Make every sample cover all keys, so the pick only depends on scores.
+    """
+    monkeypatch.setattr(random, "choices", lambda population, k: list(population))
+
+
+def store(*keys):
+    for key in keys:
+        store_value(key, encode_bulk(b"v"))
+
+
+def test_touch_key_lru():
+    store(b"k")
+    touch_key(b"k")
+    assert db["key_meta"][b"k"] == lru_clock()
+
+
+def test_touch_key_lfu(monkeypatch):
+    monkeypatch.setitem(memory_state, "track_access", "lfu")
+    store(b"k")
+    monkeypatch.setattr(random, "random", lambda: 0.99)
+    touch_key(b"k")
+    # A new key starts at LFU_INIT_VAL, and the first access always counts
+    assert db["key_meta"][b"k"] & 0xFF == LFU_INIT_VAL + 1
+    assert db["key_meta"][b"k"] >> 8 == lfu_minutes()
+    # Past the initial value, an access only counts with decreasing odds
+    touch_key(b"k")
+    assert db["key_meta"][b"k"] & 0xFF == LFU_INIT_VAL + 1
+    monkeypatch.setattr(random, "random", lambda: 0)
+    touch_key(b"k")
+    assert db["key_meta"][b"k"] & 0xFF == LFU_INIT_VAL + 2
+
+
+def test_lfu_decay():
+    assert lfu_decayed_counter((100 << 8) | 20, 100) == 20
+    assert lfu_decayed_counter((100 << 8) | 20, 107) == 13
+    assert lfu_decayed_counter((100 << 8) | 20, 1000) == 0
+    # The minute clock wraps around at 16 bits
+    assert lfu_decayed_counter((0xFFFF << 8) | 20, 2) == 17
+
+
+def test_sample_keys_skips_free_slots():
+    store(*[b"key:%d" % i for i in range(100)])
+    for i in range(0, 100, 2):
+        remove_key(b"key:%d" % i)
+    keys = sample_keys(False, 200)
+    assert keys and all(int(key[4:]) % 2 for key in keys)
+    assert sample_keys(True, 5) == []
+
+
+def test_sample_keys_volatile_sees_later_ttls():
+    store(*[b"key:%d" % i for i in range(100)])
+    set_expiry(b"key:1", time.time() + 100)
+    assert set(sample_keys(True, 50)) == {b"key:1"}
+    # A TTL given after the earlier samples, and one removed since
+    set_expiry(b"key:2", time.time() + 100)
+    clear_expiry(b"key:1")
+    assert set(sample_keys(True, 50)) == {b"key:2"}
+
+
+def test_pick_victim_lru(sample_everything):
+    store(*[b"key:%d" % i for i in range(10)])
+    now = lru_clock()
+    for i in range(10):
+        db["key_meta"][b"key:%d" % i] = now - 100 + i
+    db["key_meta"][b"key:7"] = now - 1000
+    assert pick_victim("allkeys-lru") == b"key:7"
+    # The next best candidates are kept in the pool
+    remove_key(b"key:7")
+    assert [key for key, _ in eviction.sample_state["pool"]][:2] == [b"key:0", b"key:1"]
+    assert pick_victim("allkeys-lru") == b"key:0"
+
+
+def test_pick_victim_lfu(monkeypatch, sample_everything):
+    monkeypatch.setitem(memory_state, "track_access", "lfu")
+    store(b"hot", b"cold")
+    minute = lfu_minutes()
+    db["key_meta"][b"hot"] = (minute << 8) | 200
+    db["key_meta"][b"cold"] = (minute << 8) | 1
+    assert pick_victim("allkeys-lfu") == b"cold"
+
+
+def test_pick_victim_volatile_ttl(sample_everything):
+    store(b"a", b"b", b"c")
+    set_expiry(b"a", time.time() + 100)
+    set_expiry(b"b", time.time() + 10)
+    assert pick_victim("volatile-ttl") == b"b"
+    remove_key(b"b")
+    assert pick_victim("volatile-ttl") == b"a"
+    clear_expiry(b"a")
+    assert pick_victim("volatile-ttl") is None
+
+
+def test_pick_victim_with_mostly_free_slots():
+    store(*[b"key:%d" % i for i in range(10000)])
+    for i in range(1, 10000):
+        remove_key(b"key:%d" % i)
+    assert pick_victim("allkeys-lru") == b"key:0"
+
+
+def test_free_memory_evicts(monkeypatch, sample_everything):
+    store(*[b"key:%03d" % i for i in range(100)])
+    monkeypatch.setitem(server_config, "maxmemory", memory_state["used"] // 2)
+    monkeypatch.setitem(server_config, "maxmemory_policy", "allkeys-lru")
+    evicted = memory_state["evicted_keys"]
+    assert free_memory()
+    assert memory_state["used"] <= server_config["maxmemory"]
+    assert memory_state["evicted_keys"] - evicted == 50
+    monkeypatch.setitem(server_config, "maxmemory_policy", "noeviction")
+    monkeypatch.setitem(server_config, "maxmemory", 1)
+    assert not free_memory()
@@ -0,0 +1,139 @@
+import pytest
+
+from keyspace import compile_pattern, keys_matching, scan_keys, store_value, remove_key, flush_keyspace, \
+    index_keys
+from parsers import encode_bulk
+from globals import db
+
+
+@pytest.fixture(autouse=True)
+def empty_keyspace():
+    flush_keyspace(False)
+    yield
+    flush_keyspace(False)
+
+
+def matches(pattern, key):
+    return compile_pattern(pattern).match(key) is not None
+
+
+@pytest.mark.parametrize("pattern, key, expected", [
+    (b"*", b"anything", True),
+    (b"h?llo", b"hello", True),
+    (b"h?llo", b"hllo", False),
+    (b"h*llo", b"heeeello", True),
+    (b"h[ae]llo", b"hallo", True),
+    (b"h[ae]llo", b"hillo", False),
+    (b"h[^e]llo", b"hallo", True),
+    (b"h[^e]llo", b"hello", False),
+    (b"h[a-b]llo", b"hbllo", True),
+    (b"h[z-a]llo", b"hbllo", True),
+    (b"h[z-a]llo", b"h-llo", False),
+    (b"h\\*llo", b"h*llo", True),
+    (b"h\\*llo", b"hello", False),
+    (b"[\\]]", b"]", True),
+    (b"[a-]", b"b", False),
+    (b"[]", b"a", False),
+    (b"[^]", b"a", True),
+    (b"[abc", b"b", True),
+    (b"a.b", b"axb", False),
+    (b"a(b", b"a(b", True),
+    (b"line*", b"line\nbreak", True),
+])
+def test_compile_pattern(pattern, key, expected):
+    assert matches(pattern, key) is expected
+
+
+@pytest.mark.parametrize("pattern", [b"[z-a]", b"[", b"[\\", b"\\", b"[^", b"[a-", b"[]-]", b"(", b"[[:alpha:]]"])
+def test_compile_pattern_never_fails(pattern):
+    compile_pattern(pattern)
+
+
+def test_keys_matching():
+    for key in (b"user:1", b"user:2", b"other"):
+        store_value(key, encode_bulk(b"v"))
+    assert sorted(keys_matching(b"user:*")) == [b"user:1", b"user:2"]
+    assert keys_matching(b"[z-a]") == []
+
+
+def scan_all(count=10, pattern=None, between=None):
+    cursor, seen = 0, []
+    while True:
+        cursor, keys = scan_keys(cursor, pattern, count)
+        seen += keys
+        if between is not None:
+            between()
+        if cursor == 0:
+            return seen
+
+
+def test_scan_returns_every_key_once():
+    keys = [b"key:%d" % i for i in range(1000)]
+    for key in keys:
+        store_value(key, encode_bulk(b"v"))
+    seen = scan_all(count=7)
+    assert sorted(seen) == sorted(keys)
+
+
+def test_scan_with_match():
+    for i in range(100):
+        store_value(b"key:%d" % i, encode_bulk(b"v"))
+    assert sorted(scan_all(pattern=b"key:1?")) == sorted(b"key:1%d" % i for i in range(10))
+
+
+def test_scan_while_keyspace_changes():
+    stable = [b"stable:%d" % i for i in range(500)]
+    for i, key in enumerate(stable):
+        store_value(key, encode_bulk(b"v"))
+        store_value(b"temp:%d" % i, encode_bulk(b"v"))
+    added = iter(range(10 ** 6))
+
+    def churn():
+        # Delete some keys and add new ones, which reuse their slots
+        for _ in range(5):
+            remove_key(b"temp:%d" % next(added))
+            store_value(b"new:%d" % next(added), encode_bulk(b"v"))
+
+    seen = scan_all(count=10, between=churn)
+    assert sorted(key for key in seen if key.startswith(b"stable:")) == sorted(stable)
+    assert len(seen) == len(set(seen))
+
+
+def test_concurrent_scans_keep_working():
+    for i in range(200):
+        store_value(b"key:%d" % i, encode_bulk(b"v"))
+    walks = [[0, []] for _ in range(100)]
+    while any(walk[0] is not None for walk in walks):
+        for walk in walks:
+            if walk[0] is None:
+                continue
+            cursor, keys = scan_keys(walk[0], None, 5)
+            walk[1] += keys
+            walk[0] = cursor or None
+    for _, seen in walks:
+        assert len(seen) == 200 and len(set(seen)) == 200
+
+
+def test_scan_slots_are_reused():
+    for i in range(100):
+        store_value(b"key:%d" % i, encode_bulk(b"v"))
+    for i in range(100):
+        remove_key(b"key:%d" % i)
+    for i in range(100):
+        store_value(b"other:%d" % i, encode_bulk(b"v"))
+    assert len(db["scan_slots"]) == 100
+
+
+def test_scan_bad_cursor():
+    with pytest.raises(ValueError):
+        scan_keys(-1)
+    assert scan_keys(10 ** 9) == (0, [])
+
+
+def test_index_keys_after_bulk_load():
+    db["dict"].update({b"a": encode_bulk(b"1"), b"b": encode_bulk(b"2")})
+    index_keys()
+    assert db["scan_positions"] == {b"a": 0, b"b": 1}
+    assert sorted(scan_all()) == [b"a", b"b"]
+    remove_key(b"a")
+    assert scan_all() == [b"b"]
@@ -0,0 +1,92 @@
+import asyncio
+from collections import deque
+
+import pytest
+
+import lazyfree
+from lazyfree import free_lazily, drop_items, LAZYFREE_THRESHOLD, LAZYFREE_BATCH
+from datatypes import Collection
+from keyspace import store_value, set_expiry, flush_keyspace
+from parsers import encode_bulk
+from globals import db, lazyfree_state
+
+
+@pytest.fixture(autouse=True)
+def empty_queue():
+    flush_keyspace(False)
+    initial = dict(lazyfree_state, queue=deque())
+    yield
+    lazyfree_state.update(initial)
+    flush_keyspace(False)
+
+
+def test_small_container_is_not_queued():
+    async def scenario():
+        free_lazily(list(range(LAZYFREE_THRESHOLD)))
+    asyncio.run(scenario())
+    assert not lazyfree_state["queue"] and not lazyfree_state["scheduled"]
+
+
+def test_no_event_loop_is_not_queued():
+    free_lazily(list(range(10000)))
+    assert not lazyfree_state["queue"] and not lazyfree_state["scheduled"]
+
+
+@pytest.mark.parametrize("container", [
+    dict.fromkeys(range(1000)), list(range(1000)), deque(range(1000)), set(range(1000))
+])
+def test_drop_items_batches(container):
+    drop_items(container)
+    assert len(container) == 1000 - LAZYFREE_BATCH
+    while container:
+        drop_items(container)
+
+
+def test_drop_items_queues_large_collections():
+    value = Collection("list")
+    value.items = deque(range(1000))
+
+    async def scenario():
+        free_lazily({i: value for i in range(LAZYFREE_THRESHOLD + 1)})
+        drop_items(lazyfree_state["queue"][0])
+        return [container is value.items for container in lazyfree_state["queue"]]
+    assert any(asyncio.run(scenario()))
+
+
+def test_step_frees_everything_across_turns(monkeypatch):
+    monkeypatch.setattr(lazyfree, "LAZYFREE_BUDGET", 0)
+    containers = [list(range(1000)), dict.fromkeys(range(1000))]
+
+    async def scenario():
+        for container in containers:
+            free_lazily(container)
+        assert lazyfree_state["pending"] == 2
+        while lazyfree_state["scheduled"]:
+            await asyncio.sleep(0)
+    asyncio.run(scenario())
+    assert containers == [[], {}]
+    assert lazyfree_state["pending"] == 0 and lazyfree_state["freed"] == 2
+
+
+def test_lazy_flush_swaps_containers():
+    old = dict(db)
+
+    async def scenario():
+        for i in range(1000):
+            store_value(b"key:%d" % i, encode_bulk(b"v"))
+            set_expiry(b"key:%d" % i, 2 ** 40)
+        assert flush_keyspace(True) == 1000
+        assert all(db[name] is not old[name] and not db[name] for name in db)
+        assert old["dict"] and old["expires"] and old["scan_slots"]
+        while lazyfree_state["scheduled"]:
+            await asyncio.sleep(0)
+    asyncio.run(scenario())
+    assert not old["dict"] and not old["expires"] and not old["expiry_heap"] and not old["scan_slots"]
+
+
+def test_sync_flush_leaves_nothing_queued():
+    for i in range(1000):
+        store_value(b"key:%d" % i, encode_bulk(b"v"))
+    assert flush_keyspace(False) == 1000
+    assert not db["dict"] and not db["scan_positions"]
+    assert not lazyfree_state["queue"]
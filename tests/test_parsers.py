@@ -0,0 +1,125 @@
+import pytest
+
+from parsers import parse_commands, new_parse_state, parse_input, split_replies, encode_command, \
+    encode_array, encode_bulk, bulk_value
+
+
+def feed(data, chunk_size, ends=None):
+    """
+    Feed 'data' to parse_commands() 'chunk_size' bytes at a time, like a
+    connection does. Returns the commands parsed and what is left over.
+    """
+    buffer = bytearray()
+    state = new_parse_state()
+    commands = []
+    for i in range(0, len(data), chunk_size):
+        buffer += data[i:i + chunk_size]
+        parsed, consumed = parse_commands(buffer, ends, state)
+        del buffer[:consumed]
+        commands += parsed
+    return commands, bytes(buffer)
+
+
+def test_pipelined_commands():
+    data = encode_command(["SET", "a", "1"]) + encode_command(["GET", "a"])
+    ends = []
+    commands, consumed = parse_commands(bytearray(data), ends)
+    assert commands == [[b"SET", b"a", b"1"], [b"GET", b"a"]]
+    assert consumed == len(data)
+    assert ends == [len(encode_command(["SET", "a", "1"])), len(data)]
+
+
+def test_partial_command_is_left_in_buffer():
+    data = encode_command(["SET", "key", "value"])
+    commands, consumed = parse_commands(bytearray(data[:-3]))
+    assert commands == [] and consumed == 0
+
+
+def test_binary_safe_bulk_strings():
+    value = b"a\r\nb\x00c"
+    commands, _ = parse_commands(bytearray(encode_command([b"SET", b"k", value])))
+    assert commands == [[b"SET", b"k", value]]
+
+
+def test_inline_commands():
+    commands, consumed = parse_commands(bytearray(b"PING\r\nSET a  1\n"))
+    assert commands == [[b"PING"], [b"SET", b"a", b"1"]]
+    assert consumed == len(b"PING\r\nSET a  1\n")
+
+
+def test_empty_arrays_are_skipped():
+    data = b"*0\r\n*-1\r\n" + encode_command(["PING"])
+    commands, consumed = parse_commands(bytearray(data))
+    assert commands == [[b"PING"]] and consumed == len(data)
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"*2\r\n:1\r\n$3\r\nGET\r\n", "Protocol error: expected '$', got ':'"),
+    (b"*1\r\n*1\r\n$4\r\nPING\r\n", "Protocol error: expected '$', got '*'"),
+    (b"*1\r\n$-1\r\n", "Protocol error: invalid bulk length"),
+    (b"*x\r\n", "Protocol error: invalid multibulk length"),
+    (b"*1\r\n$3\r\nGETXX", "Protocol error: expected CRLF after bulk string"),
+])
+def test_protocol_errors(data, message):
+    with pytest.raises(ValueError, match=message.replace("$", r"\$").replace("*", r"\*")):
+        parse_commands(bytearray(data))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_command_split_across_reads(chunk_size):
+    data = encode_command(["SET", "a", "x" * 100]) + encode_command(["GET", "a"]) + b"PING\r\n"
+    commands, rest = feed(data, chunk_size)
+    assert commands == [[b"SET", b"a", b"x" * 100], [b"GET", b"a"], [b"PING"]]
+    assert rest == b""
+
+
+def test_ends_with_state():
+    data = encode_command(["SET", "a", "x" * 100]) + encode_command(["GET", "a"])
+    buffer = bytearray()
+    state = new_parse_state()
+    offsets = []
+    offset = 0
+    for i in range(0, len(data), 10):
+        buffer += data[i:i + 10]
+        ends = []
+        _, consumed = parse_commands(buffer, ends, state)
+        offsets += [offset + end for end in ends]
+        offset += consumed
+        del buffer[:consumed]
+    assert offsets == [len(encode_command(["SET", "a", "x" * 100])), len(data)]
+
+
+def test_large_command_in_chunks():
+    args = [b"MSET"] + [b"key:%d" % i for i in range(200000)]
+    data = encode_command(args)
+    buffer = bytearray()
+    state = new_parse_state()
+    for i in range(0, len(data), 65536):
+        buffer += data[i:i + 65536]
+        commands, consumed = parse_commands(buffer, state=state)
+        del buffer[:consumed]
+        # Only the bytes of the arguments still incomplete stay unparsed
+        assert state["args"] is None or state["offset"] > len(buffer) - 64
+    assert commands == [args]
+    assert not buffer
+
+
+def test_parse_input_replies():
+    assert parse_input(b"+OK\r\nrest") == ("OK", b"rest")
+    assert parse_input(b"-ERR bad\r\n") == ({"error": "ERR bad"}, b"")
+    assert parse_input(b":42\r\n") == (42, b"")
+    assert parse_input(b"$-1\r\n") == (None, b"")
+    assert parse_input(b"*2\r\n$1\r\na\r\n:1\r\n") == ([b"a", 1], b"")
+    with pytest.raises(ValueError):
+        parse_input(b"$5\r\nab")
+
+
+def test_split_replies():
+    data = b"+OK\r\n" + encode_array([b"a", b"b"]) + b"$3\r\nab"
+    frames, consumed = split_replies(data)
+    assert frames == [b"+OK\r\n", encode_array([b"a", b"b"])]
+    assert consumed == len(data) - len(b"$3\r\nab")
+
+
+def test_bulk_round_trip():
+    assert bulk_value(encode_bulk(b"hello\r\n")) == b"hello\r\n"
@@ -0,0 +1,61 @@
+import pytest
+
+import pubsub
+from pubsub import subscribe, psubscribe, punsubscribe, unsubscribe_all, matching_patterns, pattern_prefix
+from globals import pubsub_channels, pubsub_patterns, pubsub_prefixes, pubsub_prefix_lengths
+
+
+class FakeClient:
+    def __init__(self):
+        self.channels = set()
+        self.patterns = set()
+
+
+@pytest.fixture(autouse=True)
+def empty_pubsub():
+    yield
+    for container in (pubsub_channels, pubsub_patterns, pubsub_prefixes, pubsub_prefix_lengths):
+        container.clear()
+
+
+def test_pattern_prefix():
+    assert pattern_prefix(b"news.*") == b"news."
+    assert pattern_prefix(b"a?b") == b"a"
+    assert pattern_prefix(b"plain") == b"plain"
+
+
+def test_matching_patterns():
+    client = FakeClient()
+    for pattern in (b"news.*", b"news.[st]*", b"*", b"sport.*"):
+        psubscribe(client, pattern)
+    assert sorted(matching_patterns(b"news.tech")) == [b"*", b"news.*", b"news.[st]*"]
+    assert sorted(matching_patterns(b"weather")) == [b"*"]
+
+
+def test_unsubscribe_cleans_the_index():
+    a, b = FakeClient(), FakeClient()
+    psubscribe(a, b"news.*")
+    psubscribe(b, b"news.*")
+    subscribe(a, b"chan")
+    punsubscribe(a, b"news.*")
+    assert b"news.*" in pubsub_patterns
+    unsubscribe_all(a)
+    unsubscribe_all(b)
+    assert not pubsub_patterns and not pubsub_prefixes and not pubsub_prefix_lengths and not pubsub_channels
+
+
+def test_bad_pattern_leaves_no_state(monkeypatch):
+    def compile_pattern(pattern):
+        raise ValueError("invalid pattern")
+
+    client = FakeClient()
+    psubscribe(client, b"good.*")
+    monkeypatch.setattr(pubsub, "compile_pattern", compile_pattern)
+    with pytest.raises(ValueError):
+        psubscribe(client, b"bad[")
+    assert client.patterns == {b"good.*"}
+    assert list(pubsub_patterns) == [b"good.*"]
+    assert matching_patterns(b"bad") == []
+    # What connection_lost does
+    unsubscribe_all(client)
+    assert not pubsub_patterns and not pubsub_prefixes and not pubsub_prefix_lengths
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from crc64 import crc64
+from rdb import lzf_decompress, read_string, read_length, encode_length, iter_rdb_chunks, \
+    parse_rdb, check_rdb_header
+from datatypes import Collection, hash_set, list_push, set_add, collection_items
+from parsers import encode_bulk
+
+
+def test_crc64_check_value():
+    # The check value of Redis' CRC-64 (Jones polynomial)
+    assert crc64(b"123456789") == 0xe9c6d914c4b8d9ca
+
+
+def test_crc64_in_chunks():
+    data = bytes(range(256)) * 10
+    crc = 0
+    for i in range(0, len(data), 100):
+        crc = crc64(data[i:i + 100], crc)
+    assert crc == crc64(data)
+
+
+@pytest.mark.parametrize("compressed, expected", [
+    # A literal run of 3 bytes
+    (b"\x02abc", b"abc"),
+    # "abc", then 9 bytes copied from 3 back (length 7 + extra byte 0, overlapping)
+    (b"\x02abc\xe0\x00\x02", b"abcabcabcabc"),
+    # "ab", then 3 bytes copied from 2 back
+    (b"\x01ab\x20\x01", b"ababa"),
+    # A single byte repeated through a 1-byte back reference
+    (b"\x00x\xe0\x08\x00", b"x" * 18),
+])
+def test_lzf_decompress(compressed, expected):
+    assert lzf_decompress(compressed, len(expected)) == expected
+
+
+def test_lzf_errors():
+    with pytest.raises(ValueError):
+        lzf_decompress(b"\x02abc", 4)
+    with pytest.raises(ValueError):
+        lzf_decompress(b"\x00a\x20\x05", 4)
+
+
+def test_read_string_encodings():
+    assert read_string(b"\x03abc", 0) == (b"abc", 4)
+    assert read_string(b"\xc0\xfb", 0) == (b"-5", 2)
+    assert read_string(b"\xc1\x39\x30", 0) == (b"12345", 3)
+    assert read_string(b"\xc2\x15\xcd\x5b\x07", 0) == (b"123456789", 5)
+    compressed = b"\x02abc\xe0\x00\x02"
+    data = b"\xc3" + encode_length(len(compressed)) + encode_length(12) + compressed
+    assert read_string(data, 0) == (b"abcabcabcabc", len(data))
+
+
+@pytest.mark.parametrize("length", [0, 63, 64, 16383, 16384, 2 ** 32 - 1, 2 ** 32])
+def test_length_round_trip(length):
+    assert read_length(encode_length(length), 0) == (length, len(encode_length(length)), False)
+
+
+def test_snapshot_round_trip():
+    hash_value = Collection("hash")
+    hash_set(hash_value, b"field", b"value")
+    list_value = Collection("list")
+    list_push(list_value, [b"a", b"b", b"c"], False)
+    set_value = Collection("set")
+    for member in (b"x", b"y"):
+        set_add(set_value, member)
+    keyspace = {
+        b"string": encode_bulk(b"hello"),
+        b"binary": encode_bulk(bytes(range(256))),
+        b"hash": hash_value,
+        b"list": list_value,
+        b"set": set_value,
+        b"volatile": encode_bulk(b"soon gone"),
+        b"expired": encode_bulk(b"gone"),
+    }
+    expiries = {b"volatile": time.time() + 3600, b"expired": time.time() - 1}
+    data = b"".join(iter_rdb_chunks(keyspace, expiries))
+    assert crc64(data[:-8]) == int.from_bytes(data[-8:], "little")
+
+    check_rdb_header(data)
+    loaded, loaded_expiries = {}, {}
+    _, done, _ = parse_rdb(data, 9, loaded, loaded_expiries)
+    assert done
+    assert sorted(loaded) == sorted(key for key in keyspace if key != b"expired")
+    for key in (b"string", b"binary", b"volatile"):
+        assert loaded[key] == keyspace[key]
+    for key in (b"hash", b"list", b"set"):
+        assert loaded[key].type == keyspace[key].type
+        assert sorted(collection_items(loaded[key])) == sorted(collection_items(keyspace[key]))
+    assert list(loaded_expiries) == [b"volatile"]
+    assert abs(loaded_expiries[b"volatile"] - expiries[b"volatile"]) < 0.01
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import server
+from replication import propagate, create_backlog, feed_backlog, read_backlog, wait_for_slaves
+from commands import COMMANDS, CommandError
+from keyspace import flush_keyspace
+from parsers import encode_command
+from globals import repl_state, slaves
+from config import server_config
+
+
+@pytest.fixture(autouse=True)
+def fresh_stream(monkeypatch):
+    initial = dict(repl_state)
+    monkeypatch.setitem(server_config, "repl_backlog_size", 16)
+    repl_state.update(master_repl_offset=0, backlog=None, backlog_idx=0, backlog_histlen=0)
+    yield
+    repl_state.clear()
+    repl_state.update(initial)
+
+
+def test_master_writes_advance_the_stream(monkeypatch):
+    monkeypatch.setitem(server_config, "repl_backlog_size", 64)
+    create_backlog()
+    command = encode_command(["DEL", "k"])
+    propagate(command)
+    assert repl_state["master_repl_offset"] == len(command)
+    assert read_backlog(1) == command
+
+
+def test_replica_writes_leave_the_stream_alone(monkeypatch):
+    monkeypatch.setitem(server_config, "replicaof", "localhost 6379")
+    create_backlog()
+    repl_state["master_repl_offset"] = 100
+    # A client write on the replica, or a key it expires or evicts
+    propagate(encode_command(["SET", "local", "1"]))
+    propagate(encode_command(["DEL", "expired"]))
+    assert repl_state["master_repl_offset"] == 100
+    assert repl_state["backlog_histlen"] == 0
+
+
+def test_backlog_wraps_around():
+    create_backlog()
+    feed_backlog(b"0123456789")
+    feed_backlog(b"abcdefghij")
+    assert repl_state["master_repl_offset"] == 20
+    assert repl_state["backlog_histlen"] == 16
+    assert read_backlog(5) == b"456789abcdefghij"
+    assert read_backlog(15) == b"efghij"
+    assert read_backlog(21) == b""
+    # Already out of the backlog, or ahead of the stream
+    assert read_backlog(4) is None
+    assert read_backlog(22) is None
+
+
+def test_client_write_offset():
+    client = server.ClientConnection()
+    create_backlog()
+    repl_state["master_repl_offset"] = 100
+    try:
+        server.process_command(client, [b"SET", b"k", b"v"], [])
+        written = repl_state["master_repl_offset"]
+        assert client.woff == written > 100
+        server.process_command(client, [b"GET", b"k"], [])
+        server.process_command(None, [b"SET", b"other", b"v"], [])
+        assert client.woff == written < repl_state["master_repl_offset"]
+    finally:
+        flush_keyspace(False)
+
+
+def test_wait_for_the_client_offset(monkeypatch):
+    monkeypatch.setitem(slaves, "replica", {"ack_offset": 50})
+    # No new GETACK round: one covering every offset is already out
+    repl_state.update(master_repl_offset=80, getack_offset=80)
+    assert asyncio.run(wait_for_slaves(1, 10, 50)) == 1
+    assert asyncio.run(wait_for_slaves(1, 10, 60)) == 0
+
+
+def test_wait_negative_timeout():
+    client = server.ClientConnection()
+    with pytest.raises(CommandError, match="timeout is negative"):
+        asyncio.run(COMMANDS[b"WAIT"]["handler"](client, [b"WAIT", b"1", b"-1"], []))
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+
+import server
+from commands import COMMANDS, CommandError
+from keyspace import set_expiry, flush_keyspace
+from globals import db
+
+
+@pytest.fixture(autouse=True)
+def empty_keyspace():
+    flush_keyspace(False)
+    yield
+    flush_keyspace(False)
+
+
+def run(*args):
+    """
+    Run a command, returning its reply and its arguments as propagated.
+    """
+    result = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+    out = []
+    COMMANDS[result[0].upper()]["handler"](None, result, out)
+    return b"".join(out), result
+
+
+def test_set_ex_is_propagated_as_pxat():
+    now_ms = int(time.time() * 1000)
+    reply, result = run("SET", "k", "v", "EX", 100)
+    assert reply == b"+OK\r\n"
+    assert result[:4] == [b"SET", b"k", b"v", b"PXAT"]
+    assert now_ms + 100000 <= int(result[4]) <= now_ms + 101000
+    assert db["expires"][b"k"] == int(result[4]) / 1000
+
+
+def test_set_expire_options():
+    run("SET", "k", "v", "PX", 5000)
+    assert db["expires"][b"k"] - time.time() == pytest.approx(5, abs=1)
+    run("SET", "k", "v", "EXAT", 2 ** 32)
+    assert db["expires"][b"k"] == 2 ** 32
+    run("SET", "k", "v", "PXAT", 2 ** 42)
+    assert db["expires"][b"k"] == 2 ** 42 / 1000
+
+
+def test_set_nx_xx():
+    assert run("SET", "k", "1", "XX")[0] == server.NULL_BULK
+    assert b"k" not in db["dict"]
+    assert run("SET", "k", "1", "NX")[0] == b"+OK\r\n"
+    assert run("SET", "k", "2", "nx")[0] == server.NULL_BULK
+    assert run("SET", "k", "3", "XX")[0] == b"+OK\r\n"
+    assert db["dict"][b"k"] == b"$1\r\n3\r\n"
+
+
+def test_set_nx_on_an_expired_key():
+    run("SET", "k", "1")
+    set_expiry(b"k", time.time() - 1)
+    assert run("SET", "k", "2", "NX")[0] == b"+OK\r\n"
+    assert db["dict"][b"k"] == b"$1\r\n2\r\n"
+
+
+def test_set_nx_with_expiry_keeps_the_condition():
+    _, result = run("SET", "k", "v", "NX", "PX", 100)
+    assert result[3] == b"PXAT" and result[5] == b"NX"
+
+
+def test_set_keepttl():
+    run("SET", "k", "1", "EX", 100)
+    expire_at = db["expires"][b"k"]
+    run("SET", "k", "2", "KEEPTTL")
+    assert db["expires"][b"k"] == expire_at
+    run("SET", "k", "3")
+    assert b"k" not in db["expires"]
+
+
+def test_set_keepttl_on_an_expired_key():
+    run("SET", "k", "1")
+    set_expiry(b"k", time.time() - 1)
+    run("SET", "k", "2", "KEEPTTL")
+    assert db["dict"][b"k"] == b"$1\r\n2\r\n"
+    assert b"k" not in db["expires"]
+
+
+@pytest.mark.parametrize("options", [
+    ["EX", 0], ["PX", -5], ["EXAT", 0], ["PXAT", -1]
+])
+def test_set_invalid_expire_time(options):
+    with pytest.raises(CommandError, match="invalid expire time in 'set' command"):
+        run("SET", "k", "v", *options)
+    assert b"k" not in db["dict"]
+
+
+@pytest.mark.parametrize("options", [
+    ["EX"], ["NX", "XX"], ["EX", 10, "PX", 10], ["KEEPTTL", "EX", 10], ["PX", 10, "KEEPTTL"], ["GETX"]
+])
+def test_set_syntax_errors(options):
+    with pytest.raises(CommandError, match="syntax error"):
+        run("SET", "k", "v", *options)
+
+
+def test_set_expire_not_an_integer():
+    with pytest.raises(ValueError):
+        run("SET", "k", "v", "EX", "soon")
@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+
+from tracking import parse_tracking_options, enable_tracking, disable_tracking, track_keys, invalidate_key, \
+    invalidate_all, INVALIDATE_HEADER, TRACKING_CHANNEL
+from keyspace import store_value, remove_key, flush_keyspace
+from parsers import encode_bulk, encode_array
+from globals import clients, tracking_table, tracking_prefixes, tracking_prefix_lengths, tracking_state
+from config import server_config
+
+
+class FakeTransport:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class FakeClient:
+    def __init__(self, client_id):
+        self.id = client_id
+        self.transport = FakeTransport()
+        self.waiting = None
+        self.out = []
+        self.channels = set()
+        self.patterns = set()
+        self.soft_limit_since = None
+        self.tracking = False
+        self.tracking_redirect = None
+        self.tracking_prefixes = []
+        self.tracking_optin = self.tracking_optout = False
+        self.caching = None
+        clients[client_id] = self
+
+
+def tracking_client(client_id, *options):
+    """
+    Create a client tracking with 'options', and the subscribed client its
+    invalidations are redirected to (id client_id + 100).
+    """
+    listener = FakeClient(client_id + 100)
+    listener.channels.add(TRACKING_CHANNEL)
+    client = FakeClient(client_id)
+    enable_tracking(client, parse_tracking_options([b"REDIRECT", b"%d" % listener.id, *options]))
+    return client, listener
+
+
+def invalidation(keys):
+    return INVALIDATE_HEADER + (b"*-1\r\n" if keys is None else encode_array(keys))
+
+
+@pytest.fixture(autouse=True)
+def reset_tracking():
+    yield
+    for client in list(clients.values()):
+        disable_tracking(client)
+    clients.clear()
+    tracking_table.clear()
+    tracking_state["pending"].clear()
+    flush_keyspace(False)
+
+
+def run_loop_turn(function):
+    """
+    Run 'function' inside an event loop, then let queued invalidations out.
+    """
+    async def turn():
+        function()
+        await asyncio.sleep(0)
+
+    asyncio.run(turn())
+
+
+def test_parse_tracking_options():
+    FakeClient(7)
+    assert parse_tracking_options([]) == {"redirect": None, "bcast": False, "prefixes": [], "optin": False,
+                                          "optout": False}
+    options = parse_tracking_options([b"redirect", b"7", b"BCAST", b"PREFIX", b"a:", b"PREFIX", b"b:"])
+    assert options["redirect"] == 7 and options["bcast"] and options["prefixes"] == [b"a:", b"b:"]
+    assert parse_tracking_options([b"OPTIN"])["optin"]
+
+
+@pytest.mark.parametrize("args, message", [
+    ([b"REDIRECT", b"99"], "does not exist"),
+    ([b"REDIRECT", b"x"], "does not exist"),
+    ([b"PREFIX", b"a"], "requires BCAST"),
+    ([b"BCAST", b"OPTIN"], "not compatible with BCAST"),
+    ([b"OPTIN", b"OPTOUT"], "both OPTIN and OPTOUT"),
+    ([b"NOLOOP"], "syntax error"),
+    ([b"REDIRECT"], "syntax error"),
+])
+def test_parse_tracking_option_errors(args, message):
+    with pytest.raises(ValueError, match=message):
+        parse_tracking_options(args)
+
+
+def test_read_keys_are_invalidated_once():
+    reader, reader_listener = tracking_client(1)
+    writer, writer_listener = tracking_client(2)
+    track_keys(reader, [b"a", b"b"])
+    track_keys(writer, [b"a"])
+    assert tracking_table == {b"a": {1, 2}, b"b": 1}
+
+    def writes():
+        store_value(b"a", encode_bulk(b"1"))
+        store_value(b"b", encode_bulk(b"1"))
+        # No longer tracked: not reported twice
+        store_value(b"a", encode_bulk(b"2"))
+
+    run_loop_turn(writes)
+    assert reader_listener.transport.data == invalidation([b"a", b"b"])
+    assert writer_listener.transport.data == invalidation([b"a"])
+    # Nothing is mixed into the replies of the tracking connections
+    assert reader.transport.data == writer.transport.data == b""
+    assert not tracking_table
+
+
+def test_no_messages_without_subscribed_redirect_target():
+    # RESP2: the tracking connection itself never gets a message
+    alone = FakeClient(1)
+    enable_tracking(alone, parse_tracking_options([]))
+    # A REDIRECT target that is not subscribed gets none either
+    client, target = FakeClient(2), FakeClient(3)
+    enable_tracking(client, parse_tracking_options([b"REDIRECT", b"3"]))
+    track_keys(alone, [b"k"])
+    track_keys(client, [b"k"])
+    run_loop_turn(lambda: store_value(b"k", encode_bulk(b"v")))
+    assert alone.transport.data == client.transport.data == target.transport.data == b""
+    assert not tracking_table
+
+
+def test_bcast_prefixes():
+    client, listener = tracking_client(1, b"BCAST", b"PREFIX", b"user:", b"PREFIX", b"u")
+    assert tracking_prefix_lengths == {5: 1, 1: 1}
+
+    def writes():
+        store_value(b"user:1", encode_bulk(b"v"))
+        store_value(b"other", encode_bulk(b"v"))
+        remove_key(b"user:1")
+
+    run_loop_turn(writes)
+    assert listener.transport.data == invalidation([b"user:1"])
+    disable_tracking(client)
+    assert not tracking_prefixes and not tracking_prefix_lengths
+
+
+def test_optin_and_optout():
+    optin, _ = tracking_client(1, b"OPTIN")
+    optout, _ = tracking_client(2, b"OPTOUT")
+    track_keys(optin, [b"a"])
+    optin.caching = True
+    track_keys(optin, [b"b"])
+    track_keys(optout, [b"c"])
+    optout.caching = False
+    track_keys(optout, [b"d"])
+    assert tracking_table == {b"b": 1, b"c": 2}
+
+
+def test_flush_invalidates_everything():
+    client, listener = tracking_client(1)
+    track_keys(client, [b"a"])
+    run_loop_turn(lambda: (invalidate_key(b"a"), invalidate_all()))
+    assert listener.transport.data == invalidation(None)
+
+
+def test_table_max_keys(monkeypatch):
+    monkeypatch.setitem(server_config, "tracking_table_max_keys", 2)
+    client, listener = tracking_client(1)
+    run_loop_turn(lambda: track_keys(client, [b"a", b"b", b"c", b"d"]))
+    assert list(tracking_table) == [b"c", b"d"]
+    assert listener.transport.data == invalidation([b"a", b"b"])